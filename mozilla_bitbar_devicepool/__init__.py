@@ -12,15 +12,16 @@ import os
 # TODO: put %(asctime)s back in?
 logging.basicConfig(format="%(threadName)26s %(levelname)-8s %(message)s")
 
-from testdroid import Testdroid
-
 logger = logging.getLogger()
 
+# the rate limiter logs with the logger above.
+from mozilla_bitbar_devicepool.bitbar.ratelimit import RateLimitedTestdroid
+
 modulepath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 TESTDROID_URL = os.environ.get("TESTDROID_URL")
 TESTDROID_APIKEY = os.environ.get("TESTDROID_APIKEY")
 if TESTDROID_URL and TESTDROID_APIKEY:
-    TESTDROID = Testdroid(apikey=TESTDROID_APIKEY, url=TESTDROID_URL)
+    TESTDROID = RateLimitedTestdroid(apikey=TESTDROID_APIKEY, url=TESTDROID_URL)
 else:
     TESTDROID = None
@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from mozilla_bitbar_devicepool import configuration
+from mozilla_bitbar_devicepool.bitbar.runs import (
+    iter_active_test_runs,
+    iter_changed_test_runs,
+)
+
+# number of syncs between full resyncs of the active runs.
+FULL_SYNC_INTERVAL = 6
+# seconds before the previous sync from which an incremental sync requests
+# the changed runs, covering clock differences with Bitbar and runs which
+# changed while the previous sync was being read.
+SYNC_OVERLAP = 60
+
+ACTIVE_STATES = ("RUNNING", "WAITING")
+
+
+class ActiveRun(
+    namedtuple(
+        "ActiveRun", ("id", "project_name", "state", "create_time", "start_time")
+    )
+):
+    """Compact record of an active test run holding only the fields used
+    by the scheduler and reporting rather than the full Bitbar run. Times
+    are Bitbar's milliseconds since the epoch.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_item(cls, project_name, item):
+        return cls(
+            item["id"],
+            project_name,
+            # share one copy of each state string between the records.
+            sys.intern(item["state"]),
+            item.get("createTime"),
+            item.get("startTime"),
+        )
+
+
+class ActiveRunTracker(object):
+    """Index of the active Bitbar test runs of our projects by run id.
+
+    A full sync requests all the active runs of our own projects, using a
+    server side filter on their project ids, and rebuilds the index. The
+    syncs in between only request the runs of our projects which were
+    created, started or finished since the previous sync and apply them
+    to the index, so that the per project counts are only recomputed for
+    projects whose runs changed. Every full_sync_interval syncs is a full
+    sync, which also drops any run whose change was missed.
+    """
+
+    def __init__(self, full_sync_interval=FULL_SYNC_INTERVAL, clock=time.time):
+        self.full_sync_interval = max(1, full_sync_interval)
+        self.clock = clock
+        self.syncs = 0
+        # Bitbar milliseconds from which the next incremental sync requests
+        # the changed runs.
+        self.since = None
+        # run id -> ActiveRun
+        self.runs = {}
+        # project name -> {"RUNNING": count, "WAITING": count}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def get_project_name(self, project_ids, item):
+        """Return the name of our project the run belongs to, or None.
+
+        Runs are matched by projectId, falling back to their projectName
+        with our user id prefix removed if Bitbar omits the id.
+        """
+        project_id = item.get("projectId")
+        if project_id is not None:
+            return project_ids.get(project_id)
+        project_name = item["projectName"].replace(
+            "%s-" % configuration.get_me_id(), ""
+        )
+        if project_name in project_ids.values():
+            return project_name
+        return None
+
+    def request_full_sync(self):
+        """Make the next sync a full sync, e.g. after runs were removed
+        without finishing, which an incremental sync would not notice.
+        """
+        self.since = None
+
+    def sync(self, project_ids):
+        """Fetch the active or changed runs and apply them to the index.
+
+        :param project_ids: dict mapping the integer Bitbar project id to
+                            the project name for our projects.
+
+        Returns a tuple of the set of project names whose active runs
+        changed and a flag which is True if this was a full resync, in
+        which case the counts of every project should be refreshed as
+        runs may have been missed by the previous syncs.
+        """
+        full_sync = self.since is None or self.syncs % self.full_sync_interval == 0
+        start = self.clock()
+
+        if full_sync:
+            runs = {}
+            # without any project ids the filter would match every project.
+            result = ()
+            if project_ids:
+                result = iter_active_test_runs(project_ids=list(project_ids))
+        else:
+            # drop the runs of projects removed from the configuration.
+            project_names = set(project_ids.values())
+            runs = {
+                run_id: run
+                for run_id, run in self.runs.items()
+                if run.project_name in project_names
+            }
+            result = ()
+            if project_ids:
+                result = iter_changed_test_runs(list(project_ids), self.since)
+
+        for item in result:
+            project_name = self.get_project_name(project_ids, item)
+            # only track runs for projects in our config
+            if project_name is None:
+                continue
+            if item["state"] in ACTIVE_STATES and item.get("endTime") is None:
+                runs[item["id"]] = ActiveRun.from_item(project_name, item)
+            else:
+                runs.pop(item["id"], None)
+        # only count syncs which completed.
+        self.syncs += 1
+        self.since = int((start - SYNC_OVERLAP) * 1000)
+
+        with self.lock:
+            changed_projects = self._apply_deltas(runs)
+            if full_sync:
+                # rebuild the counts in case a change was missed.
+                self.counts = {}
+                for run in runs.values():
+                    self._count(run.project_name, run.state, 1)
+            self.runs = runs
+        return changed_projects, full_sync
+
+    def _count(self, project_name, state, delta):
+        counts = self.counts.setdefault(project_name, {"RUNNING": 0, "WAITING": 0})
+        counts[state] += delta
+
+    def _apply_deltas(self, runs):
+        changed_projects = set()
+        for run_id, run in self.runs.items():
+            current = runs.get(run_id)
+            if current is not None and current.state == run.state:
+                continue
+            # finished or changed state
+            self._count(run.project_name, run.state, -1)
+            changed_projects.add(run.project_name)
+        for run_id, run in runs.items():
+            previous = self.runs.get(run_id)
+            if previous is not None and previous.state == run.state:
+                continue
+            # started or changed state
+            self._count(run.project_name, run.state, 1)
+            changed_projects.add(run.project_name)
+        return changed_projects
+
+    def get_counts(self, project_name):
+        """Return a dict of the RUNNING and WAITING counts for the project."""
+        with self.lock:
+            return dict(self.counts.get(project_name, {"RUNNING": 0, "WAITING": 0}))
+
+    def get_project_runs(self, project_name):
+        """Return the list of ActiveRun records for the project."""
+        with self.lock:
+            return [
+                run for run in self.runs.values() if run.project_name == project_name
+            ]
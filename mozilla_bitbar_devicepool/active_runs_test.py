@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozilla_bitbar_devicepool import active_runs, configuration
+
+
+def test_active_run_tracker_deltas(monkeypatch):
+    responses = [
+        # full sync, includes a run from a project which isn't ours.
+        [
+            {"id": 1, "projectId": 10, "state": "RUNNING"},
+            {"id": 2, "projectId": 10, "state": "WAITING"},
+            {"id": 3, "projectId": 99, "state": "RUNNING"},
+        ],
+        # run 2 started running, run 4 created for project b.
+        [
+            {"id": 2, "projectId": 10, "state": "RUNNING"},
+            {"id": 4, "projectId": 20, "state": "WAITING"},
+        ],
+        # run 1 finished, run 5 was created and finished since the last sync.
+        [
+            {"id": 5, "projectId": 20, "state": "FINISHED", "endTime": 1},
+            {"id": 1, "projectId": 10, "state": "FINISHED", "endTime": 1},
+        ],
+        # nothing changed.
+        [],
+        # project b was removed from the configuration.
+        [],
+    ]
+    calls = []
+
+    def fake_iter_active_test_runs(project_ids=None):
+        calls.append(("active", project_ids))
+        return iter(responses.pop(0))
+
+    def fake_iter_changed_test_runs(project_ids, since):
+        calls.append(("changed", project_ids, since))
+        return iter(responses.pop(0))
+
+    monkeypatch.setattr(
+        active_runs, "iter_active_test_runs", fake_iter_active_test_runs
+    )
+    monkeypatch.setattr(
+        active_runs, "iter_changed_test_runs", fake_iter_changed_test_runs
+    )
+    now = [1000]
+    tracker = active_runs.ActiveRunTracker(full_sync_interval=5, clock=lambda: now[0])
+    project_ids = {10: "a", 20: "b"}
+
+    # the first full sync only changed project a.
+    assert tracker.sync(project_ids) == ({"a"}, True)
+    assert tracker.get_counts("a") == {"RUNNING": 1, "WAITING": 1}
+    assert tracker.get_counts("b") == {"RUNNING": 0, "WAITING": 0}
+
+    now[0] = 1010
+    assert tracker.sync(project_ids) == ({"a", "b"}, False)
+    assert tracker.get_counts("a") == {"RUNNING": 2, "WAITING": 0}
+    assert tracker.get_counts("b") == {"RUNNING": 0, "WAITING": 1}
+
+    now[0] = 1020
+    assert tracker.sync(project_ids) == ({"a"}, False)
+    assert tracker.get_counts("a") == {"RUNNING": 1, "WAITING": 0}
+    assert tracker.get_project_runs("a") == [
+        active_runs.ActiveRun(2, "a", "RUNNING", None, None)
+    ]
+
+    assert tracker.sync(project_ids) == (set(), False)
+    overlap = active_runs.SYNC_OVERLAP
+    assert calls == [
+        ("active", [10, 20]),
+        ("changed", [10, 20], (1000 - overlap) * 1000),
+        ("changed", [10, 20], (1010 - overlap) * 1000),
+        ("changed", [10, 20], (1020 - overlap) * 1000),
+    ]
+
+    # the runs of a project removed from the configuration are dropped.
+    assert tracker.sync({10: "a"}) == ({"b"}, False)
+    assert tracker.get_counts("b") == {"RUNNING": 0, "WAITING": 0}
+    assert tracker.get_project_runs("b") == []
+
+
+def test_active_run_tracker_project_name(monkeypatch):
+    monkeypatch.setitem(configuration.BITBAR_CACHE, "me", {"id": 7})
+    tracker = active_runs.ActiveRunTracker()
+    project_ids = {10: "a"}
+
+    assert tracker.get_project_name(project_ids, {"projectId": 10}) == "a"
+    assert tracker.get_project_name(project_ids, {"projectId": 99}) is None
+    # without a projectId, the projectName without our user id prefix.
+    assert tracker.get_project_name(project_ids, {"projectName": "7-a"}) == "a"
+    assert tracker.get_project_name(project_ids, {"projectName": "8-a"}) is None
+
+
+def test_active_run_tracker_request_full_sync(monkeypatch):
+    monkeypatch.setattr(active_runs, "iter_active_test_runs", lambda **kwargs: [])
+    monkeypatch.setattr(active_runs, "iter_changed_test_runs", lambda *args: [])
+    tracker = active_runs.ActiveRunTracker()
+
+    assert tracker.sync({10: "a"}) == (set(), True)
+    assert tracker.sync({10: "a"}) == (set(), False)
+    tracker.request_full_sync()
+    assert tracker.sync({10: "a"}) == (set(), True)
@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+import threading
+
+# projects with a higher priority are allocated devices first.
+PRIORITY = 0
+# projects of the same priority are allocated devices in proportion to
+# their shares.
+SHARE = 1
+
+
+def get_pool_name(project_config):
+    """Return the name of the pool of devices the project draws on: its
+    device model, or its device group when it has none.
+    """
+    return project_config.get("device_model") or project_config["device_group_name"]
+
+
+def get_slack(pending_tasks):
+    """Return the number of test runs which may be queued beyond the idle
+    devices, the same small logarithmic fudge term process_queue allows a
+    single project.
+    """
+    # warning: only take the log of positive non-zero numbers, or a
+    # "ValueError: math domain error" will be raised
+    return 1 + int(math.log10(1 + pending_tasks))
+
+
+def allocate(capacity, demands):
+    """Divide capacity test run starts between the projects.
+
+    Projects are served in order of descending priority. Within a
+    priority, each start goes to the project with remaining demand whose
+    devices in use per share is lowest, so that a project which already
+    has many running or waiting test runs does not starve the others.
+
+    :param capacity: number of test runs which may be started.
+    :param demands: dict mapping project name to a dict with the number
+                    of test runs the project wants to start ("demand"),
+                    its "priority", "share" and the number of its test
+                    runs which are running or waiting ("usage").
+    :returns: dict mapping project name to the number of test runs it
+              may start.
+    """
+    grants = dict((project_name, 0) for project_name in demands)
+    priorities = sorted(
+        set(demand["priority"] for demand in demands.values()), reverse=True
+    )
+    for priority in priorities:
+        project_names = sorted(
+            project_name
+            for project_name, demand in demands.items()
+            if demand["priority"] == priority
+        )
+
+        def get_load(project_name):
+            demand = demands[project_name]
+            return (demand["usage"] + grants[project_name]) / float(demand["share"])
+
+        while capacity > 0:
+            candidates = [
+                project_name
+                for project_name in project_names
+                if grants[project_name] < demands[project_name]["demand"]
+            ]
+            if not candidates:
+                break
+            # min is stable, ties go to the first project by name.
+            project_name = min(candidates, key=get_load)
+            grants[project_name] += 1
+            capacity -= 1
+    return grants
+
+
+class DeviceAllocator(object):
+    """Allocate test run starts between the projects sharing a pool of
+    devices.
+
+    The allocation passes are made by TestRunManager.allocate_test_runs
+    while holding lock. Runs granted to a project are reserved until the
+    project's queue worker has started them and counted them as WAITING,
+    so that the other projects' passes do not hand out the same devices
+    again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # project name -> test runs granted but not started yet.
+        self.reserved = {}
+
+    def release(self, project_name):
+        """Release the project's reservation once its queue worker has
+        started, or given up on, the runs it was granted.
+        """
+        with self.lock:
+            self.reserved.pop(project_name, None)
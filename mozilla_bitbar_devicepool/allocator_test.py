@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozilla_bitbar_devicepool import allocator
+
+
+def make_demand(demand, usage=0, priority=0, share=1):
+    return {"demand": demand, "usage": usage, "priority": priority, "share": share}
+
+
+def test_get_pool_name():
+    assert allocator.get_pool_name({"device_group_name": "group-1"}) == "group-1"
+    assert (
+        allocator.get_pool_name(
+            {"device_group_name": "group-1", "device_model": "pixel2"}
+        )
+        == "pixel2"
+    )
+
+
+def test_allocate_fair_share():
+    # the busier project only gets devices once the other catches up.
+    grants = allocator.allocate(
+        6, {"unit": make_demand(10, usage=4), "perf": make_demand(10)}
+    )
+    assert grants == {"unit": 1, "perf": 5}
+    # demand is never exceeded.
+    grants = allocator.allocate(
+        6, {"unit": make_demand(10, usage=4), "perf": make_demand(2)}
+    )
+    assert grants == {"unit": 4, "perf": 2}
+    grants = allocator.allocate(
+        6, {"unit": make_demand(10), "perf": make_demand(10, share=2)}
+    )
+    assert grants == {"unit": 2, "perf": 4}
+
+
+def test_allocate_priority():
+    grants = allocator.allocate(
+        4,
+        {
+            "unit": make_demand(3, priority=1, usage=10),
+            "batt": make_demand(3),
+            "perf": make_demand(3),
+        },
+    )
+    assert grants == {"unit": 3, "batt": 1, "perf": 0}
+    assert allocator.allocate(0, {"unit": make_demand(3)}) == {"unit": 0}
@@ -0,0 +1,329 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import functools
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mozilla_bitbar_devicepool import configuration, logger, metrics
+from mozilla_bitbar_devicepool import test_run_manager
+from mozilla_bitbar_devicepool.bitbar.ratelimit import get_backoff
+from mozilla_bitbar_devicepool.taskcluster import configure_session
+from mozilla_bitbar_devicepool.test_run_manager import TestRunManager
+
+
+class AsyncTestRunManager(TestRunManager):
+    """TestRunManager which runs queue handling, active run polling and
+    stats refreshing as coroutines on a single event loop rather than
+    as one thread per project.
+
+    The Testdroid and Taskcluster clients are synchronous, so their
+    requests are run on a small, bounded pool of executor threads
+    whose size does not depend on the number of projects.
+    """
+
+    # tell pytest to ignore this class, it's not a test class
+    __test__ = False
+
+    def __init__(
+        self,
+        wait=60,
+        update_bitbar=False,
+        watch_config=False,
+        start_workers=test_run_manager.START_MAX_WORKERS,
+        max_workers=8,
+        forecast=False,
+        allocate=False,
+    ):
+        super().__init__(
+            wait=wait,
+            update_bitbar=update_bitbar,
+            watch_config=watch_config,
+            start_workers=start_workers,
+            forecast=forecast,
+            allocate=allocate,
+        )
+        self.max_workers = max_workers
+        self.loop = None
+        self.executor = None
+        self.stop_event = None
+
+    def stop(self):
+        super().stop()
+        # may be called from the executor threads, see wake_project.
+        if self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def call(self, func, *args, name=None):
+        """Run the blocking func(*args) on the executor."""
+        if name:
+            func = functools.partial(self.run_as, name, func)
+        return await self.loop.run_in_executor(
+            self.executor, functools.partial(func, *args)
+        )
+
+    async def sleep(self, seconds):
+        """Sleep for seconds or until the manager is stopped."""
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def wake_project(self, project_name):
+        # called from the executor threads, the event must be set on the loop.
+        event = self.wakeup_events.get(project_name)
+        if event:
+            self.loop.call_soon_threadsafe(event.set)
+
+    async def wait_for_wakeup_async(self, project_name, timeout):
+        """Sleep for timeout seconds or until the project is woken or the
+        manager is stopped.
+        """
+        event = self.wakeup_events[project_name]
+        waiters = [
+            self.loop.create_task(event.wait()),
+            self.loop.create_task(self.stop_event.wait()),
+        ]
+        _done, pending = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        for waiter in pending:
+            waiter.cancel()
+        event.clear()
+
+    async def handle_queue_async(self, project_name, projects_config):
+        self.run_as(project_name, logger.info, "task starting")
+
+        while self.is_project_running(project_name):
+            start = time.time()
+            jobs_to_start = self.run_as(
+                project_name, self.process_queue, project_name, projects_config
+            )
+            await self.start_test_runs_async(
+                project_name, projects_config, jobs_to_start
+            )
+            if self.allocator:
+                self.allocator.release(project_name)
+            metrics.observe_loop("queue", time.time() - start)
+
+            if self.is_project_running(project_name):
+                await self.wait_for_wakeup_async(
+                    project_name,
+                    self.get_queue_interval(
+                        project_name, projects_config, jobs_to_start
+                    ),
+                )
+        self.run_as(project_name, logger.info, "task exiting")
+
+    async def start_test_runs_async(self, project_name, projects_config, count):
+        """Start count test runs for the project in batches of at most
+        start_workers concurrent requests.
+        """
+        for batch_start in range(0, count, self.start_workers):
+            if not self.is_project_running(project_name):
+                break
+            batch_size = min(self.start_workers, count - batch_start)
+            results = await asyncio.gather(
+                *[
+                    self.call(
+                        self.start_test_run,
+                        project_name,
+                        projects_config,
+                        name=project_name,
+                    )
+                    for _task in range(batch_size)
+                ],
+                return_exceptions=True
+            )
+            # a failed start must not end the project's queue task.
+            for result in results:
+                if isinstance(result, Exception):
+                    self.run_as(
+                        project_name,
+                        functools.partial(logger.error, exc_info=result),
+                        "Failed to start test run (%s: %s)."
+                        % (result.__class__.__name__, result),
+                    )
+
+    async def start_project_worker_async(self, project_name, projects_config):
+        self.stopped_projects.discard(project_name)
+        if project_name not in self.wakeup_events:
+            self.wakeup_events[project_name] = asyncio.Event()
+        # prepopulate stats
+        await self.call(self.update_project_stats, project_name, projects_config)
+        self.project_workers[project_name] = self.loop.create_task(
+            self.handle_queue_async(project_name, projects_config)
+        )
+
+    async def stop_project_workers_async(self, project_names):
+        for project_name in project_names:
+            self.stopped_projects.add(project_name)
+            self.wake_project(project_name)
+        for project_name in project_names:
+            worker = self.project_workers.pop(project_name, None)
+            if worker:
+                await worker
+
+    async def reload_async(self, projects_config):
+        while self.state == "RUNNING":
+            await self.sleep(1)
+            self.check_config_changed()
+            if self.state != "RUNNING" or not self.reload_requested:
+                continue
+            reload_result = await self.call(
+                self.reload_configuration, projects_config, name="reload"
+            )
+            if reload_result is None:
+                continue
+            changes, stop_projects, start_projects = reload_result
+            await self.stop_project_workers_async(stop_projects)
+            configuration.remove_configuration(changes)
+            for project_name in changes["removed_projects"]:
+                metrics.remove_project(project_name)
+                if self.forecaster:
+                    self.forecaster.remove_project(project_name)
+            for project_name in start_projects:
+                await self.start_project_worker_async(project_name, projects_config)
+            await self.call(
+                self.refresh_pending_tasks, projects_config, name="pending_tasks"
+            )
+
+    async def active_jobs_async(self):
+        while self.state == "RUNNING":
+            logger.info("getting active runs")
+            try:
+                await self.call(self.process_active_runs, name="active_jobs")
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("exception raised when calling process_active_runs.")
+                logger.warning(e)
+                await self.sleep(get_backoff("admin"))
+            except Exception as e:
+                logger.error(
+                    "Failed to process active runs (%s: %s)."
+                    % (e.__class__.__name__, e),
+                    exc_info=True,
+                )
+                await self.sleep(get_backoff("admin"))
+            await self.sleep(self.active_runs_interval.value)
+
+    async def pending_tasks_async(self, projects_config):
+        while self.state == "RUNNING":
+            await self.sleep(self.pending_tasks_interval.value)
+            if self.state != "RUNNING":
+                break
+            try:
+                await self.call(
+                    self.process_pending_tasks, projects_config, name="pending_tasks"
+                )
+            except Exception as e:
+                logger.error(
+                    "Failed to get pending tasks (%s: %s)." % (e.__class__.__name__, e),
+                    exc_info=True,
+                )
+
+    async def stats_async(self, projects_config):
+        while self.state == "RUNNING":
+            await self.sleep(60)
+            if self.state != "RUNNING":
+                break
+            logger.info("getting stats for all projects")
+            start = time.time()
+            try:
+                await self.call(self.process_device_health, projects_config)
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("exception raised when calling process_device_health.")
+                logger.warning(e)
+            except Exception as e:
+                logger.error(
+                    "Failed to process device health (%s: %s)."
+                    % (e.__class__.__name__, e),
+                    exc_info=True,
+                )
+                await self.sleep(get_backoff("admin"))
+            for project_name in list(projects_config):
+                if project_name == "defaults" or project_name not in projects_config:
+                    continue
+                try:
+                    await self.call(
+                        self.update_project_stats, project_name, projects_config
+                    )
+                except requests.exceptions.ConnectionError as e:
+                    logger.warning(
+                        "exception raised when calling get_bitbar_test_stats."
+                    )
+                    logger.warning(e)
+                    await self.sleep(get_backoff("devices"))
+                except Exception as e:
+                    logger.error(
+                        "Failed to update stats for %s (%s: %s)."
+                        % (project_name, e.__class__.__name__, e),
+                        exc_info=True,
+                    )
+                    await self.sleep(get_backoff("devices"))
+            self.log_totals(projects_config)
+            metrics.observe_loop("stats", time.time() - start)
+
+    async def run_async(self):
+        CONFIG = test_run_manager.CONFIG
+        projects_config = CONFIG["projects"]
+        self.stop_event = asyncio.Event()
+        # handle the signals on the loop so that sleeping coroutines are
+        # woken immediately.
+        for signalnum in (
+            signal.SIGUSR2,
+            signal.SIGINT,
+            signal.SIGHUP,
+            signal.SIGUSR1,
+        ):
+            self.loop.add_signal_handler(signalnum, self.handle_signal, signalnum, None)
+
+        tasks = []
+        logger.info("test-run-manager: loading existing runs")
+        tasks.append(self.loop.create_task(self.active_jobs_async()))
+        await self.sleep(2)
+
+        logger.info("test-run-manager: loading pending tasks")
+        configure_session(pool_size=self.max_workers)
+        await self.call(self.refresh_pending_tasks, projects_config)
+        tasks.append(self.loop.create_task(self.pending_tasks_async(projects_config)))
+
+        logger.info("test-run-manager: loading device health")
+        await self.call(self.process_device_health, projects_config)
+
+        for project_name in projects_config:
+            if project_name == "defaults":
+                continue
+
+            project_config = projects_config[project_name]
+            additional_parameters = project_config["additional_parameters"]
+            worker_type = additional_parameters.get("TC_WORKER_TYPE")
+
+            if not worker_type:
+                # Only manage projects initiated via Taskcluster.
+                continue
+
+            await self.start_project_worker_async(project_name, projects_config)
+
+        tasks.append(self.loop.create_task(self.stats_async(projects_config)))
+        tasks.append(self.loop.create_task(self.reload_async(projects_config)))
+        await asyncio.gather(*tasks)
+        # queue workers started by a reload are not in tasks.
+        await asyncio.gather(*self.project_workers.values())
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="bitbar"
+        )
+        try:
+            self.loop.run_until_complete(self.run_async())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.loop.close()
+        logger.info("main thread exiting")
@@ -0,0 +1,467 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Benchmarks of the test run manager's configuration and scheduling loops
+# against the fake Bitbar and Taskcluster server with synthetic
+# configurations.
+#
+# Each scenario is measured in a child process
+#   python -m mozilla_bitbar_devicepool.benchmark <options json>
+# whose environment points the Testdroid and Taskcluster clients at a
+# fake server run by the parent, so that the server does not share the
+# measured process's interpreter or memory.
+
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+
+from mozilla_bitbar_devicepool import fake_server, logger, modulepath
+
+# <projects>x<devices per project>x<active runs>
+SCENARIOS = ("10x5x20", "50x10x200", "200x10x1000")
+# passes of each scheduling loop measured per scenario.
+CYCLES = 10
+# seconds the complete manager runs to measure the task to run latency.
+LATENCY_SECONDS = 60
+# the manager's wait, see start-test-run-manager --wait.
+WAIT = 20
+RUN_DURATION = 30
+# fraction of each device group kept busy by the tasks queued during the
+# latency measurement.
+UTILIZATION = 0.5
+# well above the production rate limit so that the benchmark measures
+# the manager rather than the rate limiter.
+REQUESTS_PER_SECOND = 1000
+# relative increase of a result over the previous version which is
+# reported as a regression.
+REGRESSION_THRESHOLD = 0.2
+# results compared between versions, all of which are better when lower.
+COMPARED_RESULTS = (
+    "configure_seconds",
+    "configure_calls",
+    "active_runs_seconds",
+    "active_runs_calls",
+    "stats_seconds",
+    "stats_calls",
+    "pending_tasks_seconds",
+    "pending_tasks_calls",
+    "queue_seconds",
+    "queue_calls",
+    "memory_per_project",
+    "task_latency_mean",
+    "task_latency_p95",
+)
+PROJECTS_PER_DEVICE_MODEL = 3
+APPLICATION_FILE = "benchmark-app.apk"
+TEST_FILE = "benchmark-test.zip"
+
+
+def parse_scenario(text):
+    """Parse a scenario of the form <projects>x<devices>x<active runs>.
+
+    Examples:
+       parse_scenario('50x10x200')
+       # {'projects': 50, 'devices': 10, 'active_runs': 200}
+    """
+    try:
+        projects, devices, active_runs = [int(value) for value in text.split("x")]
+    except ValueError:
+        raise ValueError(
+            "scenario {} is not <projects>x<devices>x<active runs>".format(text)
+        )
+    return {"projects": projects, "devices": devices, "active_runs": active_runs}
+
+
+def format_scenario(scenario):
+    return "{projects}x{devices}x{active_runs}".format(**scenario)
+
+
+def make_config(projects, devices):
+    """Return a synthetic Bitbar configuration with projects projects,
+    each with its own worker type and a device group of devices devices.
+    Every PROJECTS_PER_DEVICE_MODEL projects share a device model.
+    """
+    config = {
+        "projects": {
+            "defaults": {
+                "os_type": "ANDROID",
+                "project_type": "GENERIC",
+                "application_file": APPLICATION_FILE,
+                "test_file": TEST_FILE,
+                "timeout": 0,
+                "scheduler": "SINGLE",
+                "archivingStrategy": "DAYS",
+                "archivingItemCount": 7,
+                "taskcluster_provisioner_id": "proj-autophone",
+                "additional_parameters": {"TC_WORKER_CONF": "gecko-t-ap"},
+            }
+        },
+        "device_groups": {},
+    }
+    for project_index in range(projects):
+        device_model = "model{}".format(project_index // PROJECTS_PER_DEVICE_MODEL)
+        device_group_name = "{}-group-{}".format(device_model, project_index)
+        config["projects"]["benchmark-{}".format(project_index)] = {
+            "device_group_name": device_group_name,
+            "device_model": device_model,
+            "framework_name": "mozilla-usb",
+            "description": "Benchmark project {}".format(project_index),
+            "additional_parameters": {
+                "TC_WORKER_TYPE": "gecko-t-bitbar-benchmark-{}".format(project_index)
+            },
+        }
+        config["device_groups"][device_group_name] = {
+            "{}-{:04d}".format(device_group_name, device_index): None
+            for device_index in range(devices)
+        }
+    return config
+
+
+def get_version():
+    """Return the git description of the checkout, or None."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"],
+                cwd=modulepath,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_rss():
+    """Return the resident memory of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        # peak rather than current on platforms without /proc.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_api_calls():
+    """Return the number of Bitbar and Taskcluster requests made since
+    the last call.
+    """
+    from mozilla_bitbar_devicepool import instrumentation
+
+    return sum(
+        endpoint_stat["count"]
+        for endpoint_stat in instrumentation.get_stats(reset=True).values()
+    )
+
+
+def measure(options):
+    """Measure the manager's loops in this process, which must have been
+    started with the environment of the fake server at options['url'].
+
+    Returns a dict of results.
+    """
+    # imported here as the Testdroid client is created from the
+    # environment when the package is first imported.
+    from mozilla_bitbar_devicepool import configuration, metrics
+    from mozilla_bitbar_devicepool.bitbar.ratelimit import configure_rate_limiter
+    from mozilla_bitbar_devicepool.test_run_manager import TestRunManager
+
+    configure_rate_limiter(
+        options["requests_per_second"], options["requests_per_second"]
+    )
+    results = {}
+    cycles = options["cycles"]
+    projects = options["projects"]
+
+    count_api_calls()
+    rss = get_rss()
+    start = time.time()
+    configuration.configure(
+        options["config_path"],
+        filespath=options["files_path"],
+        cache_snapshot_path=None,
+    )
+    results["configure_seconds"] = time.time() - start
+    results["configure_calls"] = count_api_calls()
+
+    manager = TestRunManager(wait=options["wait"])
+    projects_config = configuration.CONFIG["projects"]
+    project_names = [name for name in projects_config if name != "defaults"]
+
+    start = time.time()
+    for _ in range(cycles):
+        manager.process_active_runs()
+    results["active_runs_seconds"] = (time.time() - start) / cycles
+    results["active_runs_calls"] = count_api_calls() / cycles
+
+    start = time.time()
+    manager.process_device_health(projects_config)
+    for project_name in project_names:
+        manager.update_project_stats(project_name, projects_config)
+    results["stats_seconds"] = time.time() - start
+    results["stats_calls"] = count_api_calls()
+
+    start = time.time()
+    manager.process_pending_tasks(projects_config)
+    results["pending_tasks_seconds"] = time.time() - start
+    results["pending_tasks_calls"] = count_api_calls()
+
+    # no tasks are pending, so the passes only decide how many test runs
+    # to start.
+    start = time.time()
+    for _ in range(cycles):
+        for project_name in project_names:
+            manager.process_queue(project_name, projects_config)
+    results["queue_seconds"] = (time.time() - start) / cycles
+    results["queue_calls"] = count_api_calls() / cycles
+    results["memory_per_project"] = (get_rss() - rss) / projects
+
+    # run the complete manager against a steady arrival of tasks.
+    requests.post(options["url"] + "/fake/reset").raise_for_status()
+    requests.post(
+        options["url"] + "/fake/settings",
+        json={
+            "task_rate": options["task_rate"],
+            "run_duration": options["run_duration"],
+        },
+    ).raise_for_status()
+    # the reset removed the runs without finishing them.
+    manager.active_runs.request_full_sync()
+    manager.process_active_runs()
+    configuration.CONFIG["threads"] = []
+    threading.Thread(
+        target=manager.thread_active_jobs, name="active_jobs", daemon=True
+    ).start()
+    threading.Thread(
+        target=manager.thread_pending_tasks,
+        name="pending_tasks",
+        args=(projects_config,),
+        daemon=True,
+    ).start()
+    for project_name in project_names:
+        manager.start_project_worker(project_name, projects_config)
+    time.sleep(options["latency_seconds"])
+    manager.stop()
+    for thread in manager.project_workers.values():
+        thread.join()
+    if manager.start_executor:
+        manager.start_executor.shutdown(wait=True)
+
+    state = requests.get(options["url"] + "/fake/state").json()
+    claim_latency = state["claim_latency"]
+    results["tasks_claimed"] = claim_latency["count"]
+    for name in ("mean", "p50", "p95", "max"):
+        results["task_latency_" + name] = claim_latency.get(name)
+    results["runs_started"] = sum(metrics.COUNTERS["runs_started"].values())
+    return results
+
+
+def run_scenario(
+    scenario,
+    cycles=CYCLES,
+    wait=WAIT,
+    latency_seconds=LATENCY_SECONDS,
+    run_duration=RUN_DURATION,
+    utilization=UTILIZATION,
+    requests_per_second=REQUESTS_PER_SECOND,
+    seed=None,
+):
+    """Measure a scenario in a child process against a fake server and
+    return the benchmark record.
+
+    :param scenario: dict as returned by parse_scenario.
+    """
+    config = make_config(scenario["projects"], scenario["devices"])
+    bitbar = fake_server.FakeBitbar(run_duration=run_duration, seed=seed)
+    bitbar.load_configuration(config)
+
+    # keep the active runs RUNNING, or WAITING once every device is busy,
+    # until the latency measurement.
+    projects = sorted(bitbar.projects.values(), key=lambda project: project["id"])
+    device_groups = {
+        device_group["displayName"]: device_group
+        for device_group in bitbar.device_groups.values()
+    }
+    project_configs = config["projects"]
+    with bitbar.lock:
+        for run_index in range(scenario["active_runs"]):
+            project = projects[run_index % len(projects)]
+            project_config = project_configs[project["name"].split("-", 1)[1]]
+            device_group = device_groups[project_config["device_group_name"]]
+            bitbar.create_run(
+                {"projectId": project["id"], "deviceGroupId": device_group["id"]},
+                duration=365 * 24 * 3600,
+            )
+    bitbar.advance()
+
+    server = fake_server.start_fake_server(bitbar)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config_path = os.path.join(tmpdir, "config.yml")
+            with open(config_path, "w") as config_file:
+                yaml.safe_dump(config, config_file)
+            for file_name in (APPLICATION_FILE, TEST_FILE):
+                open(os.path.join(tmpdir, file_name), "w").close()
+
+            options = dict(
+                scenario,
+                url=server.get_url(),
+                config_path=config_path,
+                files_path=tmpdir,
+                cycles=cycles,
+                wait=wait,
+                latency_seconds=latency_seconds,
+                run_duration=run_duration,
+                task_rate=utilization * scenario["devices"] / run_duration,
+                requests_per_second=requests_per_second,
+            )
+            environment = dict(os.environ)
+            environment.update(fake_server.get_environment(config, server.get_url()))
+            environment["PYTHONPATH"] = os.pathsep.join(
+                filter(None, [modulepath, environment.get("PYTHONPATH")])
+            )
+            output = subprocess.check_output(
+                [
+                    sys.executable,
+                    "-m",
+                    "mozilla_bitbar_devicepool.benchmark",
+                    json.dumps(options),
+                ],
+                env=environment,
+            )
+    finally:
+        server.stop()
+
+    return {
+        "timestamp": time.time(),
+        "version": get_version(),
+        "python": platform.python_version(),
+        "scenario": format_scenario(scenario),
+        "options": {
+            "cycles": cycles,
+            "wait": wait,
+            "latency_seconds": latency_seconds,
+            "run_duration": run_duration,
+            "utilization": utilization,
+            "requests_per_second": requests_per_second,
+        },
+        "results": json.loads(output.decode("utf-8").splitlines()[-1]),
+    }
+
+
+def load_results(path):
+    """Return the list of benchmark records stored at path."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def save_result(path, record):
+    """Append a benchmark record to the results stored at path."""
+    with open(path, "a") as results_file:
+        results_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def get_previous_record(records, record):
+    """Return the latest record of the same scenario and options from a
+    different version, or the latest one if every record is from the
+    same version.
+    """
+    candidates = [
+        previous
+        for previous in records
+        if previous["scenario"] == record["scenario"]
+        and previous["options"] == record["options"]
+    ]
+    other_versions = [
+        previous for previous in candidates if previous["version"] != record["version"]
+    ]
+    if other_versions:
+        return other_versions[-1]
+    if candidates:
+        return candidates[-1]
+    return None
+
+
+def compare_results(previous, current, threshold=REGRESSION_THRESHOLD):
+    """Return a list of (name, previous value, current value, relative
+    change, regression) tuples for the COMPARED_RESULTS of two results
+    dicts. A result regressed if it increased by more than threshold.
+    """
+    comparison = []
+    for name in COMPARED_RESULTS:
+        previous_value = previous.get(name)
+        current_value = current.get(name)
+        if previous_value is None or current_value is None:
+            continue
+        if previous_value:
+            change = (current_value - previous_value) / previous_value
+        else:
+            change = 0.0 if not current_value else float("inf")
+        comparison.append(
+            (name, previous_value, current_value, change, change > threshold)
+        )
+    return comparison
+
+
+def format_record(record, previous=None, threshold=REGRESSION_THRESHOLD):
+    """Return a benchmark record, compared with the previous record if
+    given, as a list of lines suitable for logging.
+    """
+    lines = [
+        "scenario {} (projects x devices x active runs) version {}".format(
+            record["scenario"], record["version"]
+        )
+    ]
+    comparison = {}
+    if previous is not None:
+        lines[0] += " compared with {}".format(previous["version"])
+        comparison = {
+            name: (previous_value, change, regression)
+            for name, previous_value, _value, change, regression in compare_results(
+                previous["results"], record["results"], threshold
+            )
+        }
+    for name, value in sorted(record["results"].items()):
+        line = "  {:24s} {:>14}".format(name, format_value(value))
+        if name in comparison:
+            previous_value, change, regression = comparison[name]
+            line += " {:>14} {:+8.1%}{}".format(
+                format_value(previous_value),
+                change,
+                " REGRESSION" if regression else "",
+            )
+        lines.append(line)
+    return lines
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "{:.6g}".format(value)
+    return str(value)
+
+
+def main():
+    logger.setLevel(logging.ERROR)
+    options = json.loads(sys.argv[1])
+    results = measure(options)
+    sys.stdout.write(json.dumps(results) + "\n")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
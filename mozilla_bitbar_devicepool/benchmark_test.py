@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool import benchmark
+
+
+def test_parse_scenario():
+    scenario = benchmark.parse_scenario("50x10x200")
+    assert scenario == {"projects": 50, "devices": 10, "active_runs": 200}
+    assert benchmark.format_scenario(scenario) == "50x10x200"
+    with pytest.raises(ValueError):
+        benchmark.parse_scenario("50x10")
+
+
+def test_make_config():
+    config = benchmark.make_config(4, 3)
+    projects_config = config["projects"]
+    assert len(projects_config) == 5
+    device_models = set()
+    for project_name, project_config in projects_config.items():
+        if project_name == "defaults":
+            continue
+        device_models.add(project_config["device_model"])
+        devices = config["device_groups"][project_config["device_group_name"]]
+        assert len(devices) == 3
+    assert device_models == {"model0", "model1"}
+
+
+def test_compare_results(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    old = {
+        "version": "v1",
+        "scenario": "1x1x1",
+        "options": {"cycles": 1},
+        "results": {"configure_seconds": 1.0, "active_runs_calls": 1},
+    }
+    new = dict(
+        old, version="v2", results={"configure_seconds": 1.5, "active_runs_calls": 1}
+    )
+    benchmark.save_result(path, old)
+    benchmark.save_result(path, new)
+    records = benchmark.load_results(path)
+    assert records == [old, new]
+
+    current = dict(new, results={"configure_seconds": 1.1, "active_runs_calls": 2})
+    # compared with the latest record of another version.
+    previous = benchmark.get_previous_record(records, current)
+    assert previous == old
+    assert benchmark.get_previous_record(records, dict(current, options={})) is None
+
+    comparison = benchmark.compare_results(previous["results"], current["results"])
+    assert [
+        (name, regression) for name, _old, _new, _change, regression in comparison
+    ] == [
+        ("configure_seconds", False),
+        ("active_runs_calls", True),
+    ]
@@ -3,9 +3,30 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from mozilla_bitbar_devicepool import TESTDROID
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed, timed_items
 from mozilla_bitbar_devicepool.util.template import get_filter
 
 
+@timed_items("GET me/device-groups")
+def iter_device_groups(page_size=PAGE_SIZE, prefetch=False, **kwargs):
+    """Yield the matching Bitbar device groups belonging to the current
+    user as they are read, see get_device_groups.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {"displayname": str, "id": int, "ostype": str}
+
+    filter = get_filter(fields, **kwargs)
+    return iter_list(
+        "api/v2/me/device-groups",
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
 def get_device_groups(**kwargs):
     """Return list of matching Bitbar device_groups belonging to current user.
 
@@ -23,15 +44,10 @@ def get_device_groups(**kwargs):
        get_device_groups() # Return all device groups
        get_device_groups(displayname='pixel2-perf') # Return pixel2-perf device group.
     """
-    fields = {"displayname": str, "id": int, "ostype": str}
-
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get(
-        "api/v2/me/device-groups", payload={"limit": 0, "filter": filter}
-    )
-    return response["data"]
+    return list(iter_device_groups(**kwargs))
 
 
+@timed("GET device-groups/{id}")
 def get_device_group(id):
     """Return Bitbar device group with specified id.
 
@@ -46,6 +62,32 @@ def get_device_group(id):
     return response["data"]
 
 
+@timed_items("GET device-groups/{id}/devices")
+def iter_device_group_devices(id, page_size=PAGE_SIZE, prefetch=False, **kwargs):
+    """Yield the matching Bitbar devices of the device group with the
+    specified id as they are read, see get_device_group_devices.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {
+        "displayname": str,
+        "enabled": bool,
+        "id": int,
+        "locked": bool,
+        "online": bool,
+        "ostype": str,
+    }
+
+    filter = get_filter(fields, **kwargs)
+    return iter_list(
+        "api/v2/device-groups/{}/devices".format(id),
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
 def get_device_group_devices(id, **kwargs):
     """Return list of matching Bitbar devices for device group with specified id.
 
@@ -68,23 +110,10 @@ def get_device_group_devices(id, **kwargs):
        get_device_group_devices(27) # Return devices for device group with id 27
        get_device_group_devices(27, displayname='pixel2-27') # Return devices for device group with id 27 and displayname pixel2-27.
     """
-    fields = {
-        "displayname": str,
-        "enabled": bool,
-        "id": int,
-        "locked": bool,
-        "online": bool,
-        "ostype": str,
-    }
-
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get(
-        "api/v2/device-groups/{}/devices".format(id),
-        payload={"limit": 0, "filter": filter},
-    )
-    return response["data"]
+    return list(iter_device_group_devices(id, **kwargs))
 
 
+@timed("POST users/{id}/device-groups")
 def create_device_group(displayname, ostype="ANDROID"):
     """Create a device group for the current user.
 
@@ -108,6 +137,7 @@ def create_device_group(displayname, ostype="ANDROID"):
     return response
 
 
+@timed("POST device-groups/{id}/devices")
 def add_devices_to_device_group(id, deviceids):
     """Add devices to a device group.
 
@@ -127,6 +157,7 @@ def add_devices_to_device_group(id, deviceids):
     return response
 
 
+@timed("DELETE device-groups/{id}/devices/{id}")
 def delete_device_from_device_group(id, deviceid):
     """Delete a device from a device group.
 
@@ -139,6 +170,7 @@ def delete_device_from_device_group(id, deviceid):
     TESTDROID.delete(path="device-groups/{}/devices/{}".format(id, deviceid))
 
 
+@timed("DELETE device-groups/{id}")
 def delete_device_group(id):
     """Delete a device group.
 
@@ -4,9 +4,36 @@
 
 
 from mozilla_bitbar_devicepool import TESTDROID
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed, timed_items
 from mozilla_bitbar_devicepool.util.template import get_filter
 
 
+@timed_items("GET devices")
+def iter_devices(page_size=PAGE_SIZE, prefetch=False, **kwargs):
+    """Yield the matching Bitbar devices as they are read, see get_devices.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {
+        "displayname": str,
+        "enabled": bool,
+        "id": int,
+        "locked": bool,
+        "online": bool,
+        "ostype": str,
+    }
+
+    filter = get_filter(fields, **kwargs)
+    return iter_list(
+        "api/v2/devices",
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
 def get_devices(**kwargs):
     """Return list of matching Bitbar devices.
 
@@ -27,20 +54,10 @@ def get_devices(**kwargs):
        get_devices() # Return all devices
        get_devices(displayname='pixel2-25') # Return pixel2-25
     """
-    fields = {
-        "displayname": str,
-        "enabled": bool,
-        "id": int,
-        "locked": bool,
-        "online": bool,
-        "ostype": str,
-    }
-
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get("api/v2/devices", payload={"limit": 0, "filter": filter})
-    return response["data"]
+    return list(iter_devices(**kwargs))
 
 
+@timed("GET devices/{id}")
 def get_device(id):
     """Return Bitbar device with specified id.
 
@@ -55,20 +72,37 @@ def get_device(id):
     return response
 
 
-def get_device_problems(device_model=None):
-    """Return list of matching Bitbar devices with device problems.
+@timed_items("GET admin/device-problems")
+def iter_device_problems(device_model=None, page_size=PAGE_SIZE, prefetch=False):
+    """Yield the matching Bitbar devices with device problems as they are
+    read.
 
     :param device_model: string prefix of device names to match.
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
     """
 
     path = "admin/device-problems"
-    payload = {"limit": 0}
-    data = TESTDROID.get(path=path, payload=payload)["data"]
+    filter = []
     if device_model:
-        data = [d for d in data if d["deviceName"].startswith(device_model)]
-    else:
-        data = [d for d in data if d["deviceName"] != "Docker Builder"]
-    return data
+        # like matches anywhere in the name, the prefix is checked below.
+        filter = get_filter({"devicename": str}, devicename__like=device_model)
+    for d in iter_list(
+        path, payload={"filter": filter}, page_size=page_size, prefetch=prefetch
+    ):
+        if device_model:
+            if d["deviceName"].startswith(device_model):
+                yield d
+        elif d["deviceName"] != "Docker Builder":
+            yield d
+
+
+def get_device_problems(device_model=None):
+    """Return list of matching Bitbar devices with device problems.
+
+    :param device_model: string prefix of device names to match.
+    """
+    return list(iter_device_problems(device_model=device_model))
 
 
 def get_offline_devices(device_model=None):
@@ -80,3 +114,77 @@ def get_offline_devices(device_model=None):
             if problem["type"] == "OFFLINE":
                 offline_devices.append(device_problem["deviceModelName"])
     return offline_devices
+
+
+def get_offline_devices_index(device_groups_config, device_models=()):
+    """Return an index of the offline devices built from a single
+    device-problems request.
+
+    :param device_groups_config: dict mapping device group names to
+                                 the configured device names in the group.
+    :param device_models: iterable of string device name prefixes to
+                          index.
+
+    Returns a dict containing
+    {
+      'by_model': {device_model: [device_name, ...]},
+      'by_device_group': {device_group_name: [device_name, ...]},
+    }
+
+    by_model lists the offline devices whose deviceName starts with the
+    device model, as get_offline_devices(device_model) does, and
+    by_device_group the offline devices configured in each device group
+    regardless of their model. See get_project_offline_devices.
+
+    Examples:
+       index = get_offline_devices_index(CONFIG['device_groups'], ['pixel2'])
+       index['by_device_group']['pixel2-unit-2']
+    """
+    # deviceModelName -> deviceName
+    offline_devices = {}
+    for device_problem in get_device_problems():
+        for problem in device_problem["problems"]:
+            if problem["type"] == "OFFLINE":
+                offline_devices[device_problem["deviceModelName"]] = device_problem[
+                    "deviceName"
+                ]
+
+    by_model = {}
+    for device_model in device_models:
+        by_model[device_model] = sorted(
+            [
+                name
+                for name, device_name in offline_devices.items()
+                if device_name.startswith(device_model)
+            ]
+        )
+
+    by_device_group = {}
+    for device_group_name, device_group in device_groups_config.items():
+        device_group = device_group or {}
+        by_device_group[device_group_name] = sorted(
+            [name for name in offline_devices if name in device_group]
+        )
+
+    return {"by_model": by_model, "by_device_group": by_device_group}
+
+
+def get_project_offline_devices(
+    offline_devices_index, device_group_name, device_group, device_model=None
+):
+    """Return the sorted list of offline devices of a project's device
+    group, limited to its device model if it has one.
+
+    :param offline_devices_index: dict returned by get_offline_devices_index.
+    :param device_group_name: string name of the project's device group.
+    :param device_group: dict of the configured device names in the group.
+    :param device_model: optional string prefix of the project's devices.
+    """
+    if not device_model:
+        return offline_devices_index["by_device_group"].get(device_group_name, [])
+    device_group = device_group or {}
+    return [
+        name
+        for name in offline_devices_index["by_model"].get(device_model, [])
+        if name in device_group
+    ]
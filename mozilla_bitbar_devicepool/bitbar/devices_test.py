@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozilla_bitbar_devicepool.bitbar import devices
+
+device_problems = [
+    {
+        "deviceName": "pixel2-01",
+        "deviceModelName": "pixel2-01",
+        "problems": [{"type": "OFFLINE"}],
+    },
+    {
+        "deviceName": "pixel2-02",
+        "deviceModelName": "pixel2-02",
+        "problems": [{"type": "CLEANUP"}],
+    },
+    {
+        "deviceName": "motog5-18",
+        "deviceModelName": "motog5-18",
+        "problems": [{"type": "OFFLINE"}],
+    },
+    # configured in a pixel2 group but not a pixel2 device.
+    {
+        "deviceName": "s7-03",
+        "deviceModelName": "pixel2-03",
+        "problems": [{"type": "OFFLINE"}],
+    },
+]
+
+device_groups_config = {
+    "pixel2-unit-2": {"pixel2-01": None, "pixel2-02": None, "pixel2-03": None},
+    "motog5-perf-2": {"motog5-18": None},
+    "test-3": None,
+}
+
+
+def test_offline_devices_index(monkeypatch):
+    calls = []
+
+    def fake_get_device_problems(device_model=None):
+        calls.append(device_model)
+        return device_problems
+
+    monkeypatch.setattr(devices, "get_device_problems", fake_get_device_problems)
+    index = devices.get_offline_devices_index(
+        device_groups_config, ["pixel2", "motog5", "s7"]
+    )
+    assert calls == [None]
+    assert index["by_model"] == {
+        "pixel2": ["pixel2-01"],
+        "motog5": ["motog5-18"],
+        "s7": ["pixel2-03"],
+    }
+    assert index["by_device_group"] == {
+        "pixel2-unit-2": ["pixel2-01", "pixel2-03"],
+        "motog5-perf-2": ["motog5-18"],
+        "test-3": [],
+    }
+
+    # projects with a device model only count the offline devices whose
+    # deviceName matches it, as get_offline_devices(device_model) does.
+    group = device_groups_config["pixel2-unit-2"]
+    assert devices.get_project_offline_devices(
+        index, "pixel2-unit-2", group, "pixel2"
+    ) == ["pixel2-01"]
+    assert devices.get_project_offline_devices(index, "pixel2-unit-2", group) == [
+        "pixel2-01",
+        "pixel2-03",
+    ]
+    assert devices.get_project_offline_devices(index, "test-3", None, "s7") == []
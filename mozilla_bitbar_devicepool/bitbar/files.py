@@ -2,10 +2,40 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from mozilla_bitbar_devicepool import TESTDROID
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed_items
 from mozilla_bitbar_devicepool.util.template import get_filter
 
 
+@timed_items("GET files")
+def iter_files(page_size=PAGE_SIZE, prefetch=False, newest_first=False, **kwargs):
+    """Yield the matching Bitbar files as they are read, see get_files.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    :param newest_first: if True, yield the files sorted by createTime
+                         descending rather than ascending.
+    """
+    fields = {
+        "createtime": int,
+        "direction": str,
+        "id": int,
+        "mimetype": str,
+        "name": str,
+        "size": int,
+        "state": str,
+    }
+
+    filter = get_filter(fields, **kwargs)
+    sort = "createTime_d" if newest_first else "createTime_a"
+    return iter_list(
+        "api/v2/files",
+        payload={"filter": filter, "sort": sort},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
 def get_files(**kwargs):
     """Return list of matching Bitbar files.
 
@@ -20,18 +50,16 @@ def get_files(**kwargs):
 
     https://mozilla.testdroid.com/cloud/swagger-ui.html#/File/getFilesUsingGET
     """
-    fields = {
-        "createtime": int,
-        "direction": str,
-        "id": int,
-        "mimetype": str,
-        "name": str,
-        "size": int,
-        "state": str,
-    }
+    return list(iter_files(**kwargs))
 
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get(
-        "api/v2/files", payload={"limit": 0, "filter": filter, "sort": "createTime_a"}
-    )
-    return response["data"]
+
+def get_latest_file(name):
+    """Return the most recently created Bitbar file with the name, or
+    None if there is none. Only the newest file is requested.
+
+    Examples:
+       get_latest_file('ignore.apk')
+    """
+    for bitbar_file in iter_files(page_size=1, newest_first=True, name=name):
+        return bitbar_file
+    return None
@@ -2,10 +2,37 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from mozilla_bitbar_devicepool import TESTDROID
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed_items
 from mozilla_bitbar_devicepool.util.template import get_filter
 
 
+@timed_items("GET admin/frameworks")
+def iter_frameworks(page_size=PAGE_SIZE, prefetch=False, **kwargs):
+    """Yield the matching Bitbar frameworks as they are read, see
+    get_frameworks.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {
+        "id": int,
+        "jobconfigid": int,
+        "labelname": str,
+        "name": str,
+        "ostype": str,
+        "type": str,
+    }
+
+    filter = get_filter(fields, **kwargs)
+    return iter_list(
+        "api/v2/admin/frameworks",
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
 def get_frameworks(**kwargs):
     """Return list of matching Bitbar frameworks.
 
@@ -26,17 +53,4 @@ def get_frameworks(**kwargs):
        get_frameworks() # Return all frameworks
        get_devices(displayname='pixel2-25') # Return pixel2-25
     """
-    fields = {
-        "id": int,
-        "jobconfigid": int,
-        "labelname": str,
-        "name": str,
-        "ostype": str,
-        "type": str,
-    }
-
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get(
-        "api/v2/admin/frameworks", payload={"limit": 0, "filter": filter}
-    )
-    return response["data"]
+    return list(iter_frameworks(**kwargs))
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mozilla_bitbar_devicepool import TESTDROID
+
+# default number of items requested per page by the iter_ wrappers. None
+# requests all of the items in a single streamed response.
+PAGE_SIZE = None
+# threads shared by the iterators which prefetch their next page.
+PREFETCH_MAX_WORKERS = 4
+
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    global _prefetch_executor
+
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix="prefetch"
+            )
+        return _prefetch_executor
+
+
+def get_page(path, payload, offset, limit):
+    """Return the list of items of a page of a Bitbar list endpoint."""
+    payload = dict(payload, offset=offset, limit=limit)
+    return TESTDROID.get(path, payload=payload)["data"]
+
+
+def iter_list(path, payload=None, page_size=PAGE_SIZE, prefetch=False):
+    """Yield the items of a Bitbar list endpoint.
+
+    :param path: API path, e.g. 'api/v2/devices'.
+    :param payload: dict of query parameters such as filter and sort.
+    :param page_size: number of items to request at a time. If None or
+                      0, all of the items are requested at once and
+                      decoded as they are streamed, see get_items.
+    :param prefetch: if True, the next page is requested in the
+                     background while the caller processes the current
+                     page.
+
+    Pages are requested by offset, so items created or deleted while
+    iterating may be skipped or returned twice unless the payload sorts
+    them by a field which does not change, such as createTime. Callers
+    may stop iterating early, in which case the remaining pages are not
+    requested.
+
+    Examples:
+       for device in iter_list('api/v2/devices', page_size=100):
+           ...
+    """
+    payload = dict(payload or {})
+    if not page_size:
+        payload["limit"] = 0
+        for item in TESTDROID.get_items(path, payload=payload):
+            yield item
+        return
+
+    offset = 0
+    page = get_page(path, payload, offset, page_size)
+    next_page = None
+    try:
+        while True:
+            if prefetch and len(page) == page_size:
+                next_page = get_prefetch_executor().submit(
+                    get_page, path, payload, offset + page_size, page_size
+                )
+            for item in page:
+                yield item
+            # a short page is the last one.
+            if len(page) < page_size:
+                return
+            offset += page_size
+            if next_page is not None:
+                page = next_page.result()
+                next_page = None
+            else:
+                page = get_page(path, payload, offset, page_size)
+    finally:
+        if next_page is not None:
+            next_page.cancel()
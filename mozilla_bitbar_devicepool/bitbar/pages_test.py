@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool.bitbar import files, pages, projects
+
+
+class FakeTestdroid(object):
+    def __init__(self, items):
+        self.items = items
+        self.requests = []
+
+    def get(self, path, payload=None):
+        self.requests.append((payload["offset"], payload["limit"]))
+        offset = payload["offset"]
+        return {"data": self.items[offset : offset + payload["limit"]]}
+
+    def get_items(self, path, payload=None):
+        self.requests.append((0, payload["limit"]))
+        return iter(self.items)
+
+
+@pytest.fixture
+def testdroid(monkeypatch):
+    testdroid = FakeTestdroid([{"id": id} for id in range(5)])
+    monkeypatch.setattr(pages, "TESTDROID", testdroid)
+    return testdroid
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_iter_list_pages(testdroid, prefetch):
+    items = pages.iter_list(
+        "api/v2/devices", payload={"filter": []}, page_size=2, prefetch=prefetch
+    )
+    assert [item["id"] for item in items] == [0, 1, 2, 3, 4]
+    assert testdroid.requests == [(0, 2), (2, 2), (4, 2)]
+
+
+def test_iter_list_stops_early(testdroid):
+    items = pages.iter_list("api/v2/devices", page_size=2)
+    assert [next(items), next(items)] == [{"id": 0}, {"id": 1}]
+    items.close()
+    # the second page was not requested.
+    assert testdroid.requests == [(0, 2)]
+
+
+def test_iter_list_streamed(testdroid):
+    assert len(list(pages.iter_list("api/v2/devices"))) == 5
+    assert testdroid.requests == [(0, 0)]
+
+
+def test_get_latest_file(monkeypatch):
+    requests = []
+
+    def fake_iter_list(path, payload=None, page_size=None, prefetch=False):
+        requests.append((payload, page_size))
+        return iter([{"id": 2, "name": "test.zip"}, {"id": 1, "name": "test.zip"}])
+
+    monkeypatch.setattr(files, "iter_list", fake_iter_list)
+    assert files.get_latest_file("test.zip")["id"] == 2
+    assert requests == [({"filter": ["s_name_eq_test.zip"], "sort": "createTime_d"}, 1)]
+
+
+def test_iter_projects_skips_archived(monkeypatch):
+    requests = []
+
+    def fake_iter_list(path, payload=None, page_size=None, prefetch=False):
+        requests.append(payload)
+        # as if the server ignored the archivetime filter.
+        return iter(
+            [
+                {"id": 1, "name": "test", "archiveTime": 1000},
+                {"id": 2, "name": "test", "archiveTime": None},
+            ]
+        )
+
+    monkeypatch.setattr(projects, "iter_list", fake_iter_list)
+    assert [project["id"] for project in projects.iter_projects(name="test")] == [2]
+    assert requests == [{"filter": ["d_archivetime_isnull", "s_name_eq_test"]}]
@@ -3,9 +3,41 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from mozilla_bitbar_devicepool import TESTDROID
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed, timed_items
 from mozilla_bitbar_devicepool.util.template import get_filter
 
 
+@timed_items("GET projects")
+def iter_projects(page_size=PAGE_SIZE, prefetch=False, **kwargs):
+    """Yield the matching Bitbar projects which have not been archived as
+    they are read, see get_projects.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {
+        "archivetime": int,
+        "frameworkid": int,
+        "id": int,
+        "name": str,
+        "ostype": str,
+    }
+
+    # skip the archived projects
+    filter = get_filter(fields, archivetime__isnull=True, **kwargs)
+    for project in iter_list(
+        "api/v2/projects",
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    ):
+        # in case the server did not apply the filter, archived duplicates
+        # would be reported as a DuplicateProjectException.
+        if project["archiveTime"] is None:
+            yield project
+
+
 def get_projects(**kwargs):
     """Return list of matching Bitbar projects.
 
@@ -24,22 +56,10 @@ def get_projects(**kwargs):
        get_projects() # Return all projects
        get_projects(name='mozilla-unittests-p2')
     """
-    fields = {
-        "frameworkid": int,
-        "id": int,
-        "name": str,
-        "ostype": str,
-    }
-
-    filter = get_filter(fields, **kwargs)
-    response = TESTDROID.get("api/v2/projects", payload={"limit": 0, "filter": filter})
-    # remove the archived projects
-    projects = [
-        project for project in response["data"] if project["archiveTime"] is None
-    ]
-    return projects
+    return list(iter_projects(**kwargs))
 
 
+@timed("GET projects/{id}")
 def get_project(id):
     """Return Bitbar project with specified id.
 
@@ -54,6 +74,7 @@ def get_project(id):
     return response
 
 
+@timed("POST users/{id}/projects")
 def create_project(name, project_type="GENERIC"):
     """Create a project.
 
@@ -79,6 +100,7 @@ def create_project(name, project_type="GENERIC"):
     return response
 
 
+@timed("POST users/{id}/projects/{id}")
 def update_project(
     id, name, archiving_item_count=365, archiving_strategy="DAYS", description=None
 ):
@@ -113,6 +135,7 @@ def update_project(
     return response
 
 
+@timed("GET users/{id}/projects/{id}/config/parameters")
 def get_project_test_run_config_parameters(id):
     """Get Project test run config parameters.
 
@@ -138,6 +161,7 @@ def get_project_test_run_config_parameters(id):
     return response["data"]
 
 
+@timed("POST users/{id}/projects/{id}/config/parameters")
 def add_project_test_run_config_parameter(id, key, value):
     """Add Project test run config parameter.
 
@@ -161,6 +185,7 @@ def add_project_test_run_config_parameter(id, key, value):
     return response
 
 
+@timed("DELETE users/{id}/projects/{id}/config/parameters/{id}")
 def delete_project_test_run_config_parameter(id, parameter_id):
     """Delete Project test run config parameter.
 
@@ -0,0 +1,415 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import threading
+import time
+
+import requests
+from testdroid import RequestResponseError, Testdroid
+
+from mozilla_bitbar_devicepool import logger
+from mozilla_bitbar_devicepool.util.json_stream import iter_items
+
+# process wide limit on the rate of Testdroid API requests and the number
+# of requests which may be made in a burst.
+REQUESTS_PER_SECOND = 10
+BURST = 20
+
+# attempts made for idempotent requests which fail to connect, time out
+# or receive a server error, with a randomized exponential backoff
+# starting at RETRY_BACKOFF seconds between attempts.
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1
+MAX_BACKOFF = 60
+
+# consecutive failures after which an endpoint class's circuit breaker
+# opens, and the seconds before a trial request is allowed through. The
+# timeout doubles up to MAX_RESET_TIMEOUT each time the trial fails.
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+MAX_RESET_TIMEOUT = 300
+
+ENDPOINT_CLASSES = ("admin", "runs", "devices", "default")
+
+# bytes read at a time from streamed responses, see get_items.
+STREAM_CHUNK_SIZE = 65536
+# seconds to wait for the connection and between bytes of streamed
+# responses.
+STREAM_TIMEOUT = (10, 60)
+
+
+class CircuitOpenException(requests.exceptions.ConnectionError):
+    """Raised instead of making a request while the circuit breaker for
+    its endpoint class is open. It is a ConnectionError so that callers
+    already handling Bitbar outages handle it the same way.
+    """
+
+    pass
+
+
+class StreamReadException(requests.exceptions.ConnectionError):
+    """Raised when reading a streamed response body fails part way. It is
+    a ConnectionError for the same reason as CircuitOpenException.
+    """
+
+    pass
+
+
+def get_endpoint_class(path):
+    """Return the endpoint class of a Testdroid API path.
+
+    Examples:
+       get_endpoint_class('api/v2/admin/runs') # 'admin'
+       get_endpoint_class('runs') # 'runs'
+       get_endpoint_class('device-groups/1/devices') # 'devices'
+    """
+    if "v2/" in path:
+        path = path.split("v2/", 1)[1]
+    path = path.lstrip("/")
+    if path.startswith("admin/"):
+        return "admin"
+    segments = path.split("?")[0].split("/")
+    if "runs" in segments:
+        return "runs"
+    if any(segment.startswith("device") for segment in segments):
+        return "devices"
+    return "default"
+
+
+def is_server_error(e):
+    return e.status_code == 429 or e.status_code >= 500
+
+
+def get_backoff_delay(attempt):
+    """Return a randomized delay in seconds before retry number attempt."""
+    delay = min(MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, waiting until one is available."""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def get_tokens(self):
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint class after FAILURE_THRESHOLD
+    consecutive failures.
+
+    While OPEN, requests raise CircuitOpenException until the reset
+    timeout has passed. A single trial request is then let through
+    (HALF_OPEN): if it succeeds the breaker closes, otherwise it opens
+    again with a doubled timeout.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=FAILURE_THRESHOLD,
+        reset_timeout=RESET_TIMEOUT,
+        max_reset_timeout=MAX_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "CLOSED"
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.state == "CLOSED":
+                return
+            if self.state == "OPEN" and time.time() >= self.retry_at:
+                logger.info("circuit breaker {}: trying a request".format(self.name))
+                self.state = "HALF_OPEN"
+                return
+            raise CircuitOpenException(
+                "circuit breaker for {} requests is open, retry in {:.0f} seconds".format(
+                    self.name, max(0, self.retry_at - time.time())
+                )
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "CLOSED":
+                logger.info("circuit breaker {}: closed".format(self.name))
+            self.state = "CLOSED"
+            self.failures = 0
+            self.timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "HALF_OPEN":
+                self.timeout = min(self.max_reset_timeout, self.timeout * 2)
+            elif self.state == "OPEN" or self.failures < self.failure_threshold:
+                return
+            self.state = "OPEN"
+            self.retry_at = time.time() + self.timeout
+            logger.warning(
+                "circuit breaker {}: open for {} seconds after {} failures".format(
+                    self.name, self.timeout, self.failures
+                )
+            )
+
+    def get_delay(self):
+        """Return the seconds until a request may be made, 0 if closed."""
+        with self.lock:
+            if self.state == "CLOSED":
+                return 0
+            return max(0, self.retry_at - time.time())
+
+    def get_state(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "retry_at": self.retry_at if self.state != "CLOSED" else None,
+            }
+
+
+class RateLimiter(object):
+    """Process wide token bucket plus a circuit breaker per endpoint class
+    through which all Testdroid requests are made.
+    """
+
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND, burst=BURST):
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.breakers = {name: CircuitBreaker(name) for name in ENDPOINT_CLASSES}
+
+    def call(self, endpoint_class, func, *args, retry=True, **kwargs):
+        """Return func(*args, **kwargs) once a token is available.
+
+        :param endpoint_class: one of ENDPOINT_CLASSES.
+        :param retry: if True, connection errors, timeouts and server
+                      errors are retried up to MAX_ATTEMPTS times.
+                      Requests which are not idempotent such as starting
+                      a test run must not be retried.
+
+        Raises CircuitOpenException if the endpoint class's circuit
+        breaker is open.
+        """
+        breaker = self.breakers[endpoint_class]
+        attempts = MAX_ATTEMPTS if retry else 1
+        for attempt in range(attempts):
+            breaker.before_request()
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                breaker.record_failure()
+                error = e
+            except RequestResponseError as e:
+                if not is_server_error(e):
+                    # the server is responding, the request itself is bad.
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                error = e
+            except Exception:
+                # e.g. a truncated body which is not valid json. An
+                # outcome must be recorded or a HALF_OPEN breaker would
+                # never close or reopen.
+                breaker.record_failure()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+            # give up early if this failure opened the circuit breaker.
+            if attempt == attempts - 1 or breaker.get_delay():
+                raise error
+            delay = get_backoff_delay(attempt)
+            logger.warning(
+                "{} request failed ({}: {}), retrying in {:.1f} seconds".format(
+                    endpoint_class, error.__class__.__name__, error, delay
+                )
+            )
+            time.sleep(delay)
+
+    def get_backoff(self, endpoint_class):
+        """Return the seconds a scheduler should wait after a failed call
+        to the endpoint class: until the circuit breaker allows a trial
+        request if it is open, otherwise a randomized exponential backoff
+        based on the consecutive failures.
+        """
+        breaker = self.breakers[endpoint_class]
+        delay = breaker.get_delay()
+        if delay:
+            return delay
+        return get_backoff_delay(breaker.failures)
+
+    def get_state(self):
+        return {
+            "tokens": self.bucket.get_tokens(),
+            "breakers": {
+                name: breaker.get_state() for name, breaker in self.breakers.items()
+            },
+        }
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def configure_rate_limiter(requests_per_second=REQUESTS_PER_SECOND, burst=BURST):
+    """Replace the process wide token bucket."""
+    RATE_LIMITER.bucket = TokenBucket(requests_per_second, burst)
+
+
+def is_available(endpoint_class):
+    """Return False while the endpoint class's circuit breaker is open."""
+    return RATE_LIMITER.breakers[endpoint_class].get_delay() == 0
+
+
+def get_backoff(endpoint_class):
+    return RATE_LIMITER.get_backoff(endpoint_class)
+
+
+def get_state():
+    """Return the token bucket and circuit breaker state, e.g.
+    {
+      'tokens': 19.5,
+      'breakers': {
+        'runs': {'state': 'CLOSED', 'failures': 0, 'retry_at': None},
+        ...
+      },
+    }
+    """
+    return RATE_LIMITER.get_state()
+
+
+class RateLimitedTestdroid(Testdroid):
+    """Testdroid client which makes its requests through RATE_LIMITER.
+
+    The higher level Testdroid methods such as get_me and upload_file
+    are implemented with get, post, delete and upload and so are limited
+    as well.
+    """
+
+    def get(self, path, payload=None, headers=None):
+        return RATE_LIMITER.call(
+            get_endpoint_class(path),
+            super().get,
+            path,
+            payload=payload,
+            headers=headers,
+        )
+
+    def post(self, path=None, payload=None, headers=None):
+        return RATE_LIMITER.call(
+            get_endpoint_class(path),
+            super().post,
+            path=path,
+            payload=payload,
+            headers=headers,
+            retry=False,
+        )
+
+    def delete(self, path=None, headers=None):
+        return RATE_LIMITER.call(
+            get_endpoint_class(path), super().delete, path=path, headers=headers
+        )
+
+    def upload(self, path=None, filename=None):
+        return RATE_LIMITER.call(
+            get_endpoint_class(path),
+            super().upload,
+            path=path,
+            filename=filename,
+            retry=False,
+        )
+
+    def get_auth(self):
+        """Return the requests auth and headers which authenticate a
+        request the same way as Testdroid's own requests.
+        """
+        headers = {"Accept": "application/json"}
+        if self.api_key:
+            return (self.api_key, ""), headers
+        headers["Authorization"] = "Bearer {}".format(self.get_token())
+        return None, headers
+
+    def get_stream(self, path, payload=None, headers=None):
+        """Return the streamed requests.Response of a GET from an API
+        resource, raising RequestResponseError for failed requests as
+        get does.
+        """
+        if payload is None:
+            payload = {}
+        if "v2/" in path:
+            path = path.split("v2/", 1)[1]
+        url = "{}/api/v2/{}".format(self.cloud_url, path)
+        auth, request_headers = self.get_auth()
+        request_headers.update(headers or {})
+        response = requests.get(
+            url,
+            params=payload,
+            headers=request_headers,
+            auth=auth,
+            stream=True,
+            timeout=STREAM_TIMEOUT,
+        )
+        if response.status_code not in range(200, 300):
+            raise RequestResponseError(response.text, response.status_code)
+        return response
+
+    def get_items(self, path, payload=None, headers=None):
+        """Yield the items of the data list of a GET response as they
+        are decoded from the streamed response body.
+
+        Only the request is rate limited and retried. Errors while
+        reading the body count as failures of the endpoint class's
+        circuit breaker and are raised to the caller, which may already
+        have processed some of the items, as StreamReadException.
+        """
+        endpoint_class = get_endpoint_class(path)
+        response = RATE_LIMITER.call(
+            endpoint_class,
+            self.get_stream,
+            path,
+            payload=payload,
+            headers=headers,
+        )
+        try:
+            for item in iter_items(response.iter_content(STREAM_CHUNK_SIZE)):
+                yield item
+        except requests.exceptions.RequestException as e:
+            RATE_LIMITER.breakers[endpoint_class].record_failure()
+            raise StreamReadException(
+                "reading {} failed ({}: {})".format(path, e.__class__.__name__, e)
+            ) from e
+        finally:
+            response.close()
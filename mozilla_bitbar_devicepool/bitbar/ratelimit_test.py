@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+import requests
+from testdroid import RequestResponseError
+
+from mozilla_bitbar_devicepool.bitbar import ratelimit
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ratelimit.time, "sleep", sleeps.append)
+    limiter = ratelimit.RateLimiter(requests_per_second=1000, burst=1000)
+    limiter.sleeps = sleeps
+    return limiter
+
+
+def test_get_endpoint_class():
+    assert ratelimit.get_endpoint_class("api/v2/admin/runs") == "admin"
+    assert ratelimit.get_endpoint_class("admin/device-problems") == "admin"
+    assert ratelimit.get_endpoint_class("runs") == "runs"
+    assert ratelimit.get_endpoint_class("users/1/projects/2/runs/3") == "runs"
+    assert ratelimit.get_endpoint_class("api/v2/devices/1") == "devices"
+    assert ratelimit.get_endpoint_class("device-groups/1/devices") == "devices"
+    assert ratelimit.get_endpoint_class("me") == "default"
+
+
+def test_retries_server_errors(limiter):
+    responses = [RequestResponseError("busy", 503), {"data": []}]
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert limiter.call("devices", request) == {"data": []}
+    assert len(limiter.sleeps) == 1
+    assert limiter.get_state()["breakers"]["devices"]["failures"] == 0
+
+
+def test_does_not_retry_client_errors_or_posts(limiter):
+    calls = []
+
+    def request(status_code):
+        calls.append(status_code)
+        raise RequestResponseError("error", status_code)
+
+    with pytest.raises(RequestResponseError):
+        limiter.call("runs", request, 404)
+    with pytest.raises(RequestResponseError):
+        limiter.call("runs", request, 500, retry=False)
+    assert calls == [404, 500]
+    assert limiter.sleeps == []
+
+
+def test_circuit_breaker(limiter, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+
+    def request():
+        raise requests.exceptions.ConnectionError("down")
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        limiter.call("admin", request)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        limiter.call("admin", request)
+    breaker_state = limiter.get_state()["breakers"]["admin"]
+    assert breaker_state["state"] == "OPEN"
+    assert limiter.get_backoff("admin") == ratelimit.RESET_TIMEOUT
+    # other endpoint classes are unaffected.
+    assert limiter.get_state()["breakers"]["runs"]["state"] == "CLOSED"
+
+    with pytest.raises(ratelimit.CircuitOpenException):
+        limiter.call("admin", lambda: "not called")
+
+    # a failed trial request reopens the breaker for longer.
+    now[0] += ratelimit.RESET_TIMEOUT
+    with pytest.raises(requests.exceptions.ConnectionError):
+        limiter.call("admin", request, retry=False)
+    assert limiter.get_backoff("admin") == ratelimit.RESET_TIMEOUT * 2
+
+    # a successful trial request closes it.
+    now[0] += ratelimit.RESET_TIMEOUT * 2
+    assert limiter.call("admin", lambda: "ok") == "ok"
+    assert limiter.get_state()["breakers"]["admin"] == {
+        "state": "CLOSED",
+        "failures": 0,
+        "retry_at": None,
+    }
+
+
+def test_get_items_stream_errors(limiter, monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMITER", limiter)
+    requests_made = []
+
+    class Response(object):
+        status_code = 200
+
+        def iter_content(self, chunk_size):
+            yield b'{"data": [{"id": 1}, '
+            raise requests.exceptions.ChunkedEncodingError("connection reset")
+
+        def close(self):
+            pass
+
+    def get(url, **kwargs):
+        requests_made.append((url, kwargs))
+        return Response()
+
+    monkeypatch.setattr(ratelimit.requests, "get", get)
+    testdroid = ratelimit.RateLimitedTestdroid(
+        apikey="key", url="https://bitbar.example.com"
+    )
+    items = []
+    with pytest.raises(requests.exceptions.ConnectionError):
+        for item in testdroid.get_items("api/v2/admin/runs"):
+            items.append(item)
+    assert items == [{"id": 1}]
+    assert limiter.get_state()["breakers"]["admin"]["failures"] == 1
+
+    url, kwargs = requests_made[0]
+    assert url == "https://bitbar.example.com/api/v2/admin/runs"
+    assert kwargs["auth"] == ("key", "")
+    assert kwargs["timeout"] == ratelimit.STREAM_TIMEOUT
+
+
+def test_circuit_breaker_half_open_other_errors(limiter, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    breaker = limiter.breakers["admin"]
+    breaker.state = "OPEN"
+    breaker.retry_at = now[0]
+
+    def request():
+        raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+    with pytest.raises(ValueError):
+        limiter.call("admin", request)
+    # the failed trial reopened the breaker rather than leaving it
+    # HALF_OPEN.
+    assert limiter.get_state()["breakers"]["admin"]["state"] == "OPEN"
+    assert limiter.get_backoff("admin") == ratelimit.RESET_TIMEOUT * 2
+
+    now[0] += ratelimit.RESET_TIMEOUT * 2
+    assert limiter.call("admin", lambda: "ok") == "ok"
+    assert limiter.get_state()["breakers"]["admin"]["state"] == "CLOSED"
@@ -8,6 +8,12 @@ from mozilla_bitbar_devicepool import (
     TESTDROID,
     configuration,
 )
+from mozilla_bitbar_devicepool.bitbar.pages import PAGE_SIZE, iter_list
+from mozilla_bitbar_devicepool.instrumentation import timed, timed_items
+from mozilla_bitbar_devicepool.util.template import get_filter
+
+# project name -> (configuration generation, serialized test configuration)
+TEST_RUN_PAYLOADS = {}
 
 
 def run_test_with_configuration(test_configuration):
@@ -17,15 +23,24 @@ def run_test_with_configuration(test_configuration):
        run_test_with_configuration(test_configuration)
     """
 
+    return run_test_with_payload(json.dumps(test_configuration))
+
+
+@timed("POST runs")
+def run_test_with_payload(payload):
+    """Run a test on demand with a test configuration already serialized
+    to json.
+    """
+
     response = TESTDROID.post(
         path="runs",
-        payload=json.dumps(test_configuration),
+        payload=payload,
         headers={"Content-type": "application/json", "Accept": "application/json"},
     )
     return response
 
 
-def run_test_for_project(project_name):
+def get_test_configuration(project_name):
     CACHE = configuration.BITBAR_CACHE
     CONFIG = configuration.CONFIG
 
@@ -66,25 +81,66 @@ def run_test_for_project(project_name):
             {"key": parameter_name, "value": parameter_value}
         )
 
-    return run_test_with_configuration(test_configuration)
+    return test_configuration
+
+
+def get_test_run_payload(project_name):
+    """Return the serialized test configuration for the project.
 
+    The payload is built once per configuration generation and reused
+    until the configuration is reloaded or a cached Bitbar project, file,
+    framework or device group is replaced.
+    """
+    # read the generation first so that a payload built while the
+    # configuration changes is rebuilt on the next call.
+    generation = configuration.CONFIG_GENERATION
+    cached_payload = TEST_RUN_PAYLOADS.get(project_name)
+    if cached_payload and cached_payload[0] == generation:
+        return cached_payload[1]
+    payload = json.dumps(get_test_configuration(project_name))
+    TEST_RUN_PAYLOADS[project_name] = (generation, payload)
+    return payload
+
+
+def run_test_for_project(project_name):
+    return run_test_with_payload(get_test_run_payload(project_name))
 
+
+@timed("GET users/{id}/projects/{id}/runs/{id}")
 def get_test_run(project_id, test_run_id):
     data = TESTDROID.get_test_run(project_id, test_run_id)
     return data
 
 
-def get_test_runs(project_id, active=None):
-    test_runs = TESTDROID.get_project_test_runs(project_id)["data"]
+@timed_items("GET users/{id}/projects/{id}/runs")
+def iter_test_runs(project_id, active=None, page_size=PAGE_SIZE, prefetch=False):
+    """Yield the project's active test runs if active, otherwise its
+    finished test runs.
+
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+    """
+    fields = {"state": str, "endtime": int}
     if active:
-        test_runs = [run for run in test_runs if run["state"] in ("WAITING", "RUNNING")]
+        filter = get_filter(fields, state__in=["WAITING", "RUNNING"])
     else:
-        test_runs = [
-            run for run in test_runs if run["state"] not in ("WAITING", "RUNNING")
-        ]
-    return test_runs
+        filter = get_filter(fields, endtime__isnull=False)
+    for run in iter_list(
+        "api/v2/me/projects/{}/runs".format(project_id),
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    ):
+        # in case the server did not apply the filter.
+        if (run["state"] in ("WAITING", "RUNNING")) == bool(active):
+            yield run
 
 
+def get_test_runs(project_id, active=None):
+    return list(iter_test_runs(project_id, active=active))
+
+
+@timed("DELETE users/{id}/projects/{id}/runs/{id}")
 def delete_test_run(project_id, test_run_id):
     me = TESTDROID.get_me()
     path = "users/%s/projects/%s/runs/%s" % (me["id"], project_id, test_run_id)
@@ -92,13 +148,65 @@ def delete_test_run(project_id, test_run_id):
     return data
 
 
+@timed("POST users/{id}/projects/{id}/runs/{id}/abort")
 def abort_test_run(project_id, test_run_id):
     return TESTDROID.abort_test_run(project_id, test_run_id)
 
 
 # https://mozilla.testdroid.com/cloud/api/v2/admin/runs?filter=d_endTime_isnull&limit=0
-def get_active_test_runs(**kwargs):
-    """Gets active test runs.
+@timed_items("GET admin/runs")
+def iter_active_test_runs(project_ids=None, page_size=PAGE_SIZE, prefetch=False):
+    """Yield the active test runs as they are read.
+
+    :param project_ids: optional list of integer project ids. If
+                        specified, only the active runs of these
+                        projects are returned.
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
     """
-    response = TESTDROID.get("api/v2/admin/runs?filter=d_endTime_isnull&limit=0")
-    return response["data"]
+    fields = {"endtime": int, "projectid": int}
+    if project_ids:
+        filter = get_filter(
+            fields, endtime__isnull=True, projectid__in=sorted(project_ids)
+        )
+    else:
+        filter = get_filter(fields, endtime__isnull=True)
+    return iter_list(
+        "api/v2/admin/runs",
+        payload={"filter": filter},
+        page_size=page_size,
+        prefetch=prefetch,
+    )
+
+
+# https://mozilla.testdroid.com/cloud/api/v2/admin/runs?filter=d_startTime_gt_1600000000000&limit=0
+@timed_items("GET admin/runs")
+def iter_changed_test_runs(project_ids, since, page_size=PAGE_SIZE, prefetch=False):
+    """Yield the test runs of the projects which were created, started or
+    finished after since, as they are read.
+
+    :param project_ids: list of integer project ids.
+    :param since: Bitbar time in milliseconds since the epoch.
+    :param page_size: number of items to request at a time, see iter_list.
+    :param prefetch: if True, request the next page in the background.
+
+    Bitbar's filters can not be combined with or, so each kind of change
+    is a separate request and a run may be yielded more than once. The
+    requests are made in order, so the last copy of a run is the latest.
+    """
+    fields = {"createtime": int, "endtime": int, "projectid": int, "starttime": int}
+    for field in ("createtime", "starttime", "endtime"):
+        filter = get_filter(
+            fields, projectid__in=sorted(project_ids), **{field + "__gt": since}
+        )
+        yield from iter_list(
+            "api/v2/admin/runs",
+            payload={"filter": filter},
+            page_size=page_size,
+            prefetch=prefetch,
+        )
+
+
+def get_active_test_runs(project_ids=None):
+    """Gets active test runs, see iter_active_test_runs."""
+    return list(iter_active_test_runs(project_ids=project_ids))
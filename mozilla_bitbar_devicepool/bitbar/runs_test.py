@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+from mozilla_bitbar_devicepool import configuration
+from mozilla_bitbar_devicepool.bitbar import runs
+
+
+def test_test_run_payload_cached_per_generation(monkeypatch):
+    monkeypatch.setattr(
+        configuration,
+        "CONFIG",
+        {
+            "projects": {
+                "test-1": {
+                    "framework_name": "framework-1",
+                    "os_type": "ANDROID",
+                    "scheduler": "SINGLE",
+                    "timeout": 0,
+                    "device_group_name": "group-1",
+                    "test_file": "test.zip",
+                    "additional_parameters": {"TC_WORKER_TYPE": "worker-1"},
+                }
+            }
+        },
+    )
+    monkeypatch.setattr(
+        configuration,
+        "BITBAR_CACHE",
+        {
+            "device_groups": {"group-1": {"id": 3}},
+            "files": {"test.zip": {"id": 4}},
+            "frameworks": {"framework-1": {"id": 1}},
+            "projects": {"test-1": {"id": 2}},
+        },
+    )
+    monkeypatch.setattr(
+        configuration,
+        "BITBAR_CACHE_TIMESTAMPS",
+        {"device_groups": {}, "files": {}, "frameworks": {}, "projects": {}},
+    )
+    monkeypatch.setattr(runs, "TEST_RUN_PAYLOADS", {})
+    posted = []
+
+    def fake_run_test_with_payload(payload):
+        posted.append(json.loads(payload))
+        return {"id": len(posted)}
+
+    monkeypatch.setattr(runs, "run_test_with_payload", fake_run_test_with_payload)
+
+    payload = runs.get_test_run_payload("test-1")
+    assert runs.get_test_run_payload("test-1") is payload
+    runs.run_test_for_project("test-1")
+    assert posted[0] == {
+        "frameworkId": 1,
+        "osType": "ANDROID",
+        "projectId": 2,
+        "scheduler": "SINGLE",
+        "timeout": 0,
+        "deviceGroupId": 3,
+        "testRunParameters": [{"key": "TC_WORKER_TYPE", "value": "worker-1"}],
+        "files": [{"id": 4, "action": "RUN_TEST"}],
+    }
+
+    # a re-uploaded file invalidates the payload.
+    configuration.set_cache_entry("files", "test.zip", {"id": 5})
+    assert runs.get_test_run_payload("test-1") is not payload
+    runs.run_test_for_project("test-1")
+    assert posted[1]["files"] == [{"id": 5, "action": "RUN_TEST"}]
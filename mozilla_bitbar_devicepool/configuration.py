@@ -2,14 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
+import json
 import os
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
-from mozilla_bitbar_devicepool import TESTDROID, logger
+from mozilla_bitbar_devicepool import TESTDROID, TESTDROID_URL, logger
 from mozilla_bitbar_devicepool.bitbar.device_groups import (
     add_devices_to_device_group,
     create_device_group,
@@ -18,13 +21,14 @@ from mozilla_bitbar_devicepool.bitbar.device_groups import (
     get_device_groups,
 )
 from mozilla_bitbar_devicepool.bitbar.devices import get_devices
-from mozilla_bitbar_devicepool.bitbar.files import get_files
+from mozilla_bitbar_devicepool.bitbar.files import get_files, get_latest_file
 from mozilla_bitbar_devicepool.bitbar.frameworks import get_frameworks
 from mozilla_bitbar_devicepool.bitbar.projects import (
     create_project,
     get_projects,
     update_project,
 )
+from mozilla_bitbar_devicepool.project_stats import ProjectStats
 from mozilla_bitbar_devicepool.util.template import apply_dict_defaults
 
 BITBAR_CACHE = {
@@ -34,11 +38,55 @@ BITBAR_CACHE = {
     "frameworks": {},
     "me": {},
     "projects": {},
+    # project name -> list of ActiveRun records, see active_runs.
     "test_runs": {},
 }
 
+# time each BITBAR_CACHE entry was last fetched from Bitbar.
+BITBAR_CACHE_TIMESTAMPS = {
+    "device_groups": {},
+    "files": {},
+    "frameworks": {},
+    "me": {},
+    "projects": {},
+}
+
+# kinds of BITBAR_CACHE entries saved to the cache snapshot.
+CACHE_SNAPSHOT_KINDS = ("device_groups", "files", "frameworks", "projects")
+CACHE_SNAPSHOT_VERSION = 1
+# maximum age in seconds of a cache snapshot entry which may be used.
+CACHE_SNAPSHOT_MAX_AGE = 24 * 60 * 60
+
+# Bitbar projects, files, frameworks and device groups listed once by
+# prefetch_bitbar_inventory and indexed by name. Each name maps to the
+# list of matching objects in the order returned by Bitbar.
+BITBAR_INVENTORY = {
+    "device_groups": {},
+    "files": {},
+    "frameworks": {},
+    "projects": {},
+}
+_inventory_lock = threading.Lock()
+
 FILESPATH = None
 CONFIG = None
+CONFIGPATH = None
+CACHE_SNAPSHOT_PATH = None
+# serializes saving the cache snapshot with invalidate_cache_snapshot.
+_cache_snapshot_lock = threading.Lock()
+
+# maximum number of device groups or projects reconciled concurrently.
+CONFIGURE_MAX_WORKERS = 8
+
+# incremented whenever a BITBAR_CACHE entry or CONFIG['projects'] changes
+# so that values derived from them, such as the test run payloads, can
+# tell when they must be rebuilt.
+CONFIG_GENERATION = 0
+_generation_lock = threading.Lock()
+
+# serializes the lookup and upload of files shared by several projects.
+_file_locks = {}
+_file_locks_lock = threading.Lock()
 
 
 class ConfigurationException(Exception):
@@ -61,6 +109,21 @@ class DuplicateProjectException(ConfigurationException):
     pass
 
 
+class ReconcileException(ConfigurationException):
+    """Raised when one or more device groups or projects failed to
+    be configured.
+
+    :param errors: list of (name, exception) tuples in configuration order.
+    """
+
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.errors = errors
+
+    def has(self, exception_class):
+        return any(isinstance(e, exception_class) for _name, e in self.errors)
+
+
 def get_filespath():
     """Return files path where application and test files are kept.
     """
@@ -72,13 +135,34 @@ def get_me_id():
     """
 
     if BITBAR_CACHE["me"] == {}:
-        BITBAR_CACHE["me"] = TESTDROID.get_me()
+        set_cache_entry("me", None, TESTDROID.get_me())
     # use 'id'
     # - not 'mainUserId' (user's can create sub-users)
     # - not 'accountId' (the organization's id))
     return BITBAR_CACHE["me"]["id"]
 
 
+def set_cache_entry(kind, name, value, fetched=None):
+    """Store value in BITBAR_CACHE[kind][name] and record when it was
+    fetched. The 'me' kind is not keyed by name.
+    """
+    if fetched is None:
+        fetched = time.time()
+    if kind == "me":
+        BITBAR_CACHE["me"] = value
+    else:
+        BITBAR_CACHE[kind][name] = value
+    BITBAR_CACHE_TIMESTAMPS[kind][name] = fetched
+    bump_config_generation()
+
+
+def bump_config_generation():
+    global CONFIG_GENERATION
+
+    with _generation_lock:
+        CONFIG_GENERATION += 1
+
+
 def ensure_filenames_are_unique(config):
     seen_filenames = []
     # TODO: break extraction of filenames out for easier testing
@@ -100,7 +184,14 @@ def ensure_filenames_are_unique(config):
     return seen_filenames
 
 
-def configure(bitbar_configpath, filespath=None, update_bitbar=False):
+def configure(
+    bitbar_configpath,
+    filespath=None,
+    update_bitbar=False,
+    max_workers=CONFIGURE_MAX_WORKERS,
+    cache_snapshot_path=None,
+    cache_snapshot_max_age=CACHE_SNAPSHOT_MAX_AGE,
+):
     """Parse and load the configuration yaml file
     defining the Mozilla Bitbar test setup.
 
@@ -109,16 +200,30 @@ def configure(bitbar_configpath, filespath=None, update_bitbar=False):
                               configuration.
     :param filespath: string path to the files directory where
                       application and test files are kept.
+    :param max_workers: maximum number of device groups or projects
+                        configured concurrently.
+    :param cache_snapshot_path: optional string path to a snapshot of
+                                BITBAR_CACHE. If it is valid for the
+                                configuration, it is loaded and the
+                                Bitbar configuration is revalidated in a
+                                background thread. Otherwise Bitbar is
+                                configured and the snapshot is written.
+    :param cache_snapshot_max_age: maximum age in seconds of the
+                                   snapshot's entries.
     """
-    global CONFIG, FILESPATH
+    global CONFIG, CONFIGPATH, CACHE_SNAPSHOT_PATH, FILESPATH
 
     FILESPATH = filespath
+    CONFIGPATH = bitbar_configpath
+    CACHE_SNAPSHOT_PATH = cache_snapshot_path
 
     logger.info("configure: starting configuration")
     start = time.time()
 
     with open(bitbar_configpath) as bitbar_configfile:
-        CONFIG = yaml.load(bitbar_configfile.read(), Loader=yaml.SafeLoader)
+        config_text = bitbar_configfile.read()
+    CONFIG = yaml.load(config_text, Loader=yaml.SafeLoader)
+    config_hash = get_config_hash(config_text)
     logger.info("configure: performing checks")
     try:
         ensure_filenames_are_unique(CONFIG)
@@ -134,18 +239,405 @@ def configure(bitbar_configpath, filespath=None, update_bitbar=False):
             "Configuration files seem to be missing! Please place and restart. Exiting..."
         )
         sys.exit(1)
-    configure_device_groups(update_bitbar=update_bitbar)
-    configure_projects(update_bitbar=update_bitbar)
+
+    if cache_snapshot_path and load_cache_snapshot(
+        cache_snapshot_path, config_hash, max_age=cache_snapshot_max_age
+    ):
+        logger.info(
+            "configure: loaded cache snapshot {}, revalidating in background".format(
+                cache_snapshot_path
+            )
+        )
+        revalidate_thread = threading.Thread(
+            target=revalidate_cache,
+            name="revalidate",
+            args=(cache_snapshot_path, config_hash),
+            kwargs={"update_bitbar": update_bitbar, "max_workers": max_workers},
+        )
+        revalidate_thread.daemon = True
+        revalidate_thread.start()
+    else:
+        reconcile_bitbar(update_bitbar=update_bitbar, max_workers=max_workers)
+        if cache_snapshot_path:
+            save_cache_snapshot(cache_snapshot_path, config_hash)
 
     end = time.time()
     diff = end - start
     logger.info("configure: configuration took {} seconds".format(diff))
 
 
-def expand_configuration():
-    """Materializes the configuration. Sets default values when none are specified.
+def reload_configuration(
+    bitbar_configpath=None, update_bitbar=False, max_workers=CONFIGURE_MAX_WORKERS
+):
+    """Reload the configuration yaml file and reconcile only the device
+    groups and projects which changed.
+
+    :param bitbar_configpath: string path to the config.yml. Defaults
+                              to the path passed to configure().
+
+    New and changed device groups are configured in CONFIG and at
+    Bitbar. New and changed projects are configured at Bitbar, then
+    swapped into CONFIG['projects'] so that running threads pick up
+    the complete new project configuration. Removed device groups and
+    projects are left in place until remove_configuration() is called
+    once their workers have stopped.
+
+    Returns a dict of lists of names with keys 'added_projects',
+    'changed_projects', 'removed_projects', 'changed_device_groups' and
+    'removed_device_groups'. If the new configuration is invalid an
+    exception is raised and the current configuration is unchanged.
+    """
+    if bitbar_configpath is None:
+        bitbar_configpath = CONFIGPATH
+
+    with open(bitbar_configpath) as bitbar_configfile:
+        config_text = bitbar_configfile.read()
+    new_config = yaml.load(config_text, Loader=yaml.SafeLoader)
+    ensure_filenames_are_unique(new_config)
+    expand_configuration(new_config)
+    configuration_preflight(new_config)
+
+    old_projects = CONFIG["projects"]
+    new_projects = new_config["projects"]
+    for project_name in new_projects:
+        if project_name != "defaults":
+            apply_taskcluster_access_token(new_projects[project_name])
+
+    old_device_groups = CONFIG["device_groups"]
+    new_device_groups = new_config["device_groups"]
+    for device_group_name in new_device_groups:
+        if new_device_groups[device_group_name] is None:
+            new_device_groups[device_group_name] = {}
+
+    changes = {
+        "added_projects": [
+            name
+            for name in new_projects
+            if name != "defaults" and name not in old_projects
+        ],
+        "changed_projects": [
+            name
+            for name in new_projects
+            if name != "defaults"
+            and name in old_projects
+            and new_projects[name] != old_projects[name]
+        ],
+        "removed_projects": [
+            name
+            for name in old_projects
+            if name != "defaults" and name not in new_projects
+        ],
+        "changed_device_groups": [
+            name
+            for name in new_device_groups
+            if new_device_groups[name] != old_device_groups.get(name)
+        ],
+        "removed_device_groups": [
+            name for name in old_device_groups if name not in new_device_groups
+        ],
+    }
+    # projects whose device group membership changed need their stats recounted.
+    recount_projects = [
+        name
+        for name in new_projects
+        if name != "defaults"
+        and name in old_projects
+        and name not in changes["changed_projects"]
+        and new_projects[name]["device_group_name"] in changes["changed_device_groups"]
+    ]
+    for kind in sorted(changes):
+        if changes[kind]:
+            logger.info(
+                "reload_configuration: {}: {}".format(kind, ", ".join(changes[kind]))
+            )
+
+    if not any(changes.values()):
+        logger.info("reload_configuration: no changes")
+        return changes
+
+    prefetch_bitbar_inventory()
+    previous_device_groups = {}
+    for device_group_name in changes["changed_device_groups"]:
+        previous_device_groups[device_group_name] = old_device_groups.get(
+            device_group_name
+        )
+        old_device_groups[device_group_name] = new_device_groups[device_group_name]
+    try:
+        reconcile_concurrently(
+            "reload_device_groups",
+            configure_device_group,
+            changes["changed_device_groups"],
+            max_workers,
+            update_bitbar=update_bitbar,
+        )
+    except ReconcileException:
+        # restore the previous device groups so the next reload retries them.
+        for device_group_name, device_group in previous_device_groups.items():
+            if device_group is None:
+                old_device_groups.pop(device_group_name, None)
+            else:
+                old_device_groups[device_group_name] = device_group
+        raise
+    reconcile_concurrently(
+        "reload_projects",
+        configure_project,
+        changes["added_projects"] + changes["changed_projects"] + recount_projects,
+        max_workers,
+        update_bitbar=update_bitbar,
+        projects_config=new_projects,
+    )
+
+    old_projects["defaults"] = new_projects["defaults"]
+    for project_name in changes["added_projects"] + changes["changed_projects"]:
+        old_projects[project_name] = new_projects[project_name]
+    bump_config_generation()
+
+    if CACHE_SNAPSHOT_PATH:
+        save_cache_snapshot(CACHE_SNAPSHOT_PATH, get_config_hash(config_text))
+    return changes
+
+
+def remove_configuration(changes):
+    """Remove the projects and device groups that reload_configuration
+    found were removed from the configuration.
+
+    :param changes: dict returned by reload_configuration.
+    """
+    for project_name in changes["removed_projects"]:
+        CONFIG["projects"].pop(project_name, None)
+        BITBAR_CACHE["projects"].pop(project_name, None)
+        BITBAR_CACHE["test_runs"].pop(project_name, None)
+        BITBAR_CACHE_TIMESTAMPS["projects"].pop(project_name, None)
+    for device_group_name in changes["removed_device_groups"]:
+        CONFIG["device_groups"].pop(device_group_name, None)
+        BITBAR_CACHE["device_groups"].pop(device_group_name, None)
+        BITBAR_CACHE_TIMESTAMPS["device_groups"].pop(device_group_name, None)
+    bump_config_generation()
+
+
+def reconcile_bitbar(update_bitbar=False, max_workers=CONFIGURE_MAX_WORKERS):
+    """Make the Bitbar device groups and projects match the configuration
+    and populate BITBAR_CACHE.
+    """
+    prefetch_bitbar_inventory()
+    configure_device_groups(update_bitbar=update_bitbar, max_workers=max_workers)
+    configure_projects(update_bitbar=update_bitbar, max_workers=max_workers)
+
+
+def revalidate_cache(
+    cache_snapshot_path,
+    config_hash,
+    update_bitbar=False,
+    max_workers=CONFIGURE_MAX_WORKERS,
+):
+    """Refresh the BITBAR_CACHE entries loaded from a snapshot from Bitbar
+    and save the snapshot again. If revalidation fails the snapshot is
+    removed so that the next start configures Bitbar from scratch.
+    """
+    start = time.time()
+    try:
+        reconcile_bitbar(update_bitbar=update_bitbar, max_workers=max_workers)
+    except Exception as e:
+        logger.error(
+            "revalidate_cache: failed ({}: {}). Removing {}.".format(
+                e.__class__.__name__, e, cache_snapshot_path
+            ),
+            exc_info=True,
+        )
+        remove_cache_snapshot(cache_snapshot_path)
+        return
+    with _cache_snapshot_lock:
+        # the snapshot was invalidated while revalidating.
+        if CACHE_SNAPSHOT_PATH != cache_snapshot_path:
+            return
+        save_cache_snapshot(cache_snapshot_path, config_hash)
+    logger.info(
+        "revalidate_cache: revalidation took {:.3f} seconds".format(time.time() - start)
+    )
+
+
+def get_config_hash(config_text):
+    """Return a hash identifying the configuration and the Bitbar
+    instance a cache snapshot belongs to.
+    """
+    config_hash = hashlib.sha256()
+    config_hash.update(str(TESTDROID_URL).encode("utf-8"))
+    config_hash.update(b"\0")
+    config_hash.update(config_text.encode("utf-8"))
+    return config_hash.hexdigest()
+
+
+def remove_cache_snapshot(cache_snapshot_path):
+    try:
+        os.unlink(cache_snapshot_path)
+    except OSError:
+        pass
+
+
+def invalidate_cache_snapshot(reason):
+    """Remove the cache snapshot, if any, and stop saving it so that the
+    next start configures Bitbar from scratch rather than reusing entries
+    Bitbar has rejected, such as archived files or deleted projects.
+
+    :param reason: string logged with the removal.
+    """
+    global CACHE_SNAPSHOT_PATH
+
+    with _cache_snapshot_lock:
+        cache_snapshot_path, CACHE_SNAPSHOT_PATH = CACHE_SNAPSHOT_PATH, None
+        if not cache_snapshot_path:
+            return
+        logger.warning(
+            "invalidate_cache_snapshot: removing {}: {}".format(
+                cache_snapshot_path, reason
+            )
+        )
+        remove_cache_snapshot(cache_snapshot_path)
+
+
+def save_cache_snapshot(cache_snapshot_path, config_hash):
+    """Write the resolved BITBAR_CACHE entries to cache_snapshot_path.
+
+    The per project locks and stats are not saved. The file is replaced
+    atomically so a partially written snapshot is never loaded.
+    """
+    entities = {
+        "me": {
+            "data": BITBAR_CACHE["me"],
+            "fetched": BITBAR_CACHE_TIMESTAMPS["me"].get(None),
+        }
+    }
+    for kind in CACHE_SNAPSHOT_KINDS:
+        entities[kind] = {}
+        for name, value in list(BITBAR_CACHE[kind].items()):
+            if kind == "projects":
+                value = dict(
+                    (key, value[key]) for key in value if key not in ("lock", "stats")
+                )
+            entities[kind][name] = {
+                "data": value,
+                "fetched": BITBAR_CACHE_TIMESTAMPS[kind].get(name),
+            }
+    snapshot = {
+        "version": CACHE_SNAPSHOT_VERSION,
+        "config_hash": config_hash,
+        "entities": entities,
+    }
+    temp_path = "{}.{}.tmp".format(cache_snapshot_path, os.getpid())
+    try:
+        with open(temp_path, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temp_path, cache_snapshot_path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(
+            "save_cache_snapshot: could not save {}: {}".format(cache_snapshot_path, e)
+        )
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        return False
+    logger.info("save_cache_snapshot: saved {}".format(cache_snapshot_path))
+    return True
+
+
+def get_required_cache_names():
+    """Return a dict of the names of each kind of BITBAR_CACHE entry the
+    configuration requires.
     """
     projects_config = CONFIG["projects"]
+    required = {
+        "device_groups": set(CONFIG["device_groups"]),
+        "files": set(),
+        "frameworks": set(),
+        "projects": set(),
+    }
+    for project_name in projects_config:
+        if project_name == "defaults":
+            continue
+        project_config = projects_config[project_name]
+        required["projects"].add(project_name)
+        required["frameworks"].add(project_config["framework_name"])
+        for file_key in ("test_file", "application_file"):
+            if project_config.get(file_key):
+                required["files"].add(project_config[file_key])
+    return required
+
+
+def load_cache_snapshot(
+    cache_snapshot_path, config_hash, max_age=CACHE_SNAPSHOT_MAX_AGE
+):
+    """Populate BITBAR_CACHE from the snapshot at cache_snapshot_path.
+
+    Returns True if the snapshot was written for the same configuration
+    and contains a fresh entry for everything the configuration requires,
+    otherwise returns False and leaves BITBAR_CACHE unchanged.
+    """
+    try:
+        with open(cache_snapshot_path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        logger.info(
+            "load_cache_snapshot: not using {}: {}".format(cache_snapshot_path, e)
+        )
+        return False
+
+    if (
+        snapshot.get("version") != CACHE_SNAPSHOT_VERSION
+        or snapshot.get("config_hash") != config_hash
+    ):
+        logger.info(
+            "load_cache_snapshot: not using {}: configuration changed".format(
+                cache_snapshot_path
+            )
+        )
+        return False
+
+    now = time.time()
+    entities = snapshot["entities"]
+
+    def is_fresh(entity):
+        fetched = entity.get("fetched")
+        return fetched is not None and now - fetched <= max_age
+
+    if not entities["me"]["data"] or not is_fresh(entities["me"]):
+        logger.info(
+            "load_cache_snapshot: not using {}: stale".format(cache_snapshot_path)
+        )
+        return False
+    for kind, names in get_required_cache_names().items():
+        for name in names:
+            entity = entities[kind].get(name)
+            if entity is None or not is_fresh(entity):
+                logger.info(
+                    "load_cache_snapshot: not using {}: {} {} missing or stale".format(
+                        cache_snapshot_path, kind, name
+                    )
+                )
+                return False
+
+    set_cache_entry("me", None, entities["me"]["data"], entities["me"]["fetched"])
+    # the device groups are needed by the projects' stats.
+    for kind in CACHE_SNAPSHOT_KINDS:
+        for name, entity in entities[kind].items():
+            if kind == "projects":
+                if name not in CONFIG["projects"]:
+                    continue
+                apply_taskcluster_access_token(CONFIG["projects"][name])
+                cache_project(name, entity["data"], fetched=entity["fetched"])
+            else:
+                set_cache_entry(kind, name, entity["data"], entity["fetched"])
+    return True
+
+
+def expand_configuration(config=None):
+    """Materializes the configuration. Sets default values when none are specified.
+
+    :param config: parsed configuration to expand. Defaults to CONFIG.
+    """
+    if config is None:
+        config = CONFIG
+    projects_config = config["projects"]
     project_defaults = projects_config["defaults"]
 
     for project_name in projects_config:
@@ -162,10 +654,14 @@ def expand_configuration():
     #   - would save later code from having to exclude it
 
 
-def configuration_preflight():
+def configuration_preflight(config=None):
     """Ensure that everything necessary for configuration is present.
+
+    :param config: parsed configuration to check. Defaults to CONFIG.
     """
-    projects_config = CONFIG["projects"]
+    if config is None:
+        config = CONFIG
+    projects_config = config["projects"]
 
     for project_name in projects_config:
         if project_name == "defaults":
@@ -185,282 +681,439 @@ def configuration_preflight():
                 raise ConfigurationFileException("'%s' does not exist!" % file_path)
 
 
-def configure_device_groups(update_bitbar=False):
+def index_by_name(items, key):
+    index = {}
+    for item in items:
+        index.setdefault(item[key], []).append(item)
+    return index
+
+
+def prefetch_bitbar_inventory():
+    """List the Bitbar projects, files, frameworks and device groups
+    once and index them by name in BITBAR_INVENTORY so that the
+    reconcilers do not need to query Bitbar for each name.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch") as executor:
+        device_groups = executor.submit(get_device_groups)
+        files = executor.submit(get_files)
+        frameworks = executor.submit(get_frameworks)
+        projects = executor.submit(get_projects)
+        inventory = {
+            "device_groups": index_by_name(device_groups.result(), "displayName"),
+            "files": index_by_name(files.result(), "name"),
+            "frameworks": index_by_name(frameworks.result(), "name"),
+            "projects": index_by_name(projects.result(), "name"),
+        }
+    with _inventory_lock:
+        BITBAR_INVENTORY.update(inventory)
+    logger.info(
+        "configure: prefetched {} device groups, {} files, {} frameworks, {} projects in {:.3f} seconds".format(
+            len(inventory["device_groups"]),
+            len(inventory["files"]),
+            len(inventory["frameworks"]),
+            len(inventory["projects"]),
+            time.time() - start,
+        )
+    )
+
+
+def lookup_inventory(kind, name):
+    """Return the list of prefetched Bitbar objects of kind with the name.
+
+    :param kind: one of 'device_groups', 'files', 'frameworks', 'projects'.
+    :param name: string name of the object.
+    """
+    with _inventory_lock:
+        return list(BITBAR_INVENTORY[kind].get(name, []))
+
+
+def add_to_inventory(kind, name, item):
+    """Record an object created after the inventory was prefetched."""
+    with _inventory_lock:
+        BITBAR_INVENTORY[kind].setdefault(name, []).append(item)
+
+
+def reconcile_concurrently(log_prefix, reconcile, names, max_workers, **kwargs):
+    """Call reconcile(name, **kwargs) for each name using a bounded pool
+    of threads.
+
+    Results are logged in the order of names regardless of the order in
+    which they complete. Errors are collected and raised together as a
+    ReconcileException once every name has been processed.
+    """
+    names = list(names)
+    errors = []
+    total = len(names)
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="configure"
+    ) as executor:
+        futures = [
+            (name, executor.submit(timed_call, reconcile, name, **kwargs))
+            for name in names
+        ]
+        for counter, (name, future) in enumerate(futures, 1):
+            log_header = "{}: {} ({}/{})".format(log_prefix, name, counter, total)
+            try:
+                elapsed = future.result()
+                logger.info(
+                    "{}: configured in {:.3f} seconds".format(log_header, elapsed)
+                )
+            except Exception as e:
+                logger.error(
+                    "{}: failed ({}: {})".format(log_header, e.__class__.__name__, e)
+                )
+                errors.append((name, e))
+    if errors:
+        raise ReconcileException(
+            "{}: {} of {} failed: {}".format(
+                log_prefix, len(errors), total, ", ".join(name for name, _e in errors)
+            ),
+            errors,
+        )
+
+
+def timed_call(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def configure_device_groups(update_bitbar=False, max_workers=CONFIGURE_MAX_WORKERS):
     """Configure device groups from configuration.
 
     :param config: parsed yaml configuration containing
                    a device_groups attribute which contains
                    and object for each device group which contains
                    objects for each contained device.
+    :param max_workers: maximum number of device groups configured
+                        concurrently.
     """
     # Cache the bitbar device data in the configuration.
     devices_cache = BITBAR_CACHE["devices"] = {}
     for device in get_devices():
         devices_cache[device["displayName"]] = device
 
+    reconcile_concurrently(
+        "configure_device_groups",
+        configure_device_group,
+        CONFIG["device_groups"],
+        max_workers,
+        update_bitbar=update_bitbar,
+    )
+
+
+def configure_device_group(device_group_name, update_bitbar=False):
+    """Configure a single device group from configuration.
+
+    :param device_group_name: name of the device group in
+                              CONFIG['device_groups'].
+    """
+    devices_cache = BITBAR_CACHE["devices"]
     device_groups_config = CONFIG["device_groups"]
-    for device_group_name in device_groups_config:
-        logger.info(
-            "configure_device_groups: configuring group {}".format(device_group_name)
+    logger.debug(
+        "configure_device_groups: configuring group {}".format(device_group_name)
+    )
+    device_group_config = device_groups_config[device_group_name]
+    if device_group_config is None:
+        # Handle the case where the configured device group is empty.
+        device_group_config = device_groups_config[device_group_name] = {}
+    new_device_group_names = set(device_group_config.keys())
+
+    # get the current definition of the device group at bitbar.
+    bitbar_device_groups = lookup_inventory("device_groups", device_group_name)
+    if len(bitbar_device_groups) > 1:
+        raise Exception(
+            "device group {} has {} duplicates".format(
+                device_group_name, len(bitbar_device_groups) - 1
+            )
         )
-        device_group_config = device_groups_config[device_group_name]
-        if device_group_config is None:
-            # Handle the case where the configured device group is empty.
-            device_group_config = device_groups_config[device_group_name] = {}
-        new_device_group_names = set(device_group_config.keys())
-
-        # get the current definition of the device group at bitbar.
-        bitbar_device_groups = get_device_groups(displayname=device_group_name)
-        if len(bitbar_device_groups) > 1:
-            raise Exception(
-                "device group {} has {} duplicates".format(
-                    device_group_name, len(bitbar_device_groups) - 1
-                )
+    elif len(bitbar_device_groups) == 1:
+        bitbar_device_group = bitbar_device_groups[0]
+        logger.debug(
+            "configure_device_groups: configuring group {} to use {}".format(
+                device_group_name, bitbar_device_group
             )
-        elif len(bitbar_device_groups) == 1:
-            bitbar_device_group = bitbar_device_groups[0]
+        )
+    else:
+        # no such device group. create it.
+        if update_bitbar:
+            bitbar_device_group = create_device_group(device_group_name)
+            add_to_inventory("device_groups", device_group_name, bitbar_device_group)
             logger.debug(
-                "configure_device_groups: configuring group {} to use {}".format(
+                "configure_device_groups: configuring group {} to use newly created group {}".format(
                     device_group_name, bitbar_device_group
                 )
             )
         else:
-            # no such device group. create it.
-            if update_bitbar:
-                bitbar_device_group = create_device_group(device_group_name)
-                logger.debug(
-                    "configure_device_groups: configuring group {} to use newly created group {}".format(
-                        device_group_name, bitbar_device_group
-                    )
-                )
-            else:
-                raise Exception(
-                    "device group {} does not exist but can not create.".format(
-                        device_group_name
-                    )
+            raise Exception(
+                "device group {} does not exist but can not create.".format(
+                    device_group_name
                 )
+            )
 
-        bitbar_device_group_devices = get_device_group_devices(
-            bitbar_device_group["id"]
-        )
-        bitbar_device_group_names = set(
-            [device["displayName"] for device in bitbar_device_group_devices]
-        )
+    bitbar_device_group_devices = get_device_group_devices(bitbar_device_group["id"])
+    bitbar_device_group_names = set(
+        [device["displayName"] for device in bitbar_device_group_devices]
+    )
 
-        # determine which devices need to be deleted from or added to
-        # the device group at bitbar.
-        delete_device_names = bitbar_device_group_names - new_device_group_names
-        add_device_names = new_device_group_names - bitbar_device_group_names
+    # determine which devices need to be deleted from or added to
+    # the device group at bitbar.
+    delete_device_names = bitbar_device_group_names - new_device_group_names
+    add_device_names = new_device_group_names - bitbar_device_group_names
 
-        delete_device_ids = [devices_cache[name]["id"] for name in delete_device_names]
-        add_device_ids = [
-            devices_cache[name]["id"]
-            for name in add_device_names
-            if name in devices_cache
-        ]
+    delete_device_ids = [devices_cache[name]["id"] for name in delete_device_names]
+    add_device_ids = [
+        devices_cache[name]["id"] for name in add_device_names if name in devices_cache
+    ]
 
-        for device_id in delete_device_ids:
-            if update_bitbar:
-                delete_device_from_device_group(bitbar_device_group["id"], device_id)
-            else:
-                raise Exception(
-                    "Attempting to remove device {} from group {}, but not configured to update bitbar config.".format(
-                        device_id, bitbar_device_group["id"]
-                    )
-                )
-            bitbar_device_group["deviceCount"] -= 1
-            if bitbar_device_group["deviceCount"] < 0:
-                raise Exception(
-                    "device group {} has negative deviceCount".format(device_group_name)
+    for device_id in delete_device_ids:
+        if update_bitbar:
+            delete_device_from_device_group(bitbar_device_group["id"], device_id)
+        else:
+            raise Exception(
+                "Attempting to remove device {} from group {}, but not configured to update bitbar config.".format(
+                    device_id, bitbar_device_group["id"]
                 )
+            )
+        bitbar_device_group["deviceCount"] -= 1
+        if bitbar_device_group["deviceCount"] < 0:
+            raise Exception(
+                "device group {} has negative deviceCount".format(device_group_name)
+            )
 
-        if add_device_ids:
-            if update_bitbar:
-                bitbar_device_group = add_devices_to_device_group(
-                    bitbar_device_group["id"], add_device_ids
-                )
-            else:
-                raise Exception(
-                    "Attempting to add device(s) {} to group {}, but not configured to update bitbar config.".format(
-                        add_device_ids, bitbar_device_group["id"]
-                    )
+    if add_device_ids:
+        if update_bitbar:
+            bitbar_device_group = add_devices_to_device_group(
+                bitbar_device_group["id"], add_device_ids
+            )
+        else:
+            raise Exception(
+                "Attempting to add device(s) {} to group {}, but not configured to update bitbar config.".format(
+                    add_device_ids, bitbar_device_group["id"]
                 )
+            )
 
-        BITBAR_CACHE["device_groups"][device_group_name] = bitbar_device_group
+    set_cache_entry("device_groups", device_group_name, bitbar_device_group)
 
 
-def configure_projects(update_bitbar=False):
+def configure_projects(update_bitbar=False, max_workers=CONFIGURE_MAX_WORKERS):
     """Configure projects from configuration.
 
     :param config: parsed yaml configuration containing
                    a projects attribute which contains
                    and object for each project.
+    :param max_workers: maximum number of projects configured
+                        concurrently.
 
     CONFIG['projects']['defaults'] contains values which will be set
     on the other projects if they are not already explicitly set.
 
     """
-    projects_config = CONFIG["projects"]
-
-    project_total = len(projects_config)
-    counter = 0
-    for project_name in projects_config:
-        counter += 1
-        log_header = "configure_projects: {} ({}/{})".format(
-            project_name, counter, project_total
-        )
-
-        if project_name == "defaults":
-            logger.info("{}: skipping".format(log_header))
-            continue
-        logger.info("{}: configuring...".format(log_header))
-
-        project_config = projects_config[project_name]
-
-        # for the project name at bitbar, add user id to the project_name
-        # - prevents collision with other users' projects and allows us to
-        #   avoid having to share projects
-        api_user_id = get_me_id()
-        user_project_name = "%s-%s" % (api_user_id, project_name)
-
-        bitbar_projects = get_projects(name=user_project_name)
-        if len(bitbar_projects) > 1:
-            raise DuplicateProjectException(
-                "project {} ({}) has {} duplicates".format(
-                    project_name, user_project_name, len(bitbar_projects) - 1
-                )
-            )
-        elif len(bitbar_projects) == 1:
-            bitbar_project = bitbar_projects[0]
-            logger.debug(
-                "configure_projects: using project {} ({})".format(
-                    bitbar_project, user_project_name
-                )
-            )
+    # look up the user id before starting the workers so they share it.
+    get_me_id()
+
+    project_names = [
+        project_name
+        for project_name in CONFIG["projects"]
+        if project_name != "defaults"
+    ]
+    reconcile_concurrently(
+        "configure_projects",
+        configure_project,
+        project_names,
+        max_workers,
+        update_bitbar=update_bitbar,
+    )
+
+
+def get_file_lock(file_name):
+    with _file_locks_lock:
+        if file_name not in _file_locks:
+            _file_locks[file_name] = threading.Lock()
+        return _file_locks[file_name]
+
+
+def configure_file(file_name, file_description, update_bitbar=False):
+    """Look up the latest Bitbar file with the given name, uploading it
+    if it does not exist, and cache it in BITBAR_CACHE['files'].
+
+    :param file_name: name of the file in the files directory.
+    :param file_description: string used in error messages, e.g. 'Test'.
+    """
+    # projects may share files, make sure each file is only uploaded once.
+    with get_file_lock(file_name):
+        bitbar_files = lookup_inventory("files", file_name)
+        if len(bitbar_files) > 0:
+            bitbar_file = bitbar_files[-1]
         else:
             if update_bitbar:
-                bitbar_project = create_project(
-                    user_project_name, project_type=project_config["project_type"]
-                )
-                logger.debug(
-                    "configure_projects: created project {} ({})".format(
-                        bitbar_project, user_project_name
+                TESTDROID.upload_file(os.path.join(FILESPATH, file_name))
+                bitbar_file = get_latest_file(file_name)
+                if bitbar_file is None:
+                    raise Exception(
+                        "{} file {} not found after uploading it!".format(
+                            file_description, file_name
+                        )
                     )
-                )
+                add_to_inventory("files", file_name, bitbar_file)
             else:
                 raise Exception(
-                    "Project {} ({}) does not exist, but not creating as not configured to update bitbar!".format(
-                        project_name, user_project_name
+                    "{} file {} not found and not configured to update bitbar configuration!".format(
+                        file_description, file_name
                     )
                 )
+        set_cache_entry("files", file_name, bitbar_file)
 
-        framework_name = project_config["framework_name"]
-        BITBAR_CACHE["frameworks"][framework_name] = get_frameworks(
-            name=framework_name
-        )[0]
 
-        logger.info("{}: configuring test file".format(log_header))
-        file_name = project_config.get("test_file")
-        if file_name:
-            bitbar_files = get_files(name=file_name)
-            if len(bitbar_files) > 0:
-                bitbar_file = bitbar_files[-1]
-            else:
-                if update_bitbar:
-                    TESTDROID.upload_file(os.path.join(FILESPATH, file_name))
-                    bitbar_file = get_files(name=file_name)[-1]
-                else:
-                    raise Exception(
-                        "Test file {} not found and not configured to update bitbar configuration!".format(
-                            file_name
-                        )
-                    )
-            BITBAR_CACHE["files"][file_name] = bitbar_file
+def configure_project(project_name, update_bitbar=False, projects_config=None):
+    """Configure a single project from configuration.
 
-        logger.info("{}: configuring application file".format(log_header))
-        file_name = project_config.get("application_file")
-        if file_name:
-            bitbar_files = get_files(name=file_name)
-            if len(bitbar_files) > 0:
-                bitbar_file = bitbar_files[-1]
-            else:
-                if update_bitbar:
-                    TESTDROID.upload_file(os.path.join(FILESPATH, file_name))
-                    bitbar_file = get_files(name=file_name)[-1]
-                else:
-                    raise Exception(
-                        "Application file {} not found and not configured to update bitbar configuration!".format(
-                            file_name
-                        )
-                    )
-            BITBAR_CACHE["files"][file_name] = bitbar_file
-
-        # Sync the base project properties if they have changed.
-        if (
-            project_config["archivingStrategy"] != bitbar_project["archivingStrategy"]
-            or project_config["archivingItemCount"]
-            != bitbar_project["archivingItemCount"]
-            or project_config["description"] != bitbar_project["description"]
-        ):
-            # project basic attributes changed in config, update bitbar version.
-            if update_bitbar:
-                bitbar_project = update_project(
-                    bitbar_project["id"],
-                    user_project_name,
-                    archiving_item_count=project_config["archivingItemCount"],
-                    archiving_strategy=project_config["archivingStrategy"],
-                    description=project_config["description"],
+    :param project_name: name of the project in CONFIG['projects'].
+    :param projects_config: optional projects configuration to use
+                            instead of CONFIG['projects'].
+    """
+    log_header = "configure_projects: {}".format(project_name)
+    logger.debug("{}: configuring...".format(log_header))
+
+    if projects_config is None:
+        projects_config = CONFIG["projects"]
+    project_config = projects_config[project_name]
+
+    # for the project name at bitbar, add user id to the project_name
+    # - prevents collision with other users' projects and allows us to
+    #   avoid having to share projects
+    api_user_id = get_me_id()
+    user_project_name = "%s-%s" % (api_user_id, project_name)
+
+    bitbar_projects = lookup_inventory("projects", user_project_name)
+    if len(bitbar_projects) > 1:
+        raise DuplicateProjectException(
+            "project {} ({}) has {} duplicates".format(
+                project_name, user_project_name, len(bitbar_projects) - 1
+            )
+        )
+    elif len(bitbar_projects) == 1:
+        bitbar_project = bitbar_projects[0]
+        logger.debug(
+            "configure_projects: using project {} ({})".format(
+                bitbar_project, user_project_name
+            )
+        )
+    else:
+        if update_bitbar:
+            bitbar_project = create_project(
+                user_project_name, project_type=project_config["project_type"]
+            )
+            add_to_inventory("projects", user_project_name, bitbar_project)
+            logger.debug(
+                "configure_projects: created project {} ({})".format(
+                    bitbar_project, user_project_name
                 )
-            else:
-                logger.error(
-                    'archivingStrategy: pc: "{}" bb: "{}"'.format(
-                        project_config["archivingStrategy"],
-                        bitbar_project["archivingStrategy"],
-                    )
+            )
+        else:
+            raise Exception(
+                "Project {} ({}) does not exist, but not creating as not configured to update bitbar!".format(
+                    project_name, user_project_name
                 )
-                logger.error(
-                    'archivingItemCount: pc: "{}" bb: "{}"'.format(
-                        project_config["archivingItemCount"],
-                        bitbar_project["archivingItemCount"],
-                    )
+            )
+
+    framework_name = project_config["framework_name"]
+    set_cache_entry(
+        "frameworks", framework_name, lookup_inventory("frameworks", framework_name)[0]
+    )
+
+    logger.debug("{}: configuring test file".format(log_header))
+    file_name = project_config.get("test_file")
+    if file_name:
+        configure_file(file_name, "Test", update_bitbar=update_bitbar)
+
+    logger.debug("{}: configuring application file".format(log_header))
+    file_name = project_config.get("application_file")
+    if file_name:
+        configure_file(file_name, "Application", update_bitbar=update_bitbar)
+
+    # Sync the base project properties if they have changed.
+    if (
+        project_config["archivingStrategy"] != bitbar_project["archivingStrategy"]
+        or project_config["archivingItemCount"] != bitbar_project["archivingItemCount"]
+        or project_config["description"] != bitbar_project["description"]
+    ):
+        # project basic attributes changed in config, update bitbar version.
+        if update_bitbar:
+            bitbar_project = update_project(
+                bitbar_project["id"],
+                user_project_name,
+                archiving_item_count=project_config["archivingItemCount"],
+                archiving_strategy=project_config["archivingStrategy"],
+                description=project_config["description"],
+            )
+        else:
+            logger.error(
+                'archivingStrategy: pc: "{}" bb: "{}"'.format(
+                    project_config["archivingStrategy"],
+                    bitbar_project["archivingStrategy"],
                 )
-                logger.error(
-                    'description: pc: "{}" bb: "{}"'.format(
-                        project_config["description"], bitbar_project["description"]
-                    )
+            )
+            logger.error(
+                'archivingItemCount: pc: "{}" bb: "{}"'.format(
+                    project_config["archivingItemCount"],
+                    bitbar_project["archivingItemCount"],
                 )
-                raise Exception(
-                    "The remote configuration for {} ({}) differs from the local configuration, but not configured to update bitbar!".format(
-                        project_name, user_project_name
-                    )
+            )
+            logger.error(
+                'description: pc: "{}" bb: "{}"'.format(
+                    project_config["description"], bitbar_project["description"]
+                )
+            )
+            raise Exception(
+                "The remote configuration for {} ({}) differs from the local configuration, but not configured to update bitbar!".format(
+                    project_name, user_project_name
                 )
+            )
 
-        additional_parameters = project_config["additional_parameters"]
-        if "TC_WORKER_TYPE" in additional_parameters:
-            # Add the TASKCLUSTER_ACCESS_TOKEN from the environment to
-            # the additional_parameters in order that the bitbar
-            # projects may be configured to use it. Non-taskcluster
-            # projects such as mozilla-docker-build are not invoke by
-            # Taskcluster currently.
-            taskcluster_access_token_name = additional_parameters[
-                "TC_WORKER_TYPE"
-            ].replace("-", "_")
-            additional_parameters["TASKCLUSTER_ACCESS_TOKEN"] = os.environ[
-                taskcluster_access_token_name
-            ]
-
-        BITBAR_CACHE["projects"][project_name] = bitbar_project
-        BITBAR_CACHE["projects"][project_name]["lock"] = threading.Lock()
-
-        device_group_name = project_config["device_group_name"]
-        device_group = BITBAR_CACHE["device_groups"][device_group_name]
-
-        BITBAR_CACHE["projects"][project_name]["stats"] = {
-            "COUNT": device_group["deviceCount"],
-            "IDLE": 0,
-            "OFFLINE_DEVICES": 0,
-            "OFFLINE": 0,
-            "DISABLED": 0,
-            "RUNNING": 0,
-            "WAITING": 0,
-        }
+    apply_taskcluster_access_token(project_config)
+    cache_project(project_name, bitbar_project, projects_config=projects_config)
+
+
+def apply_taskcluster_access_token(project_config):
+    additional_parameters = project_config["additional_parameters"]
+    if "TC_WORKER_TYPE" in additional_parameters:
+        # Add the TASKCLUSTER_ACCESS_TOKEN from the environment to
+        # the additional_parameters in order that the bitbar
+        # projects may be configured to use it. Non-taskcluster
+        # projects such as mozilla-docker-build are not invoke by
+        # Taskcluster currently.
+        taskcluster_access_token_name = additional_parameters["TC_WORKER_TYPE"].replace(
+            "-", "_"
+        )
+        additional_parameters["TASKCLUSTER_ACCESS_TOKEN"] = os.environ[
+            taskcluster_access_token_name
+        ]
+
+
+def cache_project(project_name, bitbar_project, fetched=None, projects_config=None):
+    """Store bitbar_project in BITBAR_CACHE['projects'].
+
+    If the project is already cached, its lock and stats are carried
+    over so that threads scheduling the project are not disturbed.
+    """
+    if projects_config is None:
+        projects_config = CONFIG["projects"]
+    project_config = projects_config[project_name]
+    device_group_name = project_config["device_group_name"]
+    device_group = BITBAR_CACHE["device_groups"][device_group_name]
+
+    cached_project = BITBAR_CACHE["projects"].get(project_name)
+    if cached_project:
+        lock = cached_project["lock"]
+        stats = cached_project["stats"]
+        with lock:
+            stats["COUNT"] = device_group["deviceCount"]
+            stats.publish()
+    else:
+        lock = threading.Lock()
+        stats = ProjectStats(COUNT=device_group["deviceCount"])
+    bitbar_project["lock"] = lock
+    bitbar_project["stats"] = stats
+    set_cache_entry("projects", project_name, bitbar_project, fetched)
@@ -83,3 +83,260 @@ def test_unique_filenames_bad_config():
     config = yaml.load(test_configuration_2, Loader=yaml.SafeLoader)
     with pytest.raises(configuration.ConfigurationFileDuplicateFilenamesException):
         configuration.ensure_filenames_are_unique(config)
+
+
+def test_reconcile_concurrently_aggregates_errors():
+    configured = []
+
+    def reconcile(name, update_bitbar=False):
+        if name.startswith("bad"):
+            raise configuration.DuplicateProjectException(name)
+        configured.append((name, update_bitbar))
+
+    with pytest.raises(configuration.ReconcileException) as excinfo:
+        configuration.reconcile_concurrently(
+            "test", reconcile, ["a", "bad1", "b", "bad2"], 2, update_bitbar=True
+        )
+    assert sorted(configured) == [("a", True), ("b", True)]
+    assert [name for name, _e in excinfo.value.errors] == ["bad1", "bad2"]
+    assert excinfo.value.has(configuration.DuplicateProjectException)
+
+
+def test_reconcile_concurrently_ok():
+    configured = []
+    configuration.reconcile_concurrently("test", configured.append, ["a", "b"], 4)
+    assert sorted(configured) == ["a", "b"]
+
+
+def test_prefetch_bitbar_inventory(monkeypatch):
+    calls = []
+
+    def lister(kind, items):
+        def list_items(**kwargs):
+            calls.append((kind, kwargs))
+            return items
+
+        return list_items
+
+    monkeypatch.setattr(
+        configuration,
+        "get_device_groups",
+        lister("device_groups", [{"displayName": "blah1-group", "id": 1}]),
+    )
+    monkeypatch.setattr(
+        configuration,
+        "get_files",
+        lister(
+            "files",
+            [
+                {"name": "aerickson-Testdroid.apk", "id": 10},
+                {"name": "aerickson-empty-test.zip", "id": 11},
+                {"name": "aerickson-Testdroid.apk", "id": 12},
+            ],
+        ),
+    )
+    monkeypatch.setattr(
+        configuration, "get_frameworks", lister("frameworks", [{"name": "mozilla-usb"}])
+    )
+    monkeypatch.setattr(
+        configuration, "get_projects", lister("projects", [{"name": "1-blah1"}])
+    )
+    monkeypatch.setattr(
+        configuration,
+        "BITBAR_INVENTORY",
+        {"device_groups": {}, "files": {}, "frameworks": {}, "projects": {}},
+    )
+
+    configuration.prefetch_bitbar_inventory()
+    assert sorted(calls) == [
+        ("device_groups", {}),
+        ("files", {}),
+        ("frameworks", {}),
+        ("projects", {}),
+    ]
+    assert [
+        f["id"]
+        for f in configuration.lookup_inventory("files", "aerickson-Testdroid.apk")
+    ] == [10, 12]
+    assert configuration.lookup_inventory("projects", "1-blah2") == []
+
+    configuration.add_to_inventory("projects", "1-blah2", {"name": "1-blah2"})
+    assert configuration.lookup_inventory("projects", "1-blah2") == [
+        {"name": "1-blah2"}
+    ]
+
+
+def test_cache_snapshot_round_trip(monkeypatch, tmp_path):
+    config = yaml.load(test_configuration_1, Loader=yaml.SafeLoader)
+    config["device_groups"] = {"blah1-group": None, "blah2-group": None}
+    monkeypatch.setattr(configuration, "CONFIG", config)
+    configuration.expand_configuration()
+    monkeypatch.setenv("blah1", "token1")
+    monkeypatch.setenv("blah2", "token2")
+
+    cache = {
+        "device_groups": {},
+        "devices": {},
+        "files": {},
+        "frameworks": {},
+        "me": {},
+        "projects": {},
+        "test_runs": {},
+    }
+    timestamps = {kind: {} for kind in configuration.BITBAR_CACHE_TIMESTAMPS}
+    monkeypatch.setattr(configuration, "BITBAR_CACHE", cache)
+    monkeypatch.setattr(configuration, "BITBAR_CACHE_TIMESTAMPS", timestamps)
+
+    configuration.set_cache_entry("me", None, {"id": 1})
+    for group_id, group_name in enumerate(config["device_groups"]):
+        configuration.set_cache_entry(
+            "device_groups", group_name, {"id": group_id, "deviceCount": 2}
+        )
+    for file_id, file_name in enumerate(
+        configuration.get_required_cache_names()["files"]
+    ):
+        configuration.set_cache_entry("files", file_name, {"id": file_id})
+    configuration.set_cache_entry("frameworks", "mozilla-usb", {"id": 7})
+    for project_id, project_name in enumerate(["blah1", "blah2"]):
+        configuration.cache_project(project_name, {"id": project_id})
+
+    snapshot_path = str(tmp_path / "snapshot.json")
+    assert configuration.save_cache_snapshot(snapshot_path, "hash1")
+
+    for kind in cache:
+        cache[kind] = {}
+    assert not configuration.load_cache_snapshot(snapshot_path, "hash2")
+    assert cache["projects"] == {}
+    assert not configuration.load_cache_snapshot(snapshot_path, "hash1", max_age=-1)
+
+    assert configuration.load_cache_snapshot(snapshot_path, "hash1")
+    assert cache["me"] == {"id": 1}
+    assert cache["frameworks"]["mozilla-usb"] == {"id": 7}
+    assert cache["projects"]["blah2"]["id"] == 1
+    assert cache["projects"]["blah2"]["stats"]["COUNT"] == 2
+    assert "lock" in cache["projects"]["blah2"]
+    assert (
+        config["projects"]["blah1"]["additional_parameters"]["TASKCLUSTER_ACCESS_TOKEN"]
+        == "token1"
+    )
+
+
+def test_invalidate_cache_snapshot(monkeypatch, tmp_path):
+    snapshot_path = tmp_path / "snapshot.json"
+    snapshot_path.write_text("{}")
+    monkeypatch.setattr(configuration, "CACHE_SNAPSHOT_PATH", str(snapshot_path))
+
+    configuration.invalidate_cache_snapshot("test files archived")
+    assert not snapshot_path.exists()
+    assert configuration.CACHE_SNAPSHOT_PATH is None
+
+    # a revalidation finishing afterwards does not save it again.
+    monkeypatch.setattr(configuration, "reconcile_bitbar", lambda **kwargs: None)
+    configuration.revalidate_cache(str(snapshot_path), "hash1")
+    assert not snapshot_path.exists()
+
+    # nothing to remove.
+    configuration.invalidate_cache_snapshot("project does not exist")
+
+
+def test_cache_project_keeps_lock_and_stats(monkeypatch):
+    config = yaml.load(test_configuration_1, Loader=yaml.SafeLoader)
+    monkeypatch.setattr(configuration, "CONFIG", config)
+    configuration.expand_configuration()
+    monkeypatch.setitem(
+        configuration.BITBAR_CACHE,
+        "device_groups",
+        {"blah1-group": {"id": 1, "deviceCount": 3}},
+    )
+    monkeypatch.setitem(configuration.BITBAR_CACHE, "projects", {})
+
+    configuration.cache_project("blah1", {"id": 1})
+    project = configuration.BITBAR_CACHE["projects"]["blah1"]
+    project["stats"]["RUNNING"] = 2
+
+    configuration.BITBAR_CACHE["device_groups"]["blah1-group"]["deviceCount"] = 4
+    configuration.cache_project("blah1", {"id": 1, "description": "new"})
+    new_project = configuration.BITBAR_CACHE["projects"]["blah1"]
+    assert new_project["description"] == "new"
+    assert new_project["lock"] is project["lock"]
+    assert new_project["stats"] is project["stats"]
+    assert new_project["stats"]["RUNNING"] == 2
+    assert new_project["stats"]["COUNT"] == 4
+
+
+def test_reload_configuration(monkeypatch, tmp_path):
+    old_config_text = test_configuration_1 + """
+device_groups:
+  blah1-group:
+    pixel2-01:
+  blah2-group:
+"""
+    new_config = yaml.load(old_config_text, Loader=yaml.SafeLoader)
+    del new_config["projects"]["blah2"]
+    del new_config["device_groups"]["blah2-group"]
+    new_config["projects"]["blah1"]["description"] = "blah1 is better"
+    new_config["projects"]["blah3"] = {
+        "device_group_name": "blah3-group",
+        "framework_name": "mozilla-usb",
+        "description": "blah3 is new",
+        "additional_parameters": {"TC_WORKER_TYPE": "blah3"},
+    }
+    new_config["device_groups"]["blah1-group"]["pixel2-02"] = None
+    new_config["device_groups"]["blah3-group"] = None
+    for file_name in configuration.ensure_filenames_are_unique(new_config):
+        (tmp_path / file_name).write_text("")
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(yaml.dump(new_config))
+
+    for worker_type in ["blah1", "blah2", "blah3"]:
+        monkeypatch.setenv(worker_type, "token")
+    config = yaml.load(old_config_text, Loader=yaml.SafeLoader)
+    monkeypatch.setattr(configuration, "CONFIG", config)
+    monkeypatch.setattr(configuration, "FILESPATH", str(tmp_path))
+    monkeypatch.setattr(configuration, "CACHE_SNAPSHOT_PATH", None)
+    configuration.expand_configuration()
+    for project_name in ["blah1", "blah2"]:
+        configuration.apply_taskcluster_access_token(config["projects"][project_name])
+
+    configured = []
+    monkeypatch.setattr(configuration, "prefetch_bitbar_inventory", lambda: None)
+    monkeypatch.setattr(
+        configuration,
+        "configure_device_group",
+        lambda name, update_bitbar=False: configured.append(("device_group", name)),
+    )
+
+    def fake_configure_project(name, update_bitbar=False, projects_config=None):
+        # the new project configuration is not visible until reconciled.
+        assert projects_config[name] is not config["projects"].get(name)
+        configured.append(("project", name))
+
+    monkeypatch.setattr(configuration, "configure_project", fake_configure_project)
+
+    blah1_config = config["projects"]["blah1"]
+    changes = configuration.reload_configuration(str(config_path))
+    assert changes == {
+        "added_projects": ["blah3"],
+        "changed_projects": ["blah1"],
+        "removed_projects": ["blah2"],
+        "changed_device_groups": ["blah1-group", "blah3-group"],
+        "removed_device_groups": ["blah2-group"],
+    }
+    assert sorted(configured) == [
+        ("device_group", "blah1-group"),
+        ("device_group", "blah3-group"),
+        ("project", "blah1"),
+        ("project", "blah3"),
+    ]
+    assert config["projects"]["blah1"] is not blah1_config
+    assert config["projects"]["blah1"]["description"] == "blah1 is better"
+    assert "blah2" in config["projects"]
+
+    configuration.remove_configuration(changes)
+    assert sorted(config["projects"]) == ["blah1", "blah3", "defaults"]
+    assert sorted(config["device_groups"]) == ["blah1-group", "blah3-group"]
+
+    configured[:] = []
+    changes = configuration.reload_configuration(str(config_path))
+    assert not any(changes.values())
+    assert configured == []
@@ -0,0 +1,879 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Local stand-in for the Bitbar and Taskcluster APIs used by the test run
+# manager, for load testing the manager on a single machine.
+#
+# Point the manager at it with
+#   TESTDROID_URL=http://127.0.0.1:<port>
+#   TASKCLUSTER_ROOT_URL=http://127.0.0.1:<port>
+
+import collections
+import itertools
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from mozilla_bitbar_devicepool import logger
+from mozilla_bitbar_devicepool.util.template import apply_dict_defaults
+
+USER_ID = 1
+# mean seconds a test run which claimed a task spends RUNNING.
+RUN_DURATION = 60
+# seconds a test run spends RUNNING when there is no task to claim, as
+# generic-worker exits when the queue is empty.
+IDLE_RUN_DURATION = 5
+# seconds finished test runs are kept before being forgotten.
+FINISHED_RUN_RETENTION = 600
+# seconds between simulation steps.
+TICK = 0.5
+
+FAKE_SERVER = None
+
+
+class FakeApiError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def get_field(item, field):
+    """Return the value of the item's field whose name matches field
+    ignoring case, as Bitbar filters use lower case field names.
+    """
+    field = field.lower()
+    for key, value in item.items():
+        if key.lower() == field:
+            return value
+    return None
+
+
+def parse_filter_value(field_type, value):
+    if field_type in ("n", "d"):
+        return int(value)
+    if field_type == "b":
+        return value.lower() == "true"
+    return value
+
+
+def matches_filter(item, filter):
+    """Return True if the item matches a Bitbar filter expression of the
+    form <type>_<field>_<operator>[_<value>], e.g. s_displayname_eq_pixel2,
+    n_projectId_in_1|2 or d_endTime_isnull.
+    """
+    parts = filter.split("_", 3)
+    if len(parts) < 3:
+        raise FakeApiError(400, "invalid filter {}".format(filter))
+    field_type, field, operator = parts[:3]
+    value = parts[3] if len(parts) == 4 else None
+    item_value = get_field(item, field)
+    if operator == "isnull":
+        return item_value is None
+    if operator == "isnotnull":
+        return item_value is not None
+    if value is None:
+        raise FakeApiError(400, "filter {} requires a value".format(filter))
+    if operator == "in":
+        values = [parse_filter_value(field_type, v) for v in value.split("|")]
+        return item_value in values
+    if operator == "like":
+        return value.lower().replace("%", "") in str(item_value).lower()
+    value = parse_filter_value(field_type, value)
+    if operator == "eq":
+        if field_type == "s":
+            return str(item_value).lower() == value.lower()
+        return item_value == value
+    if item_value is None:
+        return False
+    if operator == "gt":
+        return item_value > value
+    if operator == "lt":
+        return item_value < value
+    raise FakeApiError(400, "unknown filter operator in {}".format(filter))
+
+
+def list_response(items, query):
+    """Filter, sort and page items like the Bitbar list endpoints."""
+    for filter in query.get("filter", []):
+        items = [item for item in items if matches_filter(item, filter)]
+    for sort in query.get("sort", []):
+        field, _, direction = sort.rpartition("_")
+        items = sorted(
+            items,
+            key=lambda item: (get_field(item, field) or 0, item.get("id", 0)),
+            reverse=direction == "d",
+        )
+    total = len(items)
+    offset = int(query.get("offset", ["0"])[0])
+    limit = int(query.get("limit", ["0"])[0])
+    if limit:
+        items = items[offset : offset + limit]
+    else:
+        items = items[offset:]
+    return {
+        "data": items,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "empty": not items,
+    }
+
+
+class FakeBitbar(object):
+    """In memory Bitbar account, device fleet and Taskcluster queues.
+
+    Test runs are created WAITING. Each step of the simulation starts
+    the waiting runs on free online devices of their device group. A
+    RUNNING run claims the oldest pending task of its worker type if
+    there is one and finishes after about run_duration seconds, otherwise
+    it finishes after IDLE_RUN_DURATION seconds. The seconds between a
+    task being queued and claimed are recorded in claim_latencies.
+    """
+
+    def __init__(
+        self,
+        run_duration=RUN_DURATION,
+        task_rate=0.0,
+        pending_tasks=0,
+        offline_fraction=0.0,
+        seed=None,
+    ):
+        self.run_duration = run_duration
+        self.task_rate = task_rate
+        self.initial_pending_tasks = pending_tasks
+        self.offline_fraction = offline_fraction
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.me = {
+            "id": USER_ID,
+            "email": "devicepool@example.com",
+            "firstName": "Device",
+            "lastName": "Pool",
+        }
+        self.devices = {}
+        self.device_groups = {}
+        # device group id -> list of device ids
+        self.device_group_devices = {}
+        self.files = {}
+        self.frameworks = {}
+        self.projects = {}
+        # project id -> {parameter id: parameter}
+        self.project_parameters = {}
+        self.runs = {}
+        # run id -> (device id, worker type, seconds when the run finishes)
+        self.run_assignments = {}
+        # run id -> seconds the run spends RUNNING regardless of tasks
+        self.run_durations = {}
+        # worker type -> deque of the times the pending tasks were queued
+        self.task_queues = {}
+        self.task_credit = {}
+        self.claim_latencies = []
+        self.stats = {"runs_created": 0, "runs_finished": 0, "tasks_claimed": 0}
+        self.updated = time.time()
+
+    def next_id(self):
+        return next(self.ids)
+
+    def add_device(self, name):
+        device_id = self.next_id()
+        self.devices[device_id] = {
+            "id": device_id,
+            "displayName": name,
+            "deviceModelName": name,
+            "osType": "ANDROID",
+            "online": self.random.random() >= self.offline_fraction,
+            "enabled": True,
+            "locked": False,
+        }
+        return self.devices[device_id]
+
+    def add_device_group(self, name, ostype="ANDROID"):
+        device_group_id = self.next_id()
+        self.device_groups[device_group_id] = {
+            "id": device_group_id,
+            "displayName": name,
+            "osType": ostype,
+            "userId": USER_ID,
+            "deviceCount": 0,
+        }
+        self.device_group_devices[device_group_id] = []
+        return self.device_groups[device_group_id]
+
+    def add_devices_to_device_group(self, device_group_id, device_ids):
+        device_group = self.get_item(self.device_groups, device_group_id)
+        members = self.device_group_devices[device_group_id]
+        for device_id in device_ids:
+            self.get_item(self.devices, device_id)
+            if device_id not in members:
+                members.append(device_id)
+        device_group["deviceCount"] = len(members)
+        return device_group
+
+    def add_file(self, name):
+        file_id = self.next_id()
+        self.files[file_id] = {
+            "id": file_id,
+            "name": name,
+            "createTime": now_ms(),
+            "fileProperties": [{"key": "virus_scan_status", "value": "safe"}],
+        }
+        return self.files[file_id]
+
+    def add_framework(self, name):
+        framework_id = self.next_id()
+        self.frameworks[framework_id] = {"id": framework_id, "name": name}
+        return self.frameworks[framework_id]
+
+    def add_project(self, name, project_type="GENERIC"):
+        project_id = self.next_id()
+        self.projects[project_id] = {
+            "id": project_id,
+            "name": name,
+            "type": project_type,
+            "userId": USER_ID,
+            "archivingStrategy": "DAYS",
+            "archivingItemCount": 365,
+            "description": None,
+            "archiveTime": None,
+        }
+        self.project_parameters[project_id] = {}
+        return self.projects[project_id]
+
+    def load_configuration(self, config, populate=True):
+        """Create the devices and frameworks of a Bitbar yaml configuration.
+
+        :param config: parsed Bitbar configuration.
+        :param populate: if True, also create the device groups, files
+                         and projects so that the manager can start
+                         without --update-bitbar.
+        """
+        with self.lock:
+            device_groups_config = config["device_groups"]
+            devices_by_name = {}
+            for device_group_name in device_groups_config:
+                for device_name in device_groups_config[device_group_name] or {}:
+                    if device_name not in devices_by_name:
+                        devices_by_name[device_name] = self.add_device(device_name)
+
+            projects_config = config["projects"]
+            defaults = projects_config.get("defaults", {})
+            project_configs = {
+                name: apply_dict_defaults(projects_config[name], defaults)
+                for name in projects_config
+                if name != "defaults"
+            }
+            for framework_name in sorted(
+                {project["framework_name"] for project in project_configs.values()}
+            ):
+                self.add_framework(framework_name)
+            for project in project_configs.values():
+                worker_type = project["additional_parameters"].get("TC_WORKER_TYPE")
+                if worker_type:
+                    self.task_queues[worker_type] = collections.deque(
+                        [time.time()] * self.initial_pending_tasks
+                    )
+                    self.task_credit[worker_type] = 0.0
+
+            if not populate:
+                return
+            for device_group_name in device_groups_config:
+                device_group = self.add_device_group(device_group_name)
+                self.add_devices_to_device_group(
+                    device_group["id"],
+                    [
+                        devices_by_name[device_name]["id"]
+                        for device_name in device_groups_config[device_group_name] or {}
+                    ],
+                )
+            file_names = set()
+            for project in project_configs.values():
+                for file_key in ("application_file", "test_file"):
+                    if project.get(file_key):
+                        file_names.add(project[file_key])
+            for file_name in sorted(file_names):
+                self.add_file(file_name)
+            for project_name, project_config in sorted(project_configs.items()):
+                project = self.add_project(
+                    "{}-{}".format(USER_ID, project_name),
+                    project_config.get("project_type", "GENERIC"),
+                )
+                project["archivingStrategy"] = project_config.get("archivingStrategy")
+                project["archivingItemCount"] = project_config.get("archivingItemCount")
+                project["description"] = project_config.get("description")
+
+    def get_item(self, items, item_id):
+        try:
+            return items[int(item_id)]
+        except (KeyError, ValueError):
+            raise FakeApiError(404, "Entity with id {} does not exist".format(item_id))
+
+    def create_run(self, test_configuration, duration=None):
+        """Create a WAITING test run.
+
+        :param duration: optional seconds the run stays RUNNING without
+                         claiming a task, e.g. to keep devices busy.
+        """
+        project = self.get_item(self.projects, test_configuration["projectId"])
+        self.get_item(self.device_groups, test_configuration["deviceGroupId"])
+        for file in test_configuration.get("files", []):
+            self.get_item(self.files, file["id"])
+        parameters = {
+            parameter["key"]: parameter["value"]
+            for parameter in test_configuration.get("testRunParameters", [])
+        }
+        run_id = self.next_id()
+        self.runs[run_id] = {
+            "id": run_id,
+            "displayName": "Test Run {}".format(run_id),
+            "projectId": project["id"],
+            "projectName": project["name"],
+            "deviceGroupId": test_configuration["deviceGroupId"],
+            "userId": USER_ID,
+            "state": "WAITING",
+            "createTime": now_ms(),
+            "startTime": None,
+            "endTime": None,
+            "workerType": parameters.get("TC_WORKER_TYPE"),
+        }
+        if duration is not None:
+            self.run_durations[run_id] = duration
+        self.stats["runs_created"] += 1
+        return self.runs[run_id]
+
+    def finish_run(self, run, now):
+        run["state"] = "FINISHED"
+        run["endTime"] = int(now * 1000)
+        self.run_assignments.pop(run["id"], None)
+        self.run_durations.pop(run["id"], None)
+        self.stats["runs_finished"] += 1
+
+    def clear(self):
+        """Abort the active test runs, empty the task queues and clear
+        the statistics. Must be called with the lock held.
+        """
+        now = time.time()
+        for run in self.runs.values():
+            if run["endTime"] is None:
+                self.finish_run(run, now)
+                run["state"] = "ABORTED"
+        for worker_type in self.task_queues:
+            self.task_queues[worker_type].clear()
+            self.task_credit[worker_type] = 0.0
+        self.claim_latencies = []
+        self.stats = dict.fromkeys(self.stats, 0)
+
+    def reset(self):
+        with self.lock:
+            self.clear()
+
+    def advance(self, now=None):
+        """Advance the simulation to now: add tasks, finish and start
+        test runs and forget old finished runs.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            elapsed = max(0.0, now - self.updated)
+            self.updated = now
+            if self.task_rate:
+                for worker_type in self.task_queues:
+                    self.task_credit[worker_type] += self.task_rate * elapsed
+                    new_tasks = int(self.task_credit[worker_type])
+                    self.task_credit[worker_type] -= new_tasks
+                    self.task_queues[worker_type].extend([now] * new_tasks)
+
+            busy_devices = set()
+            for run_id, (device_id, worker_type, finish_at) in list(
+                self.run_assignments.items()
+            ):
+                if now >= finish_at:
+                    self.finish_run(self.runs[run_id], now)
+                else:
+                    busy_devices.add(device_id)
+
+            for run in sorted(self.runs.values(), key=lambda run: run["id"]):
+                if run["state"] != "WAITING":
+                    continue
+                free_devices = [
+                    device_id
+                    for device_id in self.device_group_devices.get(
+                        run["deviceGroupId"], []
+                    )
+                    if device_id not in busy_devices
+                    and self.devices[device_id]["online"]
+                    and self.devices[device_id]["enabled"]
+                ]
+                if not free_devices:
+                    continue
+                device_id = free_devices[0]
+                busy_devices.add(device_id)
+                worker_type = run["workerType"]
+                task_queue = self.task_queues.get(worker_type)
+                if run["id"] in self.run_durations:
+                    duration = self.run_durations[run["id"]]
+                elif task_queue:
+                    self.claim_latencies.append(now - task_queue.popleft())
+                    self.stats["tasks_claimed"] += 1
+                    duration = self.random.uniform(0.5, 1.5) * self.run_duration
+                else:
+                    duration = IDLE_RUN_DURATION
+                run["state"] = "RUNNING"
+                run["startTime"] = int(now * 1000)
+                self.run_assignments[run["id"]] = (
+                    device_id,
+                    worker_type,
+                    now + duration,
+                )
+
+            expired = int((now - FINISHED_RUN_RETENTION) * 1000)
+            for run_id in [
+                run_id
+                for run_id, run in self.runs.items()
+                if run["endTime"] is not None and run["endTime"] < expired
+            ]:
+                del self.runs[run_id]
+
+    def get_device_problems(self):
+        return [
+            {
+                "deviceName": device["displayName"],
+                "deviceModelName": device["deviceModelName"],
+                "problems": [{"type": "OFFLINE"}],
+            }
+            for device in self.devices.values()
+            if not device["online"]
+        ]
+
+    def get_pending_tasks(self, worker_type):
+        return len(self.task_queues.get(worker_type, ()))
+
+    def summarize(self):
+        """Return the run states, pending tasks, statistics and claim
+        latency summary. Must be called with the lock held.
+        """
+        states = {}
+        for run in self.runs.values():
+            states[run["state"]] = states.get(run["state"], 0) + 1
+        latencies = sorted(self.claim_latencies)
+        claim_latency = {"count": len(latencies)}
+        if latencies:
+            claim_latency.update(
+                {
+                    "mean": sum(latencies) / len(latencies),
+                    "p50": latencies[len(latencies) // 2],
+                    "p95": latencies[int(len(latencies) * 0.95)],
+                    "max": latencies[-1],
+                }
+            )
+        return {
+            "runs": states,
+            "pending_tasks": {
+                worker_type: len(task_queue)
+                for worker_type, task_queue in self.task_queues.items()
+            },
+            "stats": dict(self.stats),
+            "claim_latency": claim_latency,
+        }
+
+    def get_state(self):
+        with self.lock:
+            return self.summarize()
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # (method, path pattern, FakeRequestHandler method name). Paths are
+    # relative to /api/v2/ except for the Taskcluster queue and the fake/
+    # endpoints which control the simulation.
+    routes = [
+        ("GET", r"fake/state", "get_fake_state"),
+        ("POST", r"fake/settings", "update_fake_settings"),
+        ("POST", r"fake/reset", "reset_fake"),
+        ("GET", r"queue/v1/pending/([^/]+)/([^/]+)", "get_pending_tasks"),
+        ("GET", r"me", "get_me"),
+        ("GET", r"(?:me|users/\d+)/device-groups", "get_device_groups"),
+        ("POST", r"(?:me|users/\d+)/device-groups", "create_device_group"),
+        ("GET", r"device-groups/(\d+)", "get_device_group"),
+        ("DELETE", r"device-groups/(\d+)", "delete_device_group"),
+        (
+            "GET",
+            r"(?:users/\d+/)?device-groups/(\d+)/devices",
+            "get_device_group_devices",
+        ),
+        ("POST", r"device-groups/(\d+)/devices", "add_device_group_devices"),
+        ("DELETE", r"device-groups/(\d+)/devices/(\d+)", "delete_device_group_device"),
+        ("GET", r"devices", "get_devices"),
+        ("GET", r"devices/(\d+)", "get_device"),
+        ("GET", r"admin/device-problems", "get_device_problems"),
+        ("GET", r"(?:me/)?files", "get_files"),
+        ("GET", r"(?:me|users/\d+)/files/(\d+)", "get_file"),
+        ("POST", r"(?:me|users/\d+)/files", "upload_file"),
+        ("GET", r"admin/frameworks|me/available-frameworks", "get_frameworks"),
+        ("GET", r"(?:me/|users/\d+/)?projects", "get_projects"),
+        ("GET", r"(?:me/|users/\d+/)?projects/(\d+)", "get_project"),
+        ("POST", r"(?:me|users/\d+)/projects", "create_project"),
+        ("POST", r"(?:me|users/\d+)/projects/(\d+)", "update_project"),
+        (
+            "GET",
+            r"(?:me|users/\d+)/projects/(\d+)/config/parameters",
+            "get_project_parameters",
+        ),
+        (
+            "POST",
+            r"(?:me|users/\d+)/projects/(\d+)/config/parameters",
+            "add_project_parameter",
+        ),
+        (
+            "DELETE",
+            r"(?:me|users/\d+)/projects/(\d+)/config/parameters/(\d+)",
+            "delete_project_parameter",
+        ),
+        ("POST", r"runs", "create_run"),
+        ("GET", r"admin/runs", "get_runs"),
+        ("GET", r"(?:me|users/\d+)/projects/(\d+)/runs", "get_project_runs"),
+        ("GET", r"(?:me|users/\d+)/projects/(\d+)/runs/(\d+)", "get_project_run"),
+        ("DELETE", r"(?:me|users/\d+)/projects/(\d+)/runs/(\d+)", "delete_run"),
+        ("POST", r"(?:me|users/\d+)/projects/(\d+)/runs/(\d+)/abort", "abort_run"),
+    ]
+    compiled_routes = [
+        (method, re.compile(pattern + "$"), name) for method, pattern, name in routes
+    ]
+
+    @property
+    def bitbar(self):
+        return self.server.bitbar
+
+    def do_GET(self):
+        self.handle_api_request("GET")
+
+    def do_POST(self):
+        self.handle_api_request("POST")
+
+    def do_DELETE(self):
+        self.handle_api_request("DELETE")
+
+    def get_route(self, method, path):
+        # the Testdroid client prefixes paths which already begin with
+        # api/v2/ with another api/v2/.
+        path = path.strip("/")
+        while path.startswith("api/"):
+            path = path.split("/", 2)[2] if path.startswith("api/v2/") else path[4:]
+        for route_method, pattern, name in self.compiled_routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                return getattr(self, name), match.groups()
+        raise FakeApiError(404, "no such endpoint {} {}".format(method, path))
+
+    def handle_api_request(self, method):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        latency, jitter, error_rate = self.server.get_faults()
+        if latency or jitter:
+            time.sleep(latency + random.uniform(0, jitter))
+        try:
+            if error_rate and random.random() < error_rate:
+                raise FakeApiError(503, "injected error")
+            handler, args = self.get_route(method, url.path)
+            # serialize while holding the lock as the simulation updates
+            # the returned objects in place.
+            with self.bitbar.lock:
+                body = json.dumps(handler(*args))
+            self.send_json(200, body)
+        except FakeApiError as e:
+            self.send_json(e.status_code, json.dumps({"message": str(e)}))
+
+    def send_json(self, status_code, body):
+        body = body.encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_form(self):
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.body.decode("utf-8"))
+        return {
+            key: values if key.endswith("[]") else values[0]
+            for key, values in parse_qs(self.body.decode("utf-8")).items()
+        }
+
+    def get_fake_state(self):
+        return self.bitbar.summarize()
+
+    def update_fake_settings(self):
+        """Change the simulation and fault injection settings given in a
+        json object, e.g. {"task_rate": 0.5, "error_rate": 0.01}.
+        """
+        settings = self.get_form()
+        for name in ("task_rate", "run_duration"):
+            if name in settings:
+                setattr(self.bitbar, name, float(settings[name]))
+        faults = dict(
+            zip(("latency", "jitter", "error_rate"), self.server.get_faults())
+        )
+        for name in faults:
+            if name in settings:
+                faults[name] = float(settings[name])
+        self.server.set_faults(**faults)
+        return dict(
+            faults,
+            task_rate=self.bitbar.task_rate,
+            run_duration=self.bitbar.run_duration,
+        )
+
+    def reset_fake(self):
+        self.bitbar.clear()
+        return self.bitbar.summarize()
+
+    def get_pending_tasks(self, provisioner_id, worker_type):
+        return {
+            "provisionerId": provisioner_id,
+            "workerType": worker_type,
+            "pendingTasks": self.bitbar.get_pending_tasks(worker_type),
+        }
+
+    def get_me(self):
+        return self.bitbar.me
+
+    def get_device_groups(self):
+        return list_response(list(self.bitbar.device_groups.values()), self.query)
+
+    def create_device_group(self):
+        form = self.get_form()
+        return self.bitbar.add_device_group(
+            form["displayName"], form.get("osType", "ANDROID")
+        )
+
+    def get_device_group(self, device_group_id):
+        return self.bitbar.get_item(self.bitbar.device_groups, device_group_id)
+
+    def delete_device_group(self, device_group_id):
+        self.bitbar.get_item(self.bitbar.device_groups, device_group_id)
+        del self.bitbar.device_groups[int(device_group_id)]
+        del self.bitbar.device_group_devices[int(device_group_id)]
+        return {}
+
+    def get_device_group_devices(self, device_group_id):
+        self.bitbar.get_item(self.bitbar.device_groups, device_group_id)
+        devices = [
+            self.bitbar.devices[device_id]
+            for device_id in self.bitbar.device_group_devices[int(device_group_id)]
+        ]
+        return list_response(devices, self.query)
+
+    def add_device_group_devices(self, device_group_id):
+        device_ids = [int(device_id) for device_id in self.get_form()["deviceIds[]"]]
+        return self.bitbar.add_devices_to_device_group(int(device_group_id), device_ids)
+
+    def delete_device_group_device(self, device_group_id, device_id):
+        device_group = self.bitbar.get_item(self.bitbar.device_groups, device_group_id)
+        members = self.bitbar.device_group_devices[int(device_group_id)]
+        if int(device_id) not in members:
+            raise FakeApiError(404, "device {} is not in the group".format(device_id))
+        members.remove(int(device_id))
+        device_group["deviceCount"] = len(members)
+        return {}
+
+    def get_devices(self):
+        return list_response(list(self.bitbar.devices.values()), self.query)
+
+    def get_device(self, device_id):
+        return self.bitbar.get_item(self.bitbar.devices, device_id)
+
+    def get_device_problems(self):
+        return list_response(self.bitbar.get_device_problems(), self.query)
+
+    def get_files(self):
+        return list_response(list(self.bitbar.files.values()), self.query)
+
+    def get_file(self, file_id):
+        return self.bitbar.get_item(self.bitbar.files, file_id)
+
+    def upload_file(self):
+        match = re.search(rb'filename="([^"]+)"', self.body)
+        if not match:
+            raise FakeApiError(400, "no file in upload")
+        return self.bitbar.add_file(match.group(1).decode("utf-8"))
+
+    def get_frameworks(self):
+        return list_response(list(self.bitbar.frameworks.values()), self.query)
+
+    def get_projects(self):
+        return list_response(list(self.bitbar.projects.values()), self.query)
+
+    def get_project(self, project_id):
+        return self.bitbar.get_item(self.bitbar.projects, project_id)
+
+    def create_project(self):
+        form = self.get_form()
+        return self.bitbar.add_project(form["name"], form.get("type", "GENERIC"))
+
+    def update_project(self, project_id):
+        project = self.bitbar.get_item(self.bitbar.projects, project_id)
+        form = self.get_form()
+        for key in ("name", "archivingStrategy", "description"):
+            if key in form:
+                project[key] = form[key]
+        if "archivingItemCount" in form:
+            project["archivingItemCount"] = int(form["archivingItemCount"])
+        return project
+
+    def get_project_parameters(self, project_id):
+        self.bitbar.get_item(self.bitbar.projects, project_id)
+        parameters = self.bitbar.project_parameters[int(project_id)]
+        return list_response(list(parameters.values()), self.query)
+
+    def add_project_parameter(self, project_id):
+        self.bitbar.get_item(self.bitbar.projects, project_id)
+        form = self.get_form()
+        parameter_id = self.bitbar.next_id()
+        parameter = {"id": parameter_id, "key": form["key"], "value": form["value"]}
+        self.bitbar.project_parameters[int(project_id)][parameter_id] = parameter
+        return parameter
+
+    def delete_project_parameter(self, project_id, parameter_id):
+        self.bitbar.get_item(self.bitbar.projects, project_id)
+        parameters = self.bitbar.project_parameters[int(project_id)]
+        self.bitbar.get_item(parameters, parameter_id)
+        del parameters[int(parameter_id)]
+        return {}
+
+    def create_run(self):
+        try:
+            test_configuration = json.loads(self.body.decode("utf-8"))
+        except ValueError:
+            raise FakeApiError(400, "invalid test run configuration")
+        return self.bitbar.create_run(test_configuration)
+
+    def get_runs(self):
+        return list_response(list(self.bitbar.runs.values()), self.query)
+
+    def get_project_run_items(self, project_id):
+        self.bitbar.get_item(self.bitbar.projects, project_id)
+        return [
+            run
+            for run in self.bitbar.runs.values()
+            if run["projectId"] == int(project_id)
+        ]
+
+    def get_project_runs(self, project_id):
+        return list_response(self.get_project_run_items(project_id), self.query)
+
+    def get_project_run(self, project_id, run_id):
+        for run in self.get_project_run_items(project_id):
+            if run["id"] == int(run_id):
+                return run
+        raise FakeApiError(404, "Entity with id {} does not exist".format(run_id))
+
+    def delete_run(self, project_id, run_id):
+        self.get_project_run(project_id, run_id)
+        self.bitbar.run_assignments.pop(int(run_id), None)
+        del self.bitbar.runs[int(run_id)]
+        return {}
+
+    def abort_run(self, project_id, run_id):
+        run = self.get_project_run(project_id, run_id)
+        if run["endTime"] is None:
+            self.bitbar.finish_run(run, time.time())
+            run["state"] = "ABORTED"
+        return run
+
+    def log_message(self, format, *args):
+        logger.debug("fake server: " + format % args)
+
+
+class FakeServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, bitbar, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__(server_address, FakeRequestHandler)
+        self.bitbar = bitbar
+        self.stopped = threading.Event()
+        self.set_faults(latency, jitter, error_rate)
+
+    def set_faults(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        """Delay each response by latency plus up to jitter seconds and
+        answer the fraction error_rate of the requests with a 503.
+        """
+        self.faults = (latency, jitter, error_rate)
+
+    def get_faults(self):
+        return self.faults
+
+    def get_url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def simulate(self, tick=TICK):
+        while not self.stopped.wait(tick):
+            self.bitbar.advance()
+
+    def start(self, tick=TICK):
+        """Serve requests and advance the simulation from daemon threads."""
+        threading.Thread(
+            target=self.serve_forever, name="fake-server", daemon=True
+        ).start()
+        threading.Thread(
+            target=self.simulate, args=(tick,), name="fake-fleet", daemon=True
+        ).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+def get_environment(config, url):
+    """Return the environment variables with which the test run manager
+    uses the fake server at url, including a dummy Taskcluster access
+    token for each worker type in config.
+    """
+    environment = {
+        "TESTDROID_URL": url,
+        "TESTDROID_APIKEY": "fake-apikey",
+        "TASKCLUSTER_ROOT_URL": url,
+    }
+    projects_config = config["projects"]
+    for project_name in projects_config:
+        additional_parameters = projects_config[project_name].get(
+            "additional_parameters", {}
+        )
+        if "TC_WORKER_TYPE" in additional_parameters:
+            token_name = additional_parameters["TC_WORKER_TYPE"].replace("-", "_")
+            environment[token_name] = "fake-access-token"
+    return environment
+
+
+def start_fake_server(bitbar, port=0, address="127.0.0.1", tick=TICK, **faults):
+    """Serve the fake Bitbar and Taskcluster APIs at http://address:port
+    and simulate the fleet from daemon threads.
+
+    :param bitbar: FakeBitbar instance.
+    :param port: integer port, 0 to pick a free port.
+    :param faults: latency, jitter and error_rate passed to FakeServer.
+    """
+    global FAKE_SERVER
+
+    FAKE_SERVER = FakeServer((address, port), bitbar, **faults)
+    FAKE_SERVER.start(tick)
+    logger.info(
+        "serving fake Bitbar and Taskcluster on {}".format(FAKE_SERVER.get_url())
+    )
+    return FAKE_SERVER
@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import time
+
+import pytest
+import testdroid
+
+from mozilla_bitbar_devicepool import fake_server, taskcluster
+from mozilla_bitbar_devicepool.bitbar.ratelimit import RateLimitedTestdroid
+
+config = {
+    "projects": {
+        "defaults": {
+            "project_type": "GENERIC",
+            "application_file": "app.apk",
+            "test_file": "test.zip",
+            "archivingStrategy": "DAYS",
+            "archivingItemCount": 7,
+            "additional_parameters": {},
+        },
+        "test-1": {
+            "device_group_name": "group-1",
+            "framework_name": "framework-1",
+            "description": "test 1",
+            "additional_parameters": {"TC_WORKER_TYPE": "worker-1"},
+        },
+    },
+    "device_groups": {"group-1": {"device-01": None, "device-02": None}},
+}
+
+
+@pytest.fixture
+def server():
+    bitbar = fake_server.FakeBitbar(run_duration=10, pending_tasks=1, seed=1)
+    bitbar.load_configuration(config)
+    server = fake_server.FakeServer(("127.0.0.1", 0), bitbar)
+    # advance the simulation explicitly rather than from a thread.
+    server.simulate = lambda tick: None
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_fake_server(server, monkeypatch):
+    client = testdroid.Testdroid(apikey="fake-apikey", url=server.get_url())
+    assert client.get_me()["id"] == fake_server.USER_ID
+
+    device_groups = client.get(
+        "api/v2/me/device-groups",
+        payload={"limit": 0, "filter": ["s_displayname_eq_group-1"]},
+    )["data"]
+    assert [device_group["deviceCount"] for device_group in device_groups] == [2]
+    projects = client.get("api/v2/projects", payload={"limit": 0})["data"]
+    assert [project["name"] for project in projects] == ["1-test-1"]
+
+    test_configuration = {
+        "projectId": projects[0]["id"],
+        "deviceGroupId": device_groups[0]["id"],
+        "files": [],
+        "testRunParameters": [{"key": "TC_WORKER_TYPE", "value": "worker-1"}],
+    }
+    run_ids = [
+        client.post(
+            path="runs",
+            payload=json.dumps(test_configuration),
+            headers={"Content-type": "application/json"},
+        )["id"]
+        for _ in range(3)
+    ]
+
+    def get_states():
+        runs = client.get(
+            "api/v2/admin/runs",
+            payload={
+                "limit": 0,
+                "filter": [
+                    "d_endTime_isnull",
+                    "n_projectId_in_{}".format(projects[0]["id"]),
+                ],
+            },
+        )["data"]
+        return {run["id"]: run["state"] for run in runs}
+
+    assert set(get_states().values()) == {"WAITING"}
+
+    monkeypatch.setattr(taskcluster, "TASKCLUSTER_ROOT_URL", server.get_url())
+    assert taskcluster.get_taskcluster_pending_tasks("proj-autophone", "worker-1") == 1
+
+    # two devices: the first run claims the task, the second finds the
+    # queue empty and the third waits for a free device.
+    now = time.time()
+    server.bitbar.advance(now)
+    assert get_states() == {
+        run_ids[0]: "RUNNING",
+        run_ids[1]: "RUNNING",
+        run_ids[2]: "WAITING",
+    }
+    assert taskcluster.get_taskcluster_pending_tasks("proj-autophone", "worker-1") == 0
+
+    server.bitbar.advance(now + fake_server.IDLE_RUN_DURATION)
+    assert get_states() == {run_ids[0]: "RUNNING", run_ids[2]: "RUNNING"}
+    server.bitbar.advance(now + 60)
+    assert get_states() == {}
+    assert server.bitbar.stats == {
+        "runs_created": 3,
+        "runs_finished": 3,
+        "tasks_claimed": 1,
+    }
+    assert server.bitbar.get_state()["claim_latency"]["count"] == 1
+
+
+def test_fake_server_errors(server):
+    client = testdroid.Testdroid(apikey="fake-apikey", url=server.get_url())
+    with pytest.raises(testdroid.RequestResponseError) as e:
+        client.get("api/v2/projects/12345")
+    assert e.value.status_code == 404
+
+    server.set_faults(error_rate=1)
+    with pytest.raises(testdroid.RequestResponseError) as e:
+        client.get_me()
+    assert e.value.status_code == 503
+
+
+def test_fake_server_get_items(server):
+    client = RateLimitedTestdroid(apikey="fake-apikey", url=server.get_url())
+    devices = client.get_items(
+        "api/v2/devices", payload={"limit": 0, "filter": ["s_displayname_eq_device-02"]}
+    )
+    assert [device["displayName"] for device in devices] == ["device-02"]
+    with pytest.raises(testdroid.RequestResponseError) as e:
+        list(client.get_items("api/v2/unknown"))
+    assert e.value.status_code == 404
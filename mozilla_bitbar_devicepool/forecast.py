@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+
+# weight of the newest sample in the exponentially weighted moving
+# averages.
+ALPHA = 0.3
+# seconds assumed between starting a test run and it running until one
+# of the project's runs has been seen to start.
+START_LATENCY = 60
+
+
+class Ewma(object):
+    """Exponentially weighted moving average."""
+
+    def __init__(self, alpha=ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value = self.alpha * sample + (1 - self.alpha) * self.value
+        return self.value
+
+
+class BacklogForecaster(object):
+    """Forecast the tasks which will be queued for a worker type while a
+    test run started now waits for a device.
+
+    The arrival rate is an EWMA of the growth of the worker type's
+    pending count between polls. Tasks claimed during a poll interval
+    hide arrivals, so it underestimates a busy queue's rate, but reacts
+    to bursts such as a try push within one or two polls. The start
+    latency is an EWMA of the seconds between the manager starting one
+    of the project's test runs and the run leaving the WAITING state.
+    """
+
+    def __init__(self, alpha=ALPHA, start_latency=START_LATENCY):
+        self.alpha = alpha
+        self.start_latency = start_latency
+        self.lock = threading.Lock()
+        # (provisioner_id, worker_type) -> (timestamp, pending tasks)
+        self.pending_tasks = {}
+        # (provisioner_id, worker_type) -> Ewma of tasks per second
+        self.arrival_rates = {}
+        # project name -> Ewma of seconds
+        self.start_latencies = {}
+        # project name -> {test run id: seconds when it was started}
+        self.started_runs = {}
+
+    def observe_pending_tasks(self, pending_tasks, timestamp=None):
+        """Update the arrival rates from a poll of the pending tasks.
+
+        :param pending_tasks: dict mapping (provisioner_id, worker_type)
+                              to the number of pending tasks.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            for worker_key, pending in pending_tasks.items():
+                previous = self.pending_tasks.get(worker_key)
+                self.pending_tasks[worker_key] = (timestamp, pending)
+                if previous is None or timestamp <= previous[0]:
+                    continue
+                arrivals = max(0, pending - previous[1])
+                self.arrival_rates.setdefault(worker_key, Ewma(self.alpha)).update(
+                    arrivals / (timestamp - previous[0])
+                )
+
+    def run_started(self, project_name, run_id, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.started_runs.setdefault(project_name, {})[run_id] = timestamp
+
+    def observe_runs(self, project_name, runs, synced_at):
+        """Update the project's start latency from its active runs.
+
+        :param runs: list of the project's ActiveRun records.
+        :param synced_at: seconds when the active runs were requested.
+                          Runs started later may be missing from runs.
+        """
+        with self.lock:
+            started_runs = self.started_runs.get(project_name)
+            if not started_runs:
+                return
+            waiting = set(run.id for run in runs if run.state == "WAITING")
+            for run_id, started_at in list(started_runs.items()):
+                if run_id in waiting or started_at > synced_at:
+                    continue
+                # running, or already finished.
+                del started_runs[run_id]
+                self.start_latencies.setdefault(project_name, Ewma(self.alpha)).update(
+                    max(0, synced_at - started_at)
+                )
+
+    def get_start_latency(self, project_name):
+        with self.lock:
+            start_latency = self.start_latencies.get(project_name)
+            if start_latency is None:
+                return self.start_latency
+            return start_latency.value
+
+    def get_expected_arrivals(self, project_name, worker_key):
+        """Return the number of tasks expected to be queued for the
+        worker type during the project's start latency.
+        """
+        start_latency = self.get_start_latency(project_name)
+        with self.lock:
+            arrival_rate = self.arrival_rates.get(worker_key)
+            if arrival_rate is None:
+                return 0.0
+            return arrival_rate.value * start_latency
+
+    def remove_project(self, project_name):
+        with self.lock:
+            self.start_latencies.pop(project_name, None)
+            self.started_runs.pop(project_name, None)
@@ -0,0 +1,46 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool import forecast
+from mozilla_bitbar_devicepool.active_runs import ActiveRun
+
+worker_key = ("proj-autophone", "worker-1")
+
+
+def test_ewma():
+    ewma = forecast.Ewma(alpha=0.5)
+    assert ewma.update(10) == 10
+    assert ewma.update(0) == 5
+    assert ewma.update(5) == 5
+
+
+def test_backlog_forecaster():
+    forecaster = forecast.BacklogForecaster(alpha=0.5, start_latency=30)
+    assert forecaster.get_expected_arrivals("test-1", worker_key) == 0
+
+    # 20 tasks queued in 10 seconds, then none.
+    forecaster.observe_pending_tasks({worker_key: 0}, 100)
+    forecaster.observe_pending_tasks({worker_key: 20}, 110)
+    assert forecaster.get_expected_arrivals("test-1", worker_key) == 60
+    forecaster.observe_pending_tasks({worker_key: 5}, 120)
+    assert forecaster.get_expected_arrivals("test-1", worker_key) == 30
+
+    # run 1 started running within 10 seconds, run 2 is waiting and run
+    # 3 was started after the active runs were requested.
+    forecaster.run_started("test-1", 1, 200)
+    forecaster.run_started("test-1", 2, 200)
+    forecaster.run_started("test-1", 3, 215)
+    runs = [
+        ActiveRun(1, "test-1", "RUNNING", 200000, 205000),
+        ActiveRun(2, "test-1", "WAITING", 200000, None),
+    ]
+    forecaster.observe_runs("test-1", runs, 210)
+    assert forecaster.get_start_latency("test-1") == 10
+    assert sorted(forecaster.started_runs["test-1"]) == [2, 3]
+    assert forecaster.get_expected_arrivals("test-1", worker_key) == pytest.approx(10)
+
+    forecaster.remove_project("test-1")
+    assert forecaster.get_start_latency("test-1") == 30
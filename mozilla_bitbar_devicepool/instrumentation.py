@@ -0,0 +1,229 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import bisect
+import functools
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets. The last
+# bucket counts everything slower.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# endpoint -> EndpointStats
+ENDPOINT_STATS = {}
+_endpoint_stats_lock = threading.Lock()
+
+
+class EndpointStats(object):
+    """Latency histogram, error count and payload sizes of the calls to
+    one endpoint. The payload size is the number of records in the
+    response: the length of its 'data' list, or 1 for single objects.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.total_items = 0
+        self.max_items = 0
+
+    def record(self, seconds, items=0, error=False):
+        with self.lock:
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.count += 1
+            self.total_seconds += seconds
+            if seconds > self.max_seconds:
+                self.max_seconds = seconds
+            if error:
+                self.errors += 1
+            self.total_items += items
+            if items > self.max_items:
+                self.max_items = items
+
+    def get_stats(self, reset=False):
+        with self.lock:
+            stats = {
+                "buckets": list(self.buckets),
+                "count": self.count,
+                "errors": self.errors,
+                "total_seconds": self.total_seconds,
+                "max_seconds": self.max_seconds,
+                "total_items": self.total_items,
+                "max_items": self.max_items,
+            }
+            if reset:
+                self.reset()
+        return stats
+
+
+def get_endpoint_stats(endpoint):
+    endpoint_stats = ENDPOINT_STATS.get(endpoint)
+    if endpoint_stats is None:
+        with _endpoint_stats_lock:
+            endpoint_stats = ENDPOINT_STATS.setdefault(
+                endpoint, EndpointStats(endpoint)
+            )
+    return endpoint_stats
+
+
+def get_payload_items(result):
+    if result is None:
+        return 0
+    if isinstance(result, dict) and isinstance(result.get("data"), list):
+        return len(result["data"])
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def timed(endpoint):
+    """Decorator recording the latency, errors and payload size of each
+    call to the decorated API wrapper under endpoint.
+
+    Examples:
+       @timed("GET admin/device-problems")
+       def get_device_problems(device_model=None):
+           ...
+    """
+
+    def decorator(func):
+        endpoint_stats = get_endpoint_stats(endpoint)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                endpoint_stats.record(time.time() - start, error=True)
+                raise
+            endpoint_stats.record(time.time() - start, get_payload_items(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def timed_items(endpoint):
+    """Decorator like timed for API wrappers which are generators. The
+    latency is the time spent calling the wrapper and getting each of
+    its items, excluding the time the caller spends on the items between
+    them, and the payload size is the number of items yielded.
+
+    Examples:
+       @timed_items("GET devices")
+       def iter_devices(**kwargs):
+           ...
+    """
+
+    def decorator(func):
+        endpoint_stats = get_endpoint_stats(endpoint)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            elapsed = 0.0
+            items = 0
+            error = True
+            iterator = None
+            try:
+                start = time.time()
+                try:
+                    iterator = iter(func(*args, **kwargs))
+                finally:
+                    elapsed += time.time() - start
+                while True:
+                    start = time.time()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    finally:
+                        elapsed += time.time() - start
+                    items += 1
+                    yield item
+                error = False
+            except GeneratorExit:
+                # the caller stopped early.
+                error = False
+                raise
+            finally:
+                # release the request of a caller which stopped early.
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+                endpoint_stats.record(elapsed, items, error=error)
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats(reset=False):
+    """Return a dict of endpoint -> stats dicts for the endpoints which
+    have been called.
+
+    :param reset: if True, start new histograms after copying them.
+    """
+    with _endpoint_stats_lock:
+        endpoints = sorted(ENDPOINT_STATS.items())
+    stats = {}
+    for endpoint, endpoint_stats in endpoints:
+        endpoint_stat = endpoint_stats.get_stats(reset=reset)
+        if endpoint_stat["count"]:
+            stats[endpoint] = endpoint_stat
+    return stats
+
+
+def get_percentile(buckets, percentile):
+    """Return the upper bound of the histogram bucket containing the
+    percentile, or None if it is in the last, unbounded bucket.
+    """
+    target = sum(buckets) * percentile / 100.0
+    cumulative = 0
+    for upper_bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return upper_bound
+    return None
+
+
+def format_stats(stats=None):
+    """Return the endpoint stats as a list of lines suitable for logging."""
+    if stats is None:
+        stats = get_stats()
+    lines = [
+        "{:40s} {:>7s} {:>6s} {:>8s} {:>6s} {:>6s} {:>8s} {:>7s} {:>7s}".format(
+            "endpoint", "calls", "errors", "mean", "p50", "p99", "max", "items", "max"
+        )
+    ]
+    for endpoint, endpoint_stat in sorted(stats.items()):
+        percentiles = []
+        for percentile in (50, 99):
+            upper_bound = get_percentile(endpoint_stat["buckets"], percentile)
+            percentiles.append(
+                "<{}".format(upper_bound) if upper_bound is not None else "slow"
+            )
+        lines.append(
+            "{:40s} {:7d} {:6d} {:8.3f} {:>6s} {:>6s} {:8.3f} {:7.1f} {:7d}".format(
+                endpoint,
+                endpoint_stat["count"],
+                endpoint_stat["errors"],
+                endpoint_stat["total_seconds"] / endpoint_stat["count"],
+                percentiles[0],
+                percentiles[1],
+                endpoint_stat["max_seconds"],
+                endpoint_stat["total_items"] / endpoint_stat["count"],
+                endpoint_stat["max_items"],
+            )
+        )
+    return lines
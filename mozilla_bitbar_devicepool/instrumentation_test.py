@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool import instrumentation, metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_endpoint_stats(monkeypatch):
+    monkeypatch.setattr(instrumentation, "ENDPOINT_STATS", {})
+
+
+def test_timed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(instrumentation.time, "time", lambda: now[0])
+
+    @instrumentation.timed("GET devices")
+    def get_devices(fail=False):
+        now[0] += 0.3
+        if fail:
+            raise ValueError("failed")
+        return {"data": [{"id": 1}, {"id": 2}]}
+
+    assert get_devices() == {"data": [{"id": 1}, {"id": 2}]}
+    with pytest.raises(ValueError):
+        get_devices(fail=True)
+
+    stats = instrumentation.get_stats(reset=True)["GET devices"]
+    assert stats["count"] == 2
+    assert stats["errors"] == 1
+    assert stats["total_items"] == 2
+    assert stats["max_items"] == 2
+    assert stats["max_seconds"] == pytest.approx(0.3)
+    # both calls are in the 0.25 - 0.5 second bucket.
+    assert stats["buckets"][instrumentation.LATENCY_BUCKETS.index(0.5)] == 2
+    assert instrumentation.get_percentile(stats["buckets"], 99) == 0.5
+    assert instrumentation.get_stats() == {}
+
+
+def test_timed_items(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(instrumentation.time, "time", lambda: now[0])
+
+    @instrumentation.timed_items("GET devices")
+    def iter_devices():
+        for id in range(3):
+            now[0] += 0.1
+            yield {"id": id}
+
+    device_ids = []
+    for device in iter_devices():
+        # the caller's time is not included.
+        now[0] += 10
+        device_ids.append(device["id"])
+    assert device_ids == [0, 1, 2]
+    # stopping early is not an error.
+    devices = iter_devices()
+    next(devices)
+    devices.close()
+
+    stats = instrumentation.get_stats()["GET devices"]
+    assert stats["count"] == 2
+    assert stats["errors"] == 0
+    assert stats["total_items"] == 4
+    assert stats["max_seconds"] == pytest.approx(0.3)
+
+
+def test_format_and_export():
+    endpoint_stats = instrumentation.get_endpoint_stats("GET admin/runs")
+    endpoint_stats.record(0.04, items=10)
+    endpoint_stats.record(120, error=True)
+
+    lines = instrumentation.format_stats()
+    assert lines[0].split() == [
+        "endpoint",
+        "calls",
+        "errors",
+        "mean",
+        "p50",
+        "p99",
+        "max",
+        "items",
+        "max",
+    ]
+    assert lines[1].split()[:5] == ["GET", "admin/runs", "2", "1", "60.020"]
+    assert lines[1].split()[5:7] == ["<0.05", "slow"]
+
+    text = metrics.render().splitlines()
+    assert (
+        'bitbar_devicepool_request_duration_seconds_bucket{endpoint="GET admin/runs",le="0.05"} 1'
+        in text
+    )
+    assert (
+        'bitbar_devicepool_request_duration_seconds_bucket{endpoint="GET admin/runs",le="+Inf"} 2'
+        in text
+    )
+    assert 'bitbar_devicepool_request_errors_total{endpoint="GET admin/runs"} 1' in text
+    assert 'bitbar_devicepool_response_items_sum{endpoint="GET admin/runs"} 10' in text
@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# records buffered for the writer thread before new records are dropped.
+QUEUE_SIZE = 10000
+# seconds during which a repeated message with the same dedup_key is
+# suppressed.
+DEDUP_INTERVAL = 300
+
+_listener = None
+# formats the tracebacks of queued records, see AsyncHandler.prepare.
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line.
+
+    Besides the standard attributes, the project and fields attributes
+    passed to the logging call with extra, e.g.
+    logger.info("...", extra={"project": name, "fields": {"IDLE": 1}}),
+    are added to the object so that the per project counts can be
+    queried without parsing the message.
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        project = getattr(record, "project", None)
+        if project is not None:
+            data["project"] = project
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str, sort_keys=True)
+
+
+class DedupFilter(logging.Filter):
+    """Suppress repeats of records logged with a dedup_key in extra.
+
+    A record is dropped if the last record emitted with the same key had
+    the same message and was emitted less than interval seconds ago. The
+    next record emitted for the key reports how many were suppressed, so
+    a warning which repeats every queue pass, such as a project's offline
+    devices, is logged when it changes and then every interval seconds.
+    """
+
+    def __init__(self, interval=DEDUP_INTERVAL, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # dedup_key -> [message, seconds when emitted, suppressed count]
+        self.seen = {}
+
+    def filter(self, record):
+        key = getattr(record, "dedup_key", None)
+        if key is None or not self.interval:
+            return True
+        message = record.getMessage()
+        now = self.clock()
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen and seen[0] == message and now - seen[1] < self.interval:
+                seen[2] += 1
+                return False
+            suppressed = seen[2] if seen and seen[0] == message else 0
+            self.seen[key] = [message, now, 0]
+        if suppressed:
+            record.msg = "{} ({} repeats suppressed)".format(message, suppressed)
+            record.args = None
+        return True
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Queue records for a QueueListener writing them from its own thread,
+    so that logging never blocks the calling thread on a slow stream.
+
+    If the writer falls behind and the queue is full, records are dropped
+    rather than blocking, and a warning with the number of dropped records
+    is queued once there is room again.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """Return a copy of the record with its message merged with its
+        arguments and its traceback formatted. Unlike QueueHandler's, the
+        traceback is kept in exc_text rather than appended to the message,
+        so that the listener's formatters such as JsonFormatter place it
+        themselves.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(
+                    record.exc_info
+                )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        with self.dropped_lock:
+            if self.dropped:
+                warning = logging.LogRecord(
+                    record.name,
+                    logging.WARNING,
+                    __file__,
+                    0,
+                    "dropped %s log records while the log writer was busy",
+                    (self.dropped,),
+                    None,
+                )
+                try:
+                    self.queue.put_nowait(warning)
+                except queue.Full:
+                    self.dropped += 1
+                    return
+                self.dropped = 0
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+
+def setup_logging(json_format=False, dedup_interval=DEDUP_INTERVAL):
+    """Move the root logger's handlers behind an AsyncHandler whose
+    records are written by a background thread.
+
+    :param json_format: if True, write records with JsonFormatter.
+    :param dedup_interval: seconds during which repeated records logged
+                           with a dedup_key are suppressed. 0 disables
+                           the suppression.
+
+    The writer thread is stopped, after writing the queued records, when
+    the process exits. Returns the QueueListener.
+    """
+    global _listener
+
+    root = logging.getLogger()
+    if _listener is not None:
+        handlers = list(_listener.handlers)
+        stop_logging()
+    else:
+        handlers = list(root.handlers)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if json_format:
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+
+    handler = AsyncHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(DedupFilter(dedup_interval))
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(
+        handler.queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Write the queued records, stop the writer thread and restore the
+    root logger's handlers.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, AsyncHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+atexit.register(stop_logging)
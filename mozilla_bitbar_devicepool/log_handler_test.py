@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import logging
+import queue
+
+from mozilla_bitbar_devicepool import log_handler
+
+
+def make_record(msg, args=None, **extra):
+    record = logging.LogRecord("test", logging.WARNING, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter():
+    record = make_record(
+        "IDLE %s", (1,), project="project-a", fields={"IDLE": 1, "OFFLINE": 2}
+    )
+    data = json.loads(log_handler.JsonFormatter().format(record))
+    assert data["message"] == "IDLE 1"
+    assert data["level"] == "WARNING"
+    assert data["project"] == "project-a"
+    assert data["IDLE"] == 1
+    assert data["OFFLINE"] == 2
+
+
+def test_dedup_filter():
+    now = [0]
+    dedup = log_handler.DedupFilter(interval=10, clock=lambda: now[0])
+    key = ("project-a", "offline")
+
+    assert dedup.filter(make_record("no key"))
+    assert dedup.filter(make_record("no key"))
+
+    assert dedup.filter(make_record("OFFLINE 1", dedup_key=key))
+    now[0] = 5
+    assert not dedup.filter(make_record("OFFLINE 1", dedup_key=key))
+    assert not dedup.filter(make_record("OFFLINE 1", dedup_key=key))
+    # other keys are independent.
+    assert dedup.filter(make_record("OFFLINE 1", dedup_key=("project-b",)))
+    now[0] = 10
+    record = make_record("OFFLINE 1", dedup_key=key)
+    assert dedup.filter(record)
+    assert record.getMessage() == "OFFLINE 1 (2 repeats suppressed)"
+    # a changed message is logged immediately.
+    assert dedup.filter(make_record("OFFLINE 2", dedup_key=key))
+
+
+def test_async_handler_drops_when_full():
+    handler = log_handler.AsyncHandler(queue.Queue(2))
+    for i in range(4):
+        handler.enqueue(make_record("record %s", (i,)))
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 2
+
+    handler.queue.get_nowait()
+    handler.queue.get_nowait()
+    handler.enqueue(make_record("record 4"))
+    assert handler.dropped == 0
+    assert handler.queue.get_nowait().getMessage() == (
+        "dropped 2 log records while the log writer was busy"
+    )
+    assert handler.queue.get_nowait().getMessage() == "record 4"
+
+
+def test_setup_logging():
+    root = logging.getLogger()
+    saved_handlers = list(root.handlers)
+    stream = io.StringIO()
+    for handler in saved_handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.StreamHandler(stream))
+    try:
+        log_handler.setup_logging(json_format=True, dedup_interval=60)
+        for i in range(3):
+            root.warning(
+                "DISABLED 0 OFFLINE 1",
+                extra={"project": "project-a", "dedup_key": "project-a"},
+            )
+        log_handler.stop_logging()
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 1
+        data = json.loads(lines[0])
+        assert data["message"] == "DISABLED 0 OFFLINE 1"
+        assert data["project"] == "project-a"
+        assert "exception" not in data
+
+        log_handler.setup_logging(json_format=True)
+        try:
+            raise ValueError("bad response")
+        except ValueError:
+            root.error("request %s failed", "GET devices", exc_info=True)
+        log_handler.stop_logging()
+        data = json.loads(stream.getvalue().splitlines()[1])
+        assert data["message"] == "request GET devices failed"
+        assert data["exception"].startswith("Traceback")
+        assert "ValueError: bad response" in data["exception"]
+        assert not any(
+            isinstance(handler, log_handler.AsyncHandler) for handler in root.handlers
+        )
+    finally:
+        log_handler.stop_logging()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved_handlers:
+            root.addHandler(handler)
@@ -5,16 +5,25 @@
 import argparse
 import os
 import sys
+import time
 import zipfile
 
+import yaml
+
 from mozilla_bitbar_devicepool import (
     TESTDROID,
     configuration,
     logger,
     modulepath,
 )
+from mozilla_bitbar_devicepool.async_test_run_manager import AsyncTestRunManager
 from mozilla_bitbar_devicepool.bitbar.runs import run_test_for_project
-from mozilla_bitbar_devicepool.test_run_manager import TestRunManager
+from mozilla_bitbar_devicepool.log_handler import DEDUP_INTERVAL, setup_logging
+from mozilla_bitbar_devicepool.metrics import start_metrics_server
+from mozilla_bitbar_devicepool.test_run_manager import (
+    START_MAX_WORKERS,
+    TestRunManager,
+)
 from mozilla_bitbar_devicepool.util.network import download_file
 
 testdroid_apk_url = "https://github.com/bitbar/test-samples/raw/master/apps/android/testdroid-sample-app.apk"
@@ -51,18 +60,49 @@ def test_run_manager(args):
     else:
         bitbar_configpath = args.bitbar_config
 
+    if args.cache_snapshot == "":
+        cache_snapshot_path = os.path.join(args.files, "bitbar-cache.json")
+    else:
+        cache_snapshot_path = args.cache_snapshot
+
     try:
         configuration.configure(
-            bitbar_configpath, filespath=args.files, update_bitbar=args.update_bitbar
+            bitbar_configpath,
+            filespath=args.files,
+            update_bitbar=args.update_bitbar,
+            cache_snapshot_path=cache_snapshot_path,
+            cache_snapshot_max_age=args.cache_max_age,
         )
-    except configuration.DuplicateProjectException as e:
+    except configuration.ReconcileException as e:
+        if not e.has(configuration.DuplicateProjectException):
+            raise
         logger.error(
             "Duplicate project found! Please archive all but one and restart. Exiting..."
         )
         logger.error(e)
         sys.exit(1)
 
-    manager = TestRunManager(wait=args.wait)
+    if args.engine == "asyncio":
+        manager = AsyncTestRunManager(
+            wait=args.wait,
+            update_bitbar=args.update_bitbar,
+            watch_config=args.watch_config,
+            start_workers=args.start_workers,
+            max_workers=args.max_workers,
+            forecast=args.forecast,
+            allocate=args.allocate,
+        )
+    else:
+        manager = TestRunManager(
+            wait=args.wait,
+            update_bitbar=args.update_bitbar,
+            watch_config=args.watch_config,
+            start_workers=args.start_workers,
+            forecast=args.forecast,
+            allocate=args.allocate,
+        )
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port, args.metrics_address)
     manager.run()
 
 
@@ -86,6 +126,123 @@ def run_test(args):
     logger.info("run started for project '%s'" % args.project_name)
 
 
+def fake_server(args):
+    # the fake server is a testing tool, only loaded when it is used.
+    from mozilla_bitbar_devicepool.fake_server import (
+        FakeBitbar,
+        get_environment,
+        start_fake_server,
+    )
+
+    if args.bitbar_config is None:
+        bitbar_configpath = os.path.join(modulepath, "config", "config.yml")
+    else:
+        bitbar_configpath = args.bitbar_config
+    with open(bitbar_configpath) as bitbar_configfile:
+        config = yaml.load(bitbar_configfile.read(), Loader=yaml.SafeLoader)
+
+    bitbar = FakeBitbar(
+        run_duration=args.run_duration,
+        task_rate=args.task_rate,
+        pending_tasks=args.pending_tasks,
+        offline_fraction=args.offline_fraction,
+        seed=args.seed,
+    )
+    bitbar.load_configuration(config, populate=not args.empty)
+    server = start_fake_server(
+        bitbar,
+        port=args.port,
+        address=args.address,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    for name, value in sorted(get_environment(config, server.get_url()).items()):
+        logger.info("export {}={}".format(name, value))
+
+    try:
+        while True:
+            time.sleep(args.report_interval)
+            logger.info("fake server: {}".format(bitbar.get_state()))
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def benchmark(args):
+    # the benchmark is a testing tool, only loaded when it is used.
+    from mozilla_bitbar_devicepool.benchmark import (
+        CYCLES,
+        LATENCY_SECONDS,
+        REGRESSION_THRESHOLD,
+        REQUESTS_PER_SECOND,
+        RUN_DURATION,
+        SCENARIOS,
+        UTILIZATION,
+        WAIT,
+        compare_results,
+        format_record,
+        get_previous_record,
+        load_results,
+        parse_scenario,
+        run_scenario,
+        save_result,
+    )
+
+    defaults = {
+        "cycles": CYCLES,
+        "wait": WAIT,
+        "latency_seconds": LATENCY_SECONDS,
+        "run_duration": RUN_DURATION,
+        "utilization": UTILIZATION,
+        "requests_per_second": REQUESTS_PER_SECOND,
+        "threshold": REGRESSION_THRESHOLD,
+    }
+    for name, default in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    try:
+        scenarios = [
+            parse_scenario(scenario) for scenario in args.scenarios or SCENARIOS
+        ]
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    if args.results is None:
+        results_path = os.path.join(args.files, "benchmark-results.jsonl")
+    else:
+        results_path = args.results
+
+    records = load_results(results_path)
+    regressions = 0
+    for scenario in scenarios:
+        record = run_scenario(
+            scenario,
+            cycles=args.cycles,
+            wait=args.wait,
+            latency_seconds=args.latency_seconds,
+            run_duration=args.run_duration,
+            utilization=args.utilization,
+            requests_per_second=args.requests_per_second,
+            seed=args.seed,
+        )
+        previous = get_previous_record(records, record)
+        for line in format_record(record, previous, args.threshold):
+            logger.info(line)
+        if previous is not None:
+            regressions += sum(
+                regression
+                for _name, _previous, _value, _change, regression in compare_results(
+                    previous["results"], record["results"], args.threshold
+                )
+            )
+        save_result(results_path, record)
+        records.append(record)
+    logger.info("benchmark results saved to {}".format(results_path))
+    if regressions and args.fail_on_regression:
+        logger.error("{} benchmark results regressed".format(regressions))
+        sys.exit(1)
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -100,11 +257,27 @@ start the test_run_manager.
 TESTDROID_URL
 TESTDROID_APIKEY
 
+TASKCLUSTER_ROOT_URL optionally selects a Taskcluster deployment other
+than https://firefox-ci-tc.services.mozilla.com, such as the one
+simulated by start-fake-server.
+
 To get additional help for each positional sub-command, add
 --help to the sub-command.
 
 Controlling the test_run_manager via signals:
 
+Reload Configuration
+    kill -HUP <pid>
+
+    Reload the Bitbar configuration file, reconciling and restarting
+    only the changed projects and device groups.
+
+Log Request Statistics
+    kill -USR1 <pid>
+
+    Log the latency histograms, error counts and payload sizes of the
+    Bitbar and Taskcluster requests.
+
 Stop Now
     kill -USR2 <pid>
 
@@ -130,6 +303,23 @@ Terminate Now
         default="INFO",
         help="Logging level. Defaults to INFO.",
     )
+    parser.add_argument(
+        "--log-format",
+        dest="log_format",
+        choices=["text", "json"],
+        default="text",
+        help="Write log records as text or as one JSON object per line with "
+        "the project and its counts as fields. Defaults to text.",
+    )
+    parser.add_argument(
+        "--log-dedup-interval",
+        dest="log_dedup_interval",
+        type=int,
+        default=DEDUP_INTERVAL,
+        help="Seconds during which repeated warnings such as a project's "
+        "offline devices are suppressed. 0 logs every repeat. "
+        "Defaults to %s." % DEDUP_INTERVAL,
+    )
 
     subparsers = parser.add_subparsers(
         help="Specify one of the positional arguments to select the command to execute."
@@ -176,12 +366,90 @@ Terminate Now
         default=20,
         help="Seconds to wait between checks. Defaults to 20.",
     )
+    subparser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Run each project in its own thread or as coroutines on a "
+        "single event loop. Defaults to threads.",
+    )
+    subparser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=8,
+        help="Number of threads used for Bitbar and Taskcluster requests "
+        "by the asyncio engine. Defaults to 8.",
+    )
+    subparser.add_argument(
+        "--start-workers",
+        dest="start_workers",
+        type=int,
+        default=START_MAX_WORKERS,
+        help="Maximum number of test runs started concurrently. "
+        "Defaults to %s." % START_MAX_WORKERS,
+    )
+    subparser.add_argument(
+        "--forecast",
+        action="store_true",
+        default=False,
+        help="Also start test runs for the tasks expected to be queued while "
+        "they wait for a device, forecast from the recent growth of the "
+        "pending tasks and the time test runs take to start.",
+    )
+    subparser.add_argument(
+        "--allocate",
+        action="store_true",
+        default=False,
+        help="Divide the idle devices of each device model between the "
+        "projects sharing them by priority and share rather than letting "
+        "each project start test runs independently.",
+    )
     subparser.add_argument(
         "--update-bitbar",
         action="store_true",
         default=False,
         help="Update the remote bitbar configuration to reflect the config file.",
     )
+    subparser.add_argument(
+        "--cache-snapshot",
+        dest="cache_snapshot",
+        nargs="?",
+        const="",
+        default=None,
+        help="Load and save a snapshot of the Bitbar cache for warm restarts. "
+        "The path defaults to bitbar-cache.json in the files directory. "
+        "Disabled by default.",
+    )
+    subparser.add_argument(
+        "--cache-max-age",
+        dest="cache_max_age",
+        type=int,
+        default=configuration.CACHE_SNAPSHOT_MAX_AGE,
+        help="Maximum age in seconds of cache snapshot entries. "
+        "Defaults to %s." % configuration.CACHE_SNAPSHOT_MAX_AGE,
+    )
+    subparser.add_argument(
+        "--watch-config",
+        dest="watch_config",
+        action="store_true",
+        default=False,
+        help="Reload the Bitbar configuration file when it is modified. "
+        "The configuration is always reloaded on SIGHUP.",
+    )
+    subparser.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        type=int,
+        help="Serve Prometheus metrics on this port at /metrics. "
+        "Disabled by default.",
+    )
+    subparser.add_argument(
+        "--metrics-address",
+        dest="metrics_address",
+        default="127.0.0.1",
+        help="Address the metrics endpoint listens on. Defaults to 127.0.0.1.",
+    )
     subparser.set_defaults(func=test_run_manager)
 
     ### run-test ###
@@ -204,9 +472,177 @@ Terminate Now
     )
     subparser.set_defaults(func=run_test)
 
+    ### start-fake-server ###
+    subparser = subparsers.add_parser(
+        "start-fake-server",
+        help="Serve a simulated Bitbar and Taskcluster for load testing.",
+    )
+    subparser.add_argument(
+        "--bitbar-config",
+        help="Path to Bitbar yaml configuration file from which the devices, "
+        "device groups, projects and worker types are created.",
+    )
+    subparser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="Port to listen on. Defaults to 8080.",
+    )
+    subparser.add_argument(
+        "--address",
+        default="127.0.0.1",
+        help="Address to listen on. Defaults to 127.0.0.1.",
+    )
+    subparser.add_argument(
+        "--empty",
+        action="store_true",
+        default=False,
+        help="Only create the devices and frameworks, leaving the device "
+        "groups, files and projects to start-test-run-manager --update-bitbar.",
+    )
+    subparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds added to each response. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Maximum random seconds added to the latency. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--error-rate",
+        dest="error_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with a 503. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--run-duration",
+        dest="run_duration",
+        type=float,
+        default=60,
+        help="Mean seconds a test run which claimed a task runs. Defaults to 60.",
+    )
+    subparser.add_argument(
+        "--pending-tasks",
+        dest="pending_tasks",
+        type=int,
+        default=0,
+        help="Initial pending tasks per worker type. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--task-rate",
+        dest="task_rate",
+        type=float,
+        default=0.0,
+        help="New tasks per second per worker type. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--offline-fraction",
+        dest="offline_fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of the devices reported offline. Defaults to 0.",
+    )
+    subparser.add_argument(
+        "--seed", type=int, help="Random seed for a reproducible fleet."
+    )
+    subparser.add_argument(
+        "--report-interval",
+        dest="report_interval",
+        type=int,
+        default=60,
+        help="Seconds between logs of the simulation state. Defaults to 60.",
+    )
+    subparser.set_defaults(func=fake_server)
+
+    ### benchmark ###
+    subparser = subparsers.add_parser(
+        "benchmark",
+        help="Benchmark the test run manager against the fake server.",
+    )
+    subparser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        help="<projects>x<devices per project>x<active runs> to measure. "
+        "May be repeated. Defaults to the benchmark's SCENARIOS.",
+    )
+    # the defaults are the benchmark module's constants, applied by the
+    # benchmark handler so that the module is only imported when used.
+    subparser.add_argument(
+        "--cycles",
+        type=int,
+        help="Passes of each scheduling loop to measure. "
+        "Defaults to the benchmark's CYCLES.",
+    )
+    subparser.add_argument(
+        "--wait",
+        type=int,
+        help="The manager's --wait. Defaults to the benchmark's WAIT.",
+    )
+    subparser.add_argument(
+        "--latency-seconds",
+        dest="latency_seconds",
+        type=float,
+        help="Seconds the manager runs to measure the latency between "
+        "tasks being queued and claimed. Defaults to the benchmark's "
+        "LATENCY_SECONDS.",
+    )
+    subparser.add_argument(
+        "--run-duration",
+        dest="run_duration",
+        type=float,
+        help="Mean seconds a simulated test run takes. "
+        "Defaults to the benchmark's RUN_DURATION.",
+    )
+    subparser.add_argument(
+        "--utilization",
+        type=float,
+        help="Fraction of each device group kept busy by the queued tasks. "
+        "Defaults to the benchmark's UTILIZATION.",
+    )
+    subparser.add_argument(
+        "--requests-per-second",
+        dest="requests_per_second",
+        type=float,
+        help="Bitbar request rate limit. "
+        "Defaults to the benchmark's REQUESTS_PER_SECOND.",
+    )
+    subparser.add_argument(
+        "--seed", type=int, help="Random seed for the simulated test runs."
+    )
+    subparser.add_argument(
+        "--results",
+        help="Path of the json lines file the results are appended to. "
+        "Defaults to benchmark-results.jsonl in the files directory.",
+    )
+    subparser.add_argument(
+        "--threshold",
+        type=float,
+        help="Relative increase over the previous version reported as a "
+        "regression. Defaults to the benchmark's REGRESSION_THRESHOLD.",
+    )
+    subparser.add_argument(
+        "--fail-on-regression",
+        dest="fail_on_regression",
+        action="store_true",
+        default=False,
+        help="Exit with status 1 if any result regressed.",
+    )
+    subparser.set_defaults(func=benchmark)
+
     args = parser.parse_args()
 
     logger.setLevel(level=args.log_level)
+    # log records are written by a background thread.
+    setup_logging(
+        json_format=args.log_format == "json",
+        dedup_interval=args.log_dedup_interval,
+    )
 
     try:
         func = args.func
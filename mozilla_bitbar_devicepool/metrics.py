@@ -0,0 +1,284 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from mozilla_bitbar_devicepool import instrumentation, logger
+from mozilla_bitbar_devicepool.bitbar.ratelimit import (
+    get_state as get_rate_limiter_state,
+)
+
+PROJECT_STATS = ("COUNT", "IDLE", "OFFLINE", "DISABLED", "RUNNING", "WAITING")
+
+# The scheduler publishes copies of its state here. Each entry is replaced
+# as a whole, so the metrics endpoint never needs the per project locks.
+# project name -> {'stats': {...}, 'jobs_to_start': int}
+PROJECTS = {}
+# (provisioner_id, worker_type) -> pending tasks
+PENDING_TASKS = {}
+# counter name -> {project name: count}
+COUNTERS = {"runs_started": {}, "run_start_failures": {}}
+# loop name -> {'last': seconds, 'sum': seconds, 'count': iterations}
+LOOP_DURATIONS = {}
+_metrics_lock = threading.Lock()
+
+METRICS_SERVER = None
+
+
+def set_project_stats(project_name, stats, jobs_to_start=None):
+    """Publish a copy of the project's stats.
+
+    :param stats: StatsSnapshot of the project's stats.
+    """
+    project = {"stats": {stat: stats[stat] for stat in PROJECT_STATS}}
+    if jobs_to_start is None:
+        jobs_to_start = PROJECTS.get(project_name, {}).get("jobs_to_start", 0)
+    project["jobs_to_start"] = jobs_to_start
+    PROJECTS[project_name] = project
+
+
+def remove_project(project_name):
+    PROJECTS.pop(project_name, None)
+    with _metrics_lock:
+        for counter in COUNTERS.values():
+            counter.pop(project_name, None)
+
+
+def set_pending_tasks(pending_tasks):
+    global PENDING_TASKS
+
+    PENDING_TASKS = dict(pending_tasks)
+
+
+def increment(counter_name, project_name, value=1):
+    with _metrics_lock:
+        counter = COUNTERS[counter_name]
+        counter[project_name] = counter.get(project_name, 0) + value
+
+
+def observe_loop(loop_name, seconds):
+    """Record the duration of one iteration of a scheduler loop."""
+    with _metrics_lock:
+        loop = LOOP_DURATIONS.setdefault(loop_name, {"last": 0, "sum": 0, "count": 0})
+        loop["last"] = seconds
+        loop["sum"] += seconds
+        loop["count"] += 1
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name, labels, value):
+    if labels:
+        label_text = ",".join(
+            '{}="{}"'.format(label, escape_label_value(label_value))
+            for label, label_value in labels
+        )
+        return "{}{{{}}} {}".format(name, label_text, value)
+    return "{} {}".format(name, value)
+
+
+def render():
+    """Return the metrics in the Prometheus text exposition format."""
+    with _metrics_lock:
+        counters = {
+            counter_name: dict(counter) for counter_name, counter in COUNTERS.items()
+        }
+        loop_durations = {
+            loop_name: dict(loop) for loop_name, loop in LOOP_DURATIONS.items()
+        }
+    projects = dict(PROJECTS)
+    pending_tasks = PENDING_TASKS
+    breakers = get_rate_limiter_state()["breakers"]
+    endpoint_stats = instrumentation.get_stats()
+
+    metrics = [
+        (
+            "bitbar_devicepool_project_devices",
+            "gauge",
+            "Devices of the project's device group by state.",
+            [
+                ((("project", project_name), ("state", stat)), value)
+                for project_name in sorted(projects)
+                for stat, value in projects[project_name]["stats"].items()
+            ],
+        ),
+        (
+            "bitbar_devicepool_project_jobs_to_start",
+            "gauge",
+            "Test runs to start computed by the last queue pass.",
+            [
+                ((("project", project_name),), projects[project_name]["jobs_to_start"])
+                for project_name in sorted(projects)
+            ],
+        ),
+        (
+            "bitbar_devicepool_runs_started_total",
+            "counter",
+            "Test runs started.",
+            [
+                ((("project", project_name),), value)
+                for project_name, value in sorted(counters["runs_started"].items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_run_start_failures_total",
+            "counter",
+            "Test runs which failed to start.",
+            [
+                ((("project", project_name),), value)
+                for project_name, value in sorted(
+                    counters["run_start_failures"].items()
+                )
+            ],
+        ),
+        (
+            "bitbar_devicepool_pending_tasks",
+            "gauge",
+            "Pending Taskcluster tasks by worker type.",
+            [
+                (
+                    (("provisioner_id", provisioner_id), ("worker_type", worker_type)),
+                    value,
+                )
+                for (provisioner_id, worker_type), value in sorted(
+                    pending_tasks.items()
+                )
+            ],
+        ),
+        (
+            "bitbar_devicepool_loop_last_duration_seconds",
+            "gauge",
+            "Duration of the last iteration of each scheduler loop.",
+            [
+                ((("loop", loop_name),), loop["last"])
+                for loop_name, loop in sorted(loop_durations.items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_loop_duration_seconds",
+            "summary",
+            "Duration of the iterations of each scheduler loop.",
+            [
+                ((("loop", loop_name),), loop)
+                for loop_name, loop in sorted(loop_durations.items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_circuit_breaker_open",
+            "gauge",
+            "1 if the circuit breaker for the Bitbar endpoint class is not closed.",
+            [
+                (
+                    (("endpoint_class", endpoint_class),),
+                    int(breaker["state"] != "CLOSED"),
+                )
+                for endpoint_class, breaker in sorted(breakers.items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_request_duration_seconds",
+            "histogram",
+            "Duration of the Bitbar and Taskcluster requests by endpoint.",
+            [
+                ((("endpoint", endpoint),), endpoint_stat)
+                for endpoint, endpoint_stat in sorted(endpoint_stats.items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_request_errors_total",
+            "counter",
+            "Bitbar and Taskcluster requests which raised an exception by endpoint.",
+            [
+                ((("endpoint", endpoint),), endpoint_stat["errors"])
+                for endpoint, endpoint_stat in sorted(endpoint_stats.items())
+            ],
+        ),
+        (
+            "bitbar_devicepool_response_items",
+            "summary",
+            "Records returned by the Bitbar and Taskcluster requests by endpoint.",
+            [
+                (
+                    (("endpoint", endpoint),),
+                    {
+                        "sum": endpoint_stat["total_items"],
+                        "count": endpoint_stat["count"],
+                    },
+                )
+                for endpoint, endpoint_stat in sorted(endpoint_stats.items())
+            ],
+        ),
+    ]
+
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples:
+            if metric_type == "summary":
+                lines.append(format_sample(name + "_sum", labels, value["sum"]))
+                lines.append(format_sample(name + "_count", labels, value["count"]))
+            elif metric_type == "histogram":
+                cumulative = 0
+                for upper_bound, bucket_count in zip(
+                    instrumentation.LATENCY_BUCKETS + ("+Inf",), value["buckets"]
+                ):
+                    cumulative += bucket_count
+                    lines.append(
+                        format_sample(
+                            name + "_bucket",
+                            labels + (("le", upper_bound),),
+                            cumulative,
+                        )
+                    )
+                lines.append(
+                    format_sample(name + "_sum", labels, value["total_seconds"])
+                )
+                lines.append(format_sample(name + "_count", labels, value["count"]))
+            else:
+                lines.append(format_sample(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format % args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, address="127.0.0.1"):
+    """Serve the metrics at http://address:port/metrics from a daemon
+    thread.
+    """
+    global METRICS_SERVER
+
+    METRICS_SERVER = MetricsServer((address, port), MetricsRequestHandler)
+    thread = threading.Thread(
+        target=METRICS_SERVER.serve_forever, name="metrics", daemon=True
+    )
+    thread.start()
+    logger.info(
+        "serving metrics on http://{}:{}/metrics".format(
+            address, METRICS_SERVER.server_address[1]
+        )
+    )
+    return METRICS_SERVER
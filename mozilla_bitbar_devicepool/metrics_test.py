@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+import requests
+
+from mozilla_bitbar_devicepool import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "PROJECTS", {})
+    monkeypatch.setattr(metrics, "PENDING_TASKS", {})
+    monkeypatch.setattr(
+        metrics, "COUNTERS", {"runs_started": {}, "run_start_failures": {}}
+    )
+    monkeypatch.setattr(metrics, "LOOP_DURATIONS", {})
+
+
+def test_render():
+    stats = {
+        "COUNT": 10,
+        "IDLE": 4,
+        "OFFLINE": 1,
+        "OFFLINE_DEVICES": ["pixel2-01"],
+        "DISABLED": 0,
+        "RUNNING": 5,
+        "WAITING": 2,
+    }
+    metrics.set_project_stats("test-1", stats, jobs_to_start=3)
+    # a stats only update keeps the last jobs_to_start.
+    metrics.set_project_stats("test-1", stats)
+    metrics.increment("runs_started", "test-1", 3)
+    metrics.increment("run_start_failures", "test-1")
+    metrics.set_pending_tasks({("proj-autophone", "gecko-t-bitbar-gw-unit-p2"): 7})
+    metrics.observe_loop("active_runs", 0.5)
+    metrics.observe_loop("active_runs", 1.5)
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE bitbar_devicepool_project_devices gauge" in lines
+    assert 'bitbar_devicepool_project_devices{project="test-1",state="IDLE"} 4' in lines
+    assert 'bitbar_devicepool_project_jobs_to_start{project="test-1"} 3' in lines
+    assert 'bitbar_devicepool_runs_started_total{project="test-1"} 3' in lines
+    assert 'bitbar_devicepool_run_start_failures_total{project="test-1"} 1' in lines
+    assert (
+        'bitbar_devicepool_pending_tasks{provisioner_id="proj-autophone",'
+        'worker_type="gecko-t-bitbar-gw-unit-p2"} 7' in lines
+    )
+    assert (
+        'bitbar_devicepool_loop_last_duration_seconds{loop="active_runs"} 1.5' in lines
+    )
+    assert (
+        'bitbar_devicepool_loop_duration_seconds_sum{loop="active_runs"} 2.0' in lines
+    )
+    assert (
+        'bitbar_devicepool_loop_duration_seconds_count{loop="active_runs"} 2' in lines
+    )
+    assert 'bitbar_devicepool_circuit_breaker_open{endpoint_class="runs"} 0' in lines
+
+    metrics.remove_project("test-1")
+    assert "test-1" not in metrics.render()
+
+
+def test_metrics_server():
+    server = metrics.start_metrics_server(0)
+    try:
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        response = requests.get(url + "/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert "bitbar_devicepool_circuit_breaker_open" in response.text
+        assert requests.get(url + "/other").status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
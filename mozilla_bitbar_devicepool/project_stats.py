@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+
+STATS = (
+    "COUNT",
+    "IDLE",
+    "OFFLINE_DEVICES",
+    "OFFLINE",
+    "DISABLED",
+    "RUNNING",
+    "WAITING",
+)
+
+
+class StatsSnapshot(namedtuple("StatsSnapshot", ("version",) + STATS)):
+    """Immutable copy of a project's stats as of a version."""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        # stats are read by name, e.g. snapshot["WAITING"].
+        if isinstance(key, str):
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+
+class ProjectStats(object):
+    """Device and test run counts of a project.
+
+    The counts are updated by their writers while holding the project's
+    lock, which then publish them as a new immutable StatsSnapshot. The
+    snapshot is replaced by a single assignment, so readers of snapshot
+    such as logging and metrics never need the lock and never see a half
+    updated set of counts.
+    """
+
+    __slots__ = STATS + ("snapshot",)
+
+    def __init__(self, **stats):
+        self.COUNT = 0
+        self.IDLE = 0
+        self.OFFLINE_DEVICES = ()
+        self.OFFLINE = 0
+        self.DISABLED = 0
+        self.RUNNING = 0
+        self.WAITING = 0
+        self.snapshot = None
+        self.update(stats)
+        self.publish()
+
+    def __getitem__(self, key):
+        if key not in STATS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in STATS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def update(self, stats):
+        for key, value in stats.items():
+            self[key] = value
+
+    def publish(self):
+        """Publish the current counts. Must be called with the project's
+        lock held after each set of updates.
+        """
+        version = self.snapshot.version + 1 if self.snapshot else 0
+        self.snapshot = StatsSnapshot(
+            version,
+            self.COUNT,
+            self.IDLE,
+            tuple(self.OFFLINE_DEVICES),
+            self.OFFLINE,
+            self.DISABLED,
+            self.RUNNING,
+            self.WAITING,
+        )
+        return self.snapshot
@@ -0,0 +1,33 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool.project_stats import ProjectStats
+
+
+def test_project_stats():
+    stats = ProjectStats(COUNT=10)
+    snapshot = stats.snapshot
+    assert snapshot.version == 0
+    assert snapshot["COUNT"] == 10
+    assert snapshot.OFFLINE_DEVICES == ()
+
+    stats["RUNNING"] = 2
+    stats.update({"IDLE": 8, "OFFLINE_DEVICES": ["pixel2-01"]})
+    # readers see the previous snapshot until the updates are published.
+    assert stats.snapshot is snapshot
+    assert snapshot.RUNNING == 0
+
+    snapshot = stats.publish()
+    assert stats.snapshot is snapshot
+    assert snapshot.version == 1
+    assert (snapshot.RUNNING, snapshot.IDLE) == (2, 8)
+    assert snapshot.OFFLINE_DEVICES == ("pixel2-01",)
+    with pytest.raises(AttributeError):
+        snapshot.RUNNING = 3
+    with pytest.raises(KeyError):
+        stats["UNKNOWN"] = 1
+    with pytest.raises(AttributeError):
+        stats.UNKNOWN = 1
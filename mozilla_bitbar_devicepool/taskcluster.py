@@ -2,15 +2,200 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from mozilla_bitbar_devicepool import logger
+from mozilla_bitbar_devicepool.instrumentation import timed
+
+TASKCLUSTER_ROOT_URL = os.environ.get(
+    "TASKCLUSTER_ROOT_URL", "https://firefox-ci-tc.services.mozilla.com"
+)
+
+# seconds to wait for the connection to be established and for the
+# response to be read.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_ATTEMPTS = 3
+# base delay in seconds for the randomized exponential backoff between attempts.
+RETRY_BACKOFF = 1
+
+SESSION = None
+SESSION_POOL_SIZE = 8
+_session_lock = threading.Lock()
+
+_latency_lock = threading.Lock()
+LATENCY_STATS = {
+    "requests": 0,
+    "errors": 0,
+    "retries": 0,
+    "total_seconds": 0.0,
+    "max_seconds": 0.0,
+}
+
+
+def _create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def configure_session(pool_size=SESSION_POOL_SIZE):
+    """Create the shared keep-alive session used to talk to Taskcluster.
+
+    :param pool_size: integer maximum number of connections kept open.
+                      Should match the number of threads making requests.
+    """
+    global SESSION, SESSION_POOL_SIZE
+
+    pool_size = max(1, pool_size)
+    session = _create_session(pool_size)
+    with _session_lock:
+        old_session = SESSION
+        SESSION = session
+        SESSION_POOL_SIZE = pool_size
+    if old_session:
+        old_session.close()
+    return session
+
+
+def get_session():
+    """Return the shared Taskcluster session, creating it if needed."""
+    global SESSION
+
+    if SESSION is None:
+        with _session_lock:
+            if SESSION is None:
+                SESSION = _create_session(SESSION_POOL_SIZE)
+    return SESSION
 
 
-def get_taskcluster_pending_tasks(provisioner_id, worker_type):
-    taskcluster_queue_url = (
-        "https://firefox-ci-tc.services.mozilla.com/api/queue/v1/pending/%s/%s"
-        % (provisioner_id, worker_type)
+def record_latency(seconds, error=False, retry=False):
+    with _latency_lock:
+        LATENCY_STATS["requests"] += 1
+        LATENCY_STATS["total_seconds"] += seconds
+        if seconds > LATENCY_STATS["max_seconds"]:
+            LATENCY_STATS["max_seconds"] = seconds
+        if error:
+            LATENCY_STATS["errors"] += 1
+        if retry:
+            LATENCY_STATS["retries"] += 1
+
+
+def get_latency_stats(reset=False):
+    """Return a copy of the Taskcluster request latency counters.
+
+    :param reset: if True, zero the counters after copying them.
+    """
+    with _latency_lock:
+        stats = dict(LATENCY_STATS)
+        if reset:
+            for key in LATENCY_STATS:
+                LATENCY_STATS[key] = type(LATENCY_STATS[key])()
+    return stats
+
+
+@timed("GET taskcluster queue/v1/pending/{provisioner_id}/{worker_type}")
+def get_taskcluster_pending_tasks(
+    provisioner_id,
+    worker_type,
+    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+    max_attempts=MAX_ATTEMPTS,
+):
+    """Return the number of pending tasks for a worker type.
+
+    :param provisioner_id: string Taskcluster provisioner id.
+    :param worker_type: string Taskcluster worker type.
+    :param timeout: tuple of (connect, read) timeouts in seconds.
+    :param max_attempts: integer number of attempts made when the
+                         request times out, fails to connect or
+                         returns a server error.
+
+    Raises requests.ConnectionError or requests.Timeout if the last
+    attempt fails to complete. Returns 0 if Taskcluster responds with an
+    error or with a body which isn't the expected JSON.
+    """
+    taskcluster_queue_url = "%s/api/queue/v1/pending/%s/%s" % (
+        TASKCLUSTER_ROOT_URL,
+        provisioner_id,
+        worker_type,
     )
-    r = requests.get(taskcluster_queue_url)
-    if r.ok:
-        return r.json()["pendingTasks"]
+    session = get_session()
+    for attempt in range(max_attempts):
+        last_attempt = attempt == max_attempts - 1
+        start = time.time()
+        try:
+            r = session.get(taskcluster_queue_url, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            record_latency(time.time() - start, error=True, retry=not last_attempt)
+            if last_attempt:
+                raise
+        else:
+            server_error = r.status_code >= 500
+            record_latency(
+                time.time() - start,
+                error=not r.ok,
+                retry=server_error and not last_attempt,
+            )
+            if r.ok:
+                try:
+                    return r.json()["pendingTasks"]
+                except (KeyError, ValueError) as e:
+                    logger.warning(
+                        "invalid response from {}: {}".format(taskcluster_queue_url, e)
+                    )
+                    return 0
+            if not server_error or last_attempt:
+                return 0
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
     return 0
+
+
+def get_taskcluster_pending_tasks_for_worker_types(worker_types, max_workers=None):
+    """Return the pending task counts for several worker types at once.
+
+    :param worker_types: iterable of (provisioner_id, worker_type) tuples.
+                         Duplicates are only queried once.
+    :param max_workers: maximum number of concurrent requests. Defaults
+                        to the size of the session's connection pool.
+
+    Returns a dict mapping (provisioner_id, worker_type) to the number
+    of pending tasks. Worker types which could not be queried due to a
+    connection error or timeout are reported as having 0 pending tasks.
+
+    Examples:
+       get_taskcluster_pending_tasks_for_worker_types(
+           [('proj-autophone', 'gecko-t-bitbar-gw-unit-p2')])
+    """
+    worker_types = sorted(set(worker_types))
+    if not worker_types:
+        return {}
+    if max_workers is None:
+        max_workers = SESSION_POOL_SIZE
+
+    def get_pending_tasks(worker_key):
+        try:
+            return get_taskcluster_pending_tasks(*worker_key)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(
+                "exception raised when calling get_taskcluster_pending_tasks for {}.".format(
+                    worker_key[1]
+                )
+            )
+            logger.warning(e)
+            return 0
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(worker_types)),
+        thread_name_prefix="taskcluster",
+    ) as executor:
+        pending_tasks = executor.map(get_pending_tasks, worker_types)
+        return dict(zip(worker_types, pending_tasks))
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import requests
+
+from mozilla_bitbar_devicepool import taskcluster
+
+
+def test_pending_tasks_for_worker_types_deduplicates(monkeypatch):
+    calls = []
+
+    def fake_get_taskcluster_pending_tasks(provisioner_id, worker_type):
+        calls.append((provisioner_id, worker_type))
+        return len(worker_type)
+
+    monkeypatch.setattr(
+        taskcluster, "get_taskcluster_pending_tasks", fake_get_taskcluster_pending_tasks
+    )
+    result = taskcluster.get_taskcluster_pending_tasks_for_worker_types(
+        [("prov", "wt-a"), ("prov", "wt-bb"), ("prov", "wt-a")]
+    )
+    assert result == {("prov", "wt-a"): 4, ("prov", "wt-bb"): 5}
+    assert sorted(calls) == [("prov", "wt-a"), ("prov", "wt-bb")]
+
+
+def test_pending_tasks_for_worker_types_connection_error(monkeypatch):
+    def fake_get_taskcluster_pending_tasks(provisioner_id, worker_type):
+        raise requests.ConnectionError("boom")
+
+    monkeypatch.setattr(
+        taskcluster, "get_taskcluster_pending_tasks", fake_get_taskcluster_pending_tasks
+    )
+    result = taskcluster.get_taskcluster_pending_tasks_for_worker_types(
+        [("prov", "wt-a")]
+    )
+    assert result == {("prov", "wt-a"): 0}
+
+
+def test_pending_tasks_for_worker_types_empty():
+    assert taskcluster.get_taskcluster_pending_tasks_for_worker_types([]) == {}
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, pending_tasks=0):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.pending_tasks = pending_tasks
+
+    def json(self):
+        if isinstance(self.pending_tasks, Exception):
+            raise self.pending_tasks
+        return {"pendingTasks": self.pending_tasks}
+
+
+class FakeSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.timeouts = []
+
+    def get(self, url, timeout=None):
+        self.timeouts.append(timeout)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_pending_tasks_retries_server_errors(monkeypatch):
+    session = FakeSession(
+        [requests.ConnectionError("boom"), FakeResponse(503), FakeResponse(200, 7)]
+    )
+    monkeypatch.setattr(taskcluster, "get_session", lambda: session)
+    monkeypatch.setattr(taskcluster.time, "sleep", lambda seconds: None)
+    assert taskcluster.get_taskcluster_pending_tasks("prov", "wt-a") == 7
+    assert (
+        session.timeouts
+        == [(taskcluster.CONNECT_TIMEOUT, taskcluster.READ_TIMEOUT)] * 3
+    )
+
+
+def test_pending_tasks_gives_up(monkeypatch):
+    session = FakeSession([FakeResponse(503), FakeResponse(404)])
+    monkeypatch.setattr(taskcluster, "get_session", lambda: session)
+    monkeypatch.setattr(taskcluster.time, "sleep", lambda seconds: None)
+    assert taskcluster.get_taskcluster_pending_tasks("prov", "wt-a") == 0
+    assert session.responses == []
+
+
+def test_pending_tasks_invalid_json(monkeypatch):
+    session = FakeSession([FakeResponse(200, ValueError("Expecting value"))])
+    monkeypatch.setattr(taskcluster, "get_session", lambda: session)
+    assert taskcluster.get_taskcluster_pending_tasks("prov", "wt-a") == 0
+    assert session.responses == []
@@ -3,22 +3,39 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import math
+import os
 import re
 import signal
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from testdroid import RequestResponseError
 
-from mozilla_bitbar_devicepool import configuration, logger
+from mozilla_bitbar_devicepool import configuration, instrumentation, logger, metrics
+from mozilla_bitbar_devicepool.active_runs import ActiveRunTracker
+from mozilla_bitbar_devicepool.allocator import (
+    PRIORITY,
+    SHARE,
+    DeviceAllocator,
+    allocate,
+    get_pool_name,
+    get_slack,
+)
 from mozilla_bitbar_devicepool.bitbar.device_groups import get_device_group_devices
-from mozilla_bitbar_devicepool.bitbar.devices import get_offline_devices
-from mozilla_bitbar_devicepool.bitbar.runs import (
-    get_active_test_runs,
-    run_test_for_project,
+from mozilla_bitbar_devicepool.bitbar.devices import (
+    get_offline_devices_index,
+    get_project_offline_devices,
+)
+from mozilla_bitbar_devicepool.bitbar.ratelimit import get_backoff, is_available
+from mozilla_bitbar_devicepool.bitbar.runs import run_test_for_project
+from mozilla_bitbar_devicepool.forecast import BacklogForecaster
+from mozilla_bitbar_devicepool.taskcluster import (
+    configure_session,
+    get_latency_stats,
+    get_taskcluster_pending_tasks_for_worker_types,
 )
-from mozilla_bitbar_devicepool.taskcluster import get_taskcluster_pending_tasks
 
 #
 # WARNING: not used everywhere yet!!!
@@ -30,6 +47,36 @@ CACHE = None
 CONFIG = None
 ARCHIVED_FILE_REGEX = r"FileEntity with id [\d]* does not exist"
 PROJECT_DOES_NOT_EXIST_REGEX = r"Project with id [\d]* does not exist"
+# maximum number of test runs started concurrently.
+START_MAX_WORKERS = 8
+# seconds between active run polls, see AdaptiveInterval.
+ACTIVE_RUNS_INTERVAL = 10
+ACTIVE_RUNS_MIN_INTERVAL = 5
+ACTIVE_RUNS_MAX_INTERVAL = 30
+
+
+class AdaptiveInterval(object):
+    """Poll interval which drops to minimum while there is work in
+    progress and doubles up to maximum while there is none.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.initial = initial
+        self.minimum = min(minimum, initial)
+        self.maximum = max(maximum, initial)
+        self.value = initial
+
+    def busy(self):
+        self.value = self.minimum
+        return self.value
+
+    def idle(self):
+        self.value = min(self.maximum, self.value * 2)
+        return self.value
+
+    def reset(self):
+        self.value = self.initial
+        return self.value
 
 
 class TestRunManager(object):
@@ -43,7 +90,15 @@ class TestRunManager(object):
     # tell pytest to ignore this class, it's not a test class
     __test__ = False
 
-    def __init__(self, wait=60):
+    def __init__(
+        self,
+        wait=60,
+        update_bitbar=False,
+        watch_config=False,
+        start_workers=START_MAX_WORKERS,
+        forecast=False,
+        allocate=False,
+    ):
         global CACHE, CONFIG
 
         CACHE = configuration.BITBAR_CACHE
@@ -51,31 +106,268 @@ class TestRunManager(object):
 
         self.wait = wait
         self.state = "RUNNING"
+        # set by stop so that sleeping threads notice it immediately.
+        self.stopped = threading.Event()
+        # test runs are started on a pool shared by all projects, see
+        # start_test_runs.
+        self.start_workers = max(1, start_workers)
+        self.start_executor = None
+        self.start_executor_lock = threading.Lock()
+        # queue workers wait on their project's wakeup event between
+        # passes so that they can be woken as soon as devices become idle
+        # or new tasks are pending, see wake_project.
+        self.wakeup_events = {}
+        self.queue_intervals = {}
+        self.pending_tasks_interval = AdaptiveInterval(
+            wait, max(1, wait // 2), wait * 2
+        )
+        self.active_runs_interval = AdaptiveInterval(
+            ACTIVE_RUNS_INTERVAL, ACTIVE_RUNS_MIN_INTERVAL, ACTIVE_RUNS_MAX_INTERVAL
+        )
+        # configuration reloading, see reload_configuration.
+        self.update_bitbar = update_bitbar
+        self.watch_config = watch_config
+        self.config_mtime = self.get_config_mtime()
+        self.reload_requested = False
+        # queue workers by project name and the projects whose workers
+        # have been asked to stop.
+        self.project_workers = {}
+        self.stopped_projects = set()
+        # published by thread_pending_tasks, replaced as a whole so that
+        # readers always see a consistent set of counts.
+        self.pending_tasks_snapshot = {"timestamp": None, "pending_tasks": {}}
+        # published by process_device_health once per stats cycle.
+        self.device_health_snapshot = {
+            "timestamp": None,
+            "by_model": {},
+            "by_device_group": {},
+        }
+        # index of the active runs of our projects, see process_active_runs.
+        self.active_runs = ActiveRunTracker()
+        # optionally start test runs ahead of the tasks expected to be
+        # queued while they wait for a device, see process_queue.
+        self.forecaster = BacklogForecaster() if forecast else None
+        # optionally divide the idle devices of each device model between
+        # the projects sharing them, see allocate_test_runs.
+        self.allocator = DeviceAllocator() if allocate else None
 
         signal.signal(signal.SIGUSR2, self.handle_signal)
         signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGHUP, self.handle_signal)
+        signal.signal(signal.SIGUSR1, self.handle_signal)
 
     def handle_signal(self, signalnum, frame):
+        if signalnum == signal.SIGUSR1:
+            self.log_endpoint_stats()
+            return
+
         if self.state != "RUNNING":
             return
 
         if signalnum == signal.SIGINT or signalnum == signal.SIGUSR2:
-            self.state = "STOP"
+            self.stop()
+        elif signalnum == signal.SIGHUP:
+            self.reload_requested = True
+
+    def stop(self):
+        """Stop the manager and wake its waiting threads so that they exit
+        without waiting out their intervals.
+        """
+        self.state = "STOP"
+        self.stopped.set()
+        for project_name in list(self.wakeup_events):
+            self.wake_project(project_name)
+
+    def log_endpoint_stats(self):
+        """Log the latency, errors and payload sizes of the Bitbar and
+        Taskcluster requests since the manager started.
+        """
+        for line in instrumentation.format_stats():
+            logger.info(line)
+
+    @staticmethod
+    def run_as(name, func, *args):
+        """Run func(*args) with the current thread renamed to name so
+        that log messages are attributed to the project rather than to
+        the pool thread running it.
+        """
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = name
+        try:
+            return func(*args)
+        finally:
+            thread.name = thread_name
+
+    def get_wakeup_event(self, project_name):
+        return self.wakeup_events.setdefault(project_name, threading.Event())
+
+    def wake_project(self, project_name):
+        """Wake the project's queue worker if it is waiting."""
+        event = self.wakeup_events.get(project_name)
+        if event:
+            event.set()
+
+    def wait_for_wakeup(self, project_name, timeout):
+        event = self.get_wakeup_event(project_name)
+        event.wait(timeout)
+        event.clear()
+
+    def get_queue_interval(self, project_name, projects_config, jobs_to_start):
+        """Return the seconds the project's queue worker should wait
+        before its next pass. The interval is shortened while test runs
+        are being started and lengthened while there are no pending tasks.
+        """
+        queue_interval = self.queue_intervals.get(project_name)
+        if queue_interval is None:
+            queue_interval = self.queue_intervals[project_name] = AdaptiveInterval(
+                self.wait, max(1, self.wait // 4), self.wait * 4
+            )
+        if jobs_to_start:
+            return queue_interval.busy()
+        if not self.get_project_pending_tasks(project_name, projects_config):
+            return queue_interval.idle()
+        return queue_interval.reset()
+
+    def is_project_running(self, project_name):
+        return self.state == "RUNNING" and project_name not in self.stopped_projects
+
+    def is_taskcluster_project(self, project_config):
+        return bool(project_config["additional_parameters"].get("TC_WORKER_TYPE"))
+
+    def get_config_mtime(self):
+        if not configuration.CONFIGPATH:
+            return None
+        try:
+            return os.stat(configuration.CONFIGPATH).st_mtime
+        except OSError:
+            return None
+
+    def check_config_changed(self):
+        """Request a reload if watching the configuration file and it
+        has been modified.
+        """
+        if not self.watch_config:
+            return
+        config_mtime = self.get_config_mtime()
+        if config_mtime is not None and config_mtime != self.config_mtime:
+            logger.info("configuration file changed")
+            self.config_mtime = config_mtime
+            self.reload_requested = True
+
+    def reload_configuration(self, projects_config):
+        """Reload the configuration file and reconcile the changes.
+
+        Returns a tuple of the reload_configuration changes, the projects
+        whose queue workers must be stopped and the projects whose queue
+        workers must be started, or None if the reload failed and the
+        current configuration remains in effect.
+        """
+        self.reload_requested = False
+        self.config_mtime = self.get_config_mtime()
+        logger.info("reloading configuration")
+        try:
+            changes = configuration.reload_configuration(
+                update_bitbar=self.update_bitbar
+            )
+        except Exception as e:
+            logger.error(
+                "Failed to reload configuration, keeping the current configuration (%s: %s)."
+                % (e.__class__.__name__, e),
+                exc_info=True,
+            )
+            return None
+
+        stop_projects = list(changes["removed_projects"])
+        start_projects = []
+        for project_name in changes["added_projects"] + changes["changed_projects"]:
+            is_taskcluster_project = self.is_taskcluster_project(
+                projects_config[project_name]
+            )
+            if is_taskcluster_project and project_name not in self.project_workers:
+                start_projects.append(project_name)
+            elif not is_taskcluster_project and project_name in self.project_workers:
+                stop_projects.append(project_name)
+        return changes, stop_projects, start_projects
+
+    def start_project_worker(self, project_name, projects_config):
+        self.stopped_projects.discard(project_name)
+        # prepopulate stats
+        self.update_project_stats(project_name, projects_config)
+
+        # multithread handle_queue
+        # TODO: should name be project_name or device group name?
+        t1 = threading.Thread(
+            target=self.handle_queue,
+            name=project_name,
+            args=(project_name, projects_config,),
+        )
+        CONFIG["threads"].append(t1)
+        self.project_workers[project_name] = t1
+        t1.start()
+
+    def stop_project_workers(self, project_names):
+        for project_name in project_names:
+            self.stopped_projects.add(project_name)
+            self.wake_project(project_name)
+        for project_name in project_names:
+            worker = self.project_workers.pop(project_name, None)
+            if worker:
+                worker.join()
+                CONFIG["threads"].remove(worker)
+
+    def reload(self, projects_config):
+        reload_result = self.reload_configuration(projects_config)
+        if reload_result is None:
+            return
+        changes, stop_projects, start_projects = reload_result
+        self.stop_project_workers(stop_projects)
+        configuration.remove_configuration(changes)
+        for project_name in changes["removed_projects"]:
+            metrics.remove_project(project_name)
+            if self.forecaster:
+                self.forecaster.remove_project(project_name)
+        for project_name in start_projects:
+            self.start_project_worker(project_name, projects_config)
+        self.refresh_pending_tasks(projects_config)
+
+    def main_sleep(self, seconds, projects_config):
+        """Sleep in the main thread while handling configuration reloads."""
+        end = time.time() + seconds
+        while self.state == "RUNNING" and time.time() < end:
+            self.check_config_changed()
+            if self.reload_requested:
+                self.reload(projects_config)
+            self.stopped.wait(1)
+
+    def process_device_health(self, projects_config):
+        """Fetch the device problems once and publish the offline devices
+        indexed by device model and device group.
+        """
+        device_models = set()
+        for project_name in list(projects_config):
+            if project_name == "defaults":
+                continue
+            device_model = projects_config[project_name].get("device_model")
+            if device_model:
+                device_models.add(device_model)
+        offline_devices_index = get_offline_devices_index(
+            CONFIG["device_groups"], device_models
+        )
+        offline_devices_index["timestamp"] = time.time()
+        self.device_health_snapshot = offline_devices_index
 
     def get_bitbar_test_stats(self, project_name, project_config):
         device_group_name = project_config["device_group_name"]
-        device_group = CONFIG["device_groups"][device_group_name]
         bitbar_device_group = CACHE["device_groups"][device_group_name]
-        stats = CACHE["projects"][project_name]["stats"]
         device_group_count = bitbar_device_group["deviceCount"]
 
-        offline_devices = []
-        temp_offline_devices = get_offline_devices(
-            device_model=project_config.get("device_model", None)
+        offline_devices = get_project_offline_devices(
+            self.device_health_snapshot,
+            device_group_name,
+            CONFIG["device_groups"].get(device_group_name),
+            device_model=project_config.get("device_model"),
         )
-        for device_name in temp_offline_devices:
-            if device_name in device_group:
-                offline_devices.append(device_name)
         enabled_devices = get_device_group_devices(bitbar_device_group["id"])
 
         stats = CACHE["projects"][project_name]["stats"]
@@ -85,116 +377,373 @@ class TestRunManager(object):
 
     def handle_queue(self, project_name, projects_config):
         logger.info("thread starting")
-        stats = CACHE["projects"][project_name]["stats"]
-        lock = CACHE["projects"][project_name]["lock"]
 
-        while self.state == "RUNNING":
-            project_config = projects_config[project_name]
-            device_group_name = project_config["device_group_name"]
-            additional_parameters = project_config["additional_parameters"]
-            worker_type = additional_parameters.get("TC_WORKER_TYPE")
+        while self.is_project_running(project_name):
+            start = time.time()
+            jobs_to_start = self.process_queue(project_name, projects_config)
+            self.start_test_runs(project_name, projects_config, jobs_to_start)
+            if self.allocator:
+                self.allocator.release(project_name)
+            metrics.observe_loop("queue", time.time() - start)
+
+            if self.is_project_running(project_name):
+                self.wait_for_wakeup(
+                    project_name,
+                    self.get_queue_interval(
+                        project_name, projects_config, jobs_to_start
+                    ),
+                )
+        logger.info("thread exiting")
 
-            with lock:
-                if stats["OFFLINE"] or stats["DISABLED"]:
-                    logger.warning(
-                        "{:10s} DISABLED {} OFFLINE {} {}".format(
-                            device_group_name,
-                            stats["DISABLED"],
-                            stats["OFFLINE"],
-                            ", ".join(stats["OFFLINE_DEVICES"]),
-                        )
-                    )
+    def get_start_executor(self):
+        # shared by the queue workers, only one may create it.
+        with self.start_executor_lock:
+            if self.start_executor is None:
+                self.start_executor = ThreadPoolExecutor(
+                    max_workers=self.start_workers, thread_name_prefix="start"
+                )
+            return self.start_executor
 
-                taskcluster_provisioner_id = projects_config["defaults"][
-                    "taskcluster_provisioner_id"
-                ]
+    def start_test_runs(self, project_name, projects_config, count):
+        """Start count test runs for the project concurrently, at most
+        start_workers at a time, and wait for them to be started.
 
-                # create enough tests to service either the pending tasks or the number of idle
-                # devices which do not already have a waiting test + a small logarithmic fudge
-                # term based on the number of pending tasks (whichever is smaller).
-                try:
-                    pending_tasks = get_taskcluster_pending_tasks(
-                        taskcluster_provisioner_id, worker_type
+        Runs which have not been started yet are skipped if the project
+        or the manager is stopped, e.g. by an archived file error.
+        """
+
+        def start(_task):
+            if self.is_project_running(project_name):
+                self.run_as(
+                    project_name, self.start_test_run, project_name, projects_config
+                )
+
+        if count == 1:
+            start(0)
+        elif count > 1:
+            list(self.get_start_executor().map(start, range(count)))
+
+    def get_project_worker_key(self, project_name, projects_config):
+        """Return the project's (provisioner_id, worker_type) tuple."""
+        taskcluster_provisioner_id = projects_config["defaults"][
+            "taskcluster_provisioner_id"
+        ]
+        worker_type = projects_config[project_name]["additional_parameters"].get(
+            "TC_WORKER_TYPE"
+        )
+        return (taskcluster_provisioner_id, worker_type)
+
+    def get_project_pending_tasks(self, project_name, projects_config):
+        return self.pending_tasks_snapshot["pending_tasks"].get(
+            self.get_project_worker_key(project_name, projects_config), 0
+        )
+
+    def get_jobs_to_start(self, project_name, projects_config, stats, pending_tasks):
+        """Return the number of test runs the project wants to start.
+
+        :param stats: StatsSnapshot of the project's stats.
+        """
+        # create enough tests to service either the pending tasks or the number of idle
+        # devices which do not already have a waiting test + a small logarithmic fudge
+        # term based on the number of pending tasks (whichever is smaller).
+        jobs_to_start = min(
+            pending_tasks,
+            stats.IDLE - stats.WAITING + get_slack(pending_tasks),
+        )
+        if jobs_to_start < 0:
+            jobs_to_start = 0
+        if self.forecaster:
+            # start runs for the tasks expected to be queued while
+            # they wait for a device, but only on idle devices.
+            expected_arrivals = self.forecaster.get_expected_arrivals(
+                project_name,
+                self.get_project_worker_key(project_name, projects_config),
+            )
+            forecast_jobs = min(
+                int(math.ceil(expected_arrivals)),
+                stats.IDLE - stats.WAITING - jobs_to_start,
+            )
+            if forecast_jobs > 0:
+                jobs_to_start += forecast_jobs
+        return jobs_to_start
+
+    def allocate_test_runs(self, project_name, projects_config, jobs_to_start):
+        """Return the number of the project's jobs_to_start which it may
+        start without taking devices from the other projects of its
+        device model.
+
+        The projects' demands are divided by allocate between the idle
+        devices of the pool which are not already waited on. Devices in
+        more than one of the pool's device groups are only counted once.
+        """
+        device_groups_config = CONFIG["device_groups"]
+        pool_name = get_pool_name(projects_config[project_name])
+        with self.allocator.lock:
+            demands = {}
+            devices = set()
+            offline_devices = set()
+            in_use = 0
+            available = 0
+            pending_tasks = 0
+            for name in list(projects_config):
+                project_config = projects_config.get(name)
+                bitbar_project = CACHE["projects"].get(name)
+                if (
+                    name == "defaults"
+                    or project_config is None
+                    or bitbar_project is None
+                    or not self.is_taskcluster_project(project_config)
+                    or get_pool_name(project_config) != pool_name
+                ):
+                    continue
+                stats = bitbar_project["stats"].snapshot
+                reserved = self.allocator.reserved.get(name, 0)
+                project_pending_tasks = self.get_project_pending_tasks(
+                    name, projects_config
+                )
+                if name == project_name:
+                    demand = jobs_to_start
+                else:
+                    demand = self.get_jobs_to_start(
+                        name, projects_config, stats, project_pending_tasks
                     )
-                except requests.ConnectionError as e:
+                usage = stats.RUNNING + stats.WAITING + reserved
+                available += max(0, stats.IDLE - stats.WAITING - reserved)
+                offline_devices.update(stats.OFFLINE_DEVICES)
+                devices.update(
+                    device_groups_config.get(project_config["device_group_name"]) or {}
+                )
+                in_use += usage
+                pending_tasks += project_pending_tasks
+                demands[name] = {
+                    "demand": max(0, demand - reserved),
+                    "priority": project_config.get("priority", PRIORITY),
+                    "share": project_config.get("share", SHARE),
+                    "usage": usage,
+                }
+            if devices:
+                available = min(available, len(devices - offline_devices) - in_use)
+            capacity = max(0, available) + get_slack(pending_tasks)
+            granted = allocate(capacity, demands).get(project_name, 0)
+            self.allocator.reserved[project_name] = (
+                self.allocator.reserved.get(project_name, 0) + granted
+            )
+        if granted < jobs_to_start:
+            logger.info(
+                "{} allocated {} of {} test runs".format(
+                    pool_name, granted, jobs_to_start
+                )
+            )
+        return granted
+
+    def process_queue(self, project_name, projects_config):
+        """Return the number of test runs to start for the project."""
+        # the latest published stats, the lock is not needed to read them.
+        stats = CACHE["projects"][project_name]["stats"].snapshot
+
+        project_config = projects_config[project_name]
+        device_group_name = project_config["device_group_name"]
+
+        # structured fields for the json log format.
+        fields = stats._asdict()
+        if stats.OFFLINE or stats.DISABLED:
+            # repeated every pass until the devices recover, see DedupFilter.
+            logger.warning(
+                "{:10s} DISABLED {} OFFLINE {} {}".format(
+                    device_group_name,
+                    stats.DISABLED,
+                    stats.OFFLINE,
+                    ", ".join(stats.OFFLINE_DEVICES),
+                ),
+                extra={
+                    "project": project_name,
+                    "fields": fields,
+                    "dedup_key": (project_name, "offline"),
+                },
+            )
+
+        pending_tasks = self.get_project_pending_tasks(project_name, projects_config)
+        jobs_to_start = self.get_jobs_to_start(
+            project_name, projects_config, stats, pending_tasks
+        )
+        # back off with the other projects while Bitbar is failing.
+        if jobs_to_start and not is_available("runs"):
+            logger.warning(
+                "not starting {} test runs while Bitbar runs requests are failing".format(
+                    jobs_to_start
+                )
+            )
+            jobs_to_start = 0
+        if jobs_to_start and self.allocator:
+            jobs_to_start = self.allocate_test_runs(
+                project_name, projects_config, jobs_to_start
+            )
+        metrics.set_project_stats(project_name, stats, jobs_to_start)
+
+        if stats.RUNNING or stats.WAITING:
+            logger.info(
+                "COUNT {} IDLE {} OFFLINE {} DISABLED {} RUNNING {} WAITING {} PENDING {} STARTING {}".format(
+                    stats.COUNT,
+                    stats.IDLE,
+                    stats.OFFLINE,
+                    stats.DISABLED,
+                    stats.RUNNING,
+                    stats.WAITING,
+                    pending_tasks,
+                    jobs_to_start,
+                ),
+                extra={
+                    "project": project_name,
+                    "fields": dict(
+                        fields, PENDING=pending_tasks, STARTING=jobs_to_start
+                    ),
+                },
+            )
+        return jobs_to_start
+
+    def start_test_run(self, project_name, projects_config):
+        """Start a single test run for the project, handling any errors."""
+        stats = CACHE["projects"][project_name]["stats"]
+        lock = CACHE["projects"][project_name]["lock"]
+        device_group_name = projects_config[project_name]["device_group_name"]
+
+        try:
+            if TESTING:
+                logger.info("TESTING MODE: Would be starting test run.")
+            else:
+                # if there are no devices assigned, the API will throw an exception
+                # when we try to start, so detect and warn here.
+                if stats["COUNT"] == 0:
                     logger.warning(
-                        "exception raised when calling get_taskcluster_pending_tasks."
+                        "Didn't try to start a job because there are no devices assigned."
                     )
-                    logger.warning(e)
-                    pending_tasks = 0
-                # warning: only take the log of positive non-zero numbers, or a
-                # "ValueError: math domain error" will be raised
-                jobs_to_start = min(
-                    pending_tasks,
-                    stats["IDLE"]
-                    - stats["WAITING"]
-                    + 1
-                    + int(math.log10(1 + pending_tasks)),
+                else:
+                    test_run = run_test_for_project(project_name)
+                    # increment so we don't start too many jobs before main thread updates stats
+                    with lock:
+                        stats["WAITING"] += 1
+                        stats.publish()
+                    metrics.increment("runs_started", project_name)
+                    if self.forecaster:
+                        self.forecaster.run_started(project_name, test_run["id"])
+
+                    logger.info("test run {} started".format(test_run["id"]))
+        except RequestResponseError as e:
+            metrics.increment("run_start_failures", project_name)
+            if e.status_code == 404 and re.search(ARCHIVED_FILE_REGEX, str(e)):
+                logger.error(
+                    "Test files have been archived. Exiting so configuration is rerun..."
                 )
-                if jobs_to_start < 0:
-                    jobs_to_start = 0
-
-                if stats["RUNNING"] or stats["WAITING"]:
-                    logger.info(
-                        "COUNT {} IDLE {} OFFLINE {} DISABLED {} RUNNING {} WAITING {} PENDING {} STARTING {}".format(
-                            stats["COUNT"],
-                            stats["IDLE"],
-                            stats["OFFLINE"],
-                            stats["DISABLED"],
-                            stats["RUNNING"],
-                            stats["WAITING"],
-                            pending_tasks,
-                            jobs_to_start,
-                        )
-                    )
+                logger.error("%s: %s" % (e.__class__.__name__, e))
+                configuration.invalidate_cache_snapshot("test files archived")
+                self.stop()
+            elif e.status_code == 404 and re.search(
+                PROJECT_DOES_NOT_EXIST_REGEX, str(e)
+            ):
+                logger.error(
+                    "Project does not exist!. Exiting so configuration is rerun..."
+                )
+                logger.error("%s: %s" % (e.__class__.__name__, e))
+                configuration.invalidate_cache_snapshot("project does not exist")
+                self.stop()
+            else:
+                logger.error("%s: %s" % (e.__class__.__name__, e))
+        except Exception as e:
+            metrics.increment("run_start_failures", project_name)
+            logger.error(
+                "Failed to create test run for group %s (%s: %s)."
+                % (device_group_name, e.__class__.__name__, e),
+                exc_info=True,
+            )
 
-            for _task in range(jobs_to_start):
-                if self.state != "RUNNING":
-                    break
-                try:
-                    if TESTING:
-                        logger.info("TESTING MODE: Would be starting test run.")
-                    else:
-                        # if there are no devices assigned, the API will throw an exception
-                        # when we try to start, so detect and warn here.
-                        if stats["COUNT"] == 0:
-                            logger.warning(
-                                "Didn't try to start a job because there are no devices assigned."
-                            )
-                        else:
-                            test_run = run_test_for_project(project_name)
-                            # increment so we don't start too many jobs before main thread updates stats
-                            with lock:
-                                stats["WAITING"] += 1
-
-                            logger.info("test run {} started".format(test_run["id"]))
-                except RequestResponseError as e:
-                    if e.status_code == 404 and re.search(ARCHIVED_FILE_REGEX, str(e)):
-                        logger.error(
-                            "Test files have been archived. Exiting so configuration is rerun..."
-                        )
-                        logger.error("%s: %s" % (e.__class__.__name__, e))
-                        self.state = "STOP"
-                    elif e.status_code == 404 and re.search(
-                        PROJECT_DOES_NOT_EXIST_REGEX, str(e)
-                    ):
-                        logger.error(
-                            "Project does not exist!. Exiting so configuration is rerun..."
-                        )
-                        logger.error("%s: %s" % (e.__class__.__name__, e))
-                        self.state = "STOP"
-                    else:
-                        logger.error("%s: %s" % (e.__class__.__name__, e))
-                except Exception as e:
-                    logger.error(
-                        "Failed to create test run for group %s (%s: %s)."
-                        % (device_group_name, e.__class__.__name__, e),
-                        exc_info=True,
-                    )
+    def get_taskcluster_worker_types(self, projects_config):
+        """Return the set of (provisioner_id, worker_type) tuples for the
+        Taskcluster managed projects.
+        """
+        taskcluster_provisioner_id = projects_config["defaults"][
+            "taskcluster_provisioner_id"
+        ]
+        worker_types = set()
+        for project_name in list(projects_config):
+            if project_name == "defaults":
+                continue
+            additional_parameters = projects_config[project_name][
+                "additional_parameters"
+            ]
+            worker_type = additional_parameters.get("TC_WORKER_TYPE")
+            if worker_type:
+                worker_types.add((taskcluster_provisioner_id, worker_type))
+        return worker_types
 
-            if self.state == "RUNNING":
-                time.sleep(self.wait)
-        logger.info("thread exiting")
+    def thread_pending_tasks(self, projects_config):
+        while self.state == "RUNNING":
+            self.stopped.wait(self.pending_tasks_interval.value)
+            if self.state != "RUNNING":
+                break
+            self.refresh_pending_tasks(projects_config)
+
+    def refresh_pending_tasks(self, projects_config):
+        """Call process_pending_tasks, logging instead of raising any error
+        so that a Taskcluster failure does not stop the calling thread.
+        """
+        try:
+            self.process_pending_tasks(projects_config)
+        except Exception as e:
+            logger.error(
+                "Failed to get pending tasks (%s: %s)." % (e.__class__.__name__, e),
+                exc_info=True,
+            )
+
+    def process_pending_tasks(self, projects_config):
+        worker_types = self.get_taskcluster_worker_types(projects_config)
+        start = time.time()
+        pending_tasks = get_taskcluster_pending_tasks_for_worker_types(worker_types)
+        end = time.time()
+        previous_pending_tasks = self.pending_tasks_snapshot["pending_tasks"]
+        self.pending_tasks_snapshot = {
+            "timestamp": end,
+            "pending_tasks": pending_tasks,
+        }
+        metrics.set_pending_tasks(pending_tasks)
+        metrics.observe_loop("pending_tasks", end - start)
+        if self.forecaster:
+            self.forecaster.observe_pending_tasks(pending_tasks, end)
+
+        # wake the queue workers of worker types with more pending tasks.
+        increased_worker_types = set(
+            worker_key
+            for worker_key, count in pending_tasks.items()
+            if count > previous_pending_tasks.get(worker_key, 0)
+        )
+        if increased_worker_types:
+            self.pending_tasks_interval.busy()
+            for project_name in list(projects_config):
+                if project_name == "defaults" or project_name not in projects_config:
+                    continue
+                worker_key = (
+                    projects_config["defaults"]["taskcluster_provisioner_id"],
+                    projects_config[project_name]["additional_parameters"].get(
+                        "TC_WORKER_TYPE"
+                    ),
+                )
+                if worker_key in increased_worker_types:
+                    self.wake_project(project_name)
+        elif not any(pending_tasks.values()):
+            self.pending_tasks_interval.idle()
+        else:
+            self.pending_tasks_interval.reset()
+        latency_stats = get_latency_stats()
+        logger.info(
+            "pending tasks for {} worker types took {:.3f} seconds "
+            "(requests {} errors {} retries {} max {:.3f})".format(
+                len(worker_types),
+                end - start,
+                latency_stats["requests"],
+                latency_stats["errors"],
+                latency_stats["retries"],
+                latency_stats["max_seconds"],
+            )
+        )
 
     def thread_active_jobs(self):
         while self.state == "RUNNING":
@@ -204,48 +753,57 @@ class TestRunManager(object):
             except requests.exceptions.ConnectionError as e:
                 logger.warning("exception raised when calling process_active_runs.")
                 logger.warning(e)
-                # TODO: if we see this a lot, add exponential backoff?
-                time.sleep(10)
-            time.sleep(10)
+                self.stopped.wait(get_backoff("admin"))
+            self.stopped.wait(self.active_runs_interval.value)
 
     def process_active_runs(self):
+        start = time.time()
         bitbar_projects = CACHE["projects"]
         bitbar_test_runs = CACHE["test_runs"]
 
-        # init the temporary dict
-        accumulation_dict = {}
-        for project_name in bitbar_projects:
-            accumulation_dict[project_name] = []
+        # projects may be added or removed by a configuration reload while
+        # we are working.
+        project_ids = {}
+        for project_name in list(bitbar_projects):
+            bitbar_project = bitbar_projects.get(project_name)
+            if bitbar_project is not None:
+                project_ids[bitbar_project["id"]] = project_name
 
         try:
-            # gather all runs per project
-            result = get_active_test_runs()
+            changed_projects, full_sync = self.active_runs.sync(project_ids)
         except RequestResponseError as e:
             logger.error("process_active_runs: RequestResponseError received")
             logger.error(e)
             return
-
-        for item in result:
-            # remove user id from this (see configuration.py:configure_projects)
-            project_name = item["projectName"].replace(
-                "%s-" % (configuration.get_me_id()), ""
+        if full_sync:
+            logger.info("active runs: full resync")
+        elif changed_projects:
+            logger.info(
+                "active runs: changed {}".format(", ".join(sorted(changed_projects)))
             )
-            # only accumulate for projects in our config
-            if project_name in bitbar_projects:
-                accumulation_dict[project_name].append(item)
-
-        # replace current values with what we got above
-        for project_name in bitbar_projects:
-            stats = CACHE["projects"][project_name]["stats"]
-            lock = CACHE["projects"][project_name]["lock"]
+        # poll more often while runs are starting and finishing.
+        if changed_projects:
+            self.active_runs_interval.busy()
+        elif not self.active_runs.runs:
+            self.active_runs_interval.idle()
+        else:
+            self.active_runs_interval.reset()
+
+        # only the projects whose runs changed need their counts replaced,
+        # but IDLE also depends on the OFFLINE and DISABLED counts updated
+        # by the stats loop.
+        for project_name in project_ids.values():
+            bitbar_project = bitbar_projects.get(project_name)
+            if bitbar_project is None:
+                continue
+            stats = bitbar_project["stats"]
+            lock = bitbar_project["lock"]
             with lock:
-                bitbar_test_runs[project_name] = accumulation_dict[project_name]
-
-                stats["RUNNING"] = 0
-                stats["WAITING"] = 0
-                for test_run in bitbar_test_runs[project_name]:
-                    test_run_state = test_run["state"]
-                    stats[test_run_state] += 1
+                available = stats["IDLE"] - stats["WAITING"]
+                if full_sync or project_name in changed_projects:
+                    project_runs = self.active_runs.get_project_runs(project_name)
+                    bitbar_test_runs[project_name] = project_runs
+                    stats.update(self.active_runs.get_counts(project_name))
 
                 stats["IDLE"] = (
                     stats["COUNT"]
@@ -255,6 +813,37 @@ class TestRunManager(object):
                 )
                 if stats["IDLE"] < 0:
                     stats["IDLE"] = 0
+                # devices became available for tasks.
+                wake = stats["IDLE"] - stats["WAITING"] > available
+                snapshot = stats.publish()
+            metrics.set_project_stats(project_name, snapshot)
+            if self.forecaster:
+                self.forecaster.observe_runs(
+                    project_name, bitbar_test_runs.get(project_name, []), start
+                )
+            if wake:
+                self.wake_project(project_name)
+        metrics.observe_loop("active_runs", time.time() - start)
+
+    def update_project_stats(self, project_name, projects_config):
+        lock = CACHE["projects"][project_name]["lock"]
+        with lock:
+            self.get_bitbar_test_stats(project_name, projects_config[project_name])
+            snapshot = CACHE["projects"][project_name]["stats"].publish()
+        metrics.set_project_stats(project_name, snapshot)
+
+    def log_totals(self, projects_config):
+        waiting_total = 0
+        running_total = 0
+        for project_name in list(projects_config):
+            if project_name == "defaults":
+                continue
+            stats = CACHE["projects"][project_name]["stats"].snapshot
+            waiting_total += stats.WAITING
+            running_total += stats.RUNNING
+        logger.info(
+            "WAITING_TOTAL {} RUNNING_TOTAL {}".format(waiting_total, running_total)
+        )
 
     def run(self):
         projects_config = CONFIG["projects"]
@@ -268,6 +857,23 @@ class TestRunManager(object):
         CONFIG["threads"].append(active_job_thread)
         time.sleep(2)
 
+        logger.info("test-run-manager: loading pending tasks")
+        # one pooled connection per concurrent pending task request
+        configure_session(
+            pool_size=len(self.get_taskcluster_worker_types(projects_config))
+        )
+        self.refresh_pending_tasks(projects_config)
+        pending_tasks_thread = threading.Thread(
+            target=self.thread_pending_tasks,
+            name="pending_tasks",
+            args=(projects_config,),
+        )
+        pending_tasks_thread.start()
+        CONFIG["threads"].append(pending_tasks_thread)
+
+        logger.info("test-run-manager: loading device health")
+        self.process_device_health(projects_config)
+
         for project_name in projects_config:
             if project_name == "defaults":
                 continue
@@ -281,48 +887,40 @@ class TestRunManager(object):
                 # Only manage projects initiated via Taskcluster.
                 continue
 
-            # prepopulate stats
-            self.get_bitbar_test_stats(project_name, projects_config[project_name])
+            self.start_project_worker(project_name, projects_config)
             time.sleep(1)
 
-            # multithread handle_queue
-            # TODO: should name be project_name or device group name?
-            t1 = threading.Thread(
-                target=self.handle_queue,
-                name=project_name,
-                args=(project_name, projects_config,),
-            )
-            CONFIG["threads"].append(t1)
-            t1.start()
-
         # we need the main thread to keep running so it can handle signals
         # - https://www.g-loaded.eu/2016/11/24/how-to-terminate-running-python-threads-using-signals/
         while self.state == "RUNNING":
-            waiting_total = 0
-            running_total = 0
-            time.sleep(60)
+            self.main_sleep(60, projects_config)
+            if self.state != "RUNNING":
+                break
             logger.info("getting stats for all projects")
+            start = time.time()
+            try:
+                self.process_device_health(projects_config)
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("exception raised when calling process_device_health.")
+                logger.warning(e)
             for project_name in projects_config:
                 if project_name == "defaults":
                     continue
-                lock = CACHE["projects"][project_name]["lock"]
-                stats = CACHE["projects"][project_name]["stats"]
-                waiting_total += stats["WAITING"]
-                running_total += stats["RUNNING"]
-                with lock:
-                    try:
-                        self.get_bitbar_test_stats(
-                            project_name, projects_config[project_name]
-                        )
-                    except requests.exceptions.ConnectionError as e:
-                        logger.warning(
-                            "exception raised when calling get_bitbar_test_stats."
-                        )
-                        logger.warning(e)
-                        # TODO: if we see this a lot, add exponential backoff?
-                        time.sleep(15)
+                try:
+                    self.update_project_stats(project_name, projects_config)
+                except requests.exceptions.ConnectionError as e:
+                    logger.warning(
+                        "exception raised when calling get_bitbar_test_stats."
+                    )
+                    logger.warning(e)
+                    time.sleep(get_backoff("devices"))
                 time.sleep(1)
-            logger.info(
-                "WAITING_TOTAL {} RUNNING_TOTAL {}".format(waiting_total, running_total)
-            )
+            self.log_totals(projects_config)
+            metrics.observe_loop("stats", time.time() - start)
+        # the queue workers may still be starting test runs on the
+        # executor, which must not be shut down before they exit.
+        for worker in list(self.project_workers.values()):
+            worker.join()
+        if self.start_executor:
+            self.start_executor.shutdown(wait=True)
         logger.info("main thread exiting")
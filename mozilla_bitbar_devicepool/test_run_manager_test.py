@@ -0,0 +1,260 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from testdroid import RequestResponseError
+
+from mozilla_bitbar_devicepool import (
+    allocator,
+    configuration,
+    forecast,
+    test_run_manager,
+)
+from mozilla_bitbar_devicepool.async_test_run_manager import AsyncTestRunManager
+from mozilla_bitbar_devicepool.project_stats import ProjectStats
+
+projects_config = {
+    "defaults": {"taskcluster_provisioner_id": "proj-autophone"},
+    "test-1": {
+        "device_group_name": "group-1",
+        "additional_parameters": {"TC_WORKER_TYPE": "worker-1"},
+    },
+}
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # leave pytest's signal handlers in place.
+    monkeypatch.setattr(test_run_manager.signal, "signal", lambda *args: None)
+    monkeypatch.setattr(configuration, "CONFIG", {"projects": projects_config})
+    monkeypatch.setattr(
+        configuration,
+        "BITBAR_CACHE",
+        {
+            "projects": {
+                "test-1": {
+                    "id": 1,
+                    "lock": threading.Lock(),
+                    "stats": ProjectStats(COUNT=10),
+                }
+            },
+            "test_runs": {},
+        },
+    )
+    manager = test_run_manager.TestRunManager(start_workers=4)
+    yield manager
+    if manager.start_executor:
+        manager.start_executor.shutdown(wait=True)
+
+
+def test_start_test_runs(monkeypatch, manager):
+    started = []
+
+    def fake_run_test_for_project(project_name):
+        started.append(threading.current_thread().name)
+        return {"id": len(started)}
+
+    monkeypatch.setattr(
+        test_run_manager, "run_test_for_project", fake_run_test_for_project
+    )
+    manager.start_test_runs("test-1", projects_config, 20)
+    assert len(started) == 20
+    assert set(started) == {"test-1"}
+    stats = configuration.BITBAR_CACHE["projects"]["test-1"]["stats"]
+    assert stats["WAITING"] == 20
+    assert stats.snapshot.WAITING == 20
+
+
+def test_get_start_executor_shared(manager):
+    executors = []
+    barrier = threading.Barrier(8)
+
+    def get_executor():
+        barrier.wait()
+        executors.append(manager.get_start_executor())
+
+    threads = [threading.Thread(target=get_executor) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, executors))) == 1
+
+
+def test_start_test_runs_archived_file(monkeypatch, manager):
+    manager.start_workers = 1
+    started = []
+
+    def fake_run_test_for_project(project_name):
+        started.append(project_name)
+        raise RequestResponseError("FileEntity with id 1 does not exist", 404)
+
+    monkeypatch.setattr(
+        test_run_manager, "run_test_for_project", fake_run_test_for_project
+    )
+    manager.start_test_runs("test-1", projects_config, 5)
+    assert manager.state == "STOP"
+    assert started == ["test-1"]
+    assert configuration.BITBAR_CACHE["projects"]["test-1"]["stats"]["WAITING"] == 0
+
+
+def test_start_test_runs_async_errors(monkeypatch, manager):
+    manager = AsyncTestRunManager(start_workers=2)
+    started = []
+
+    def fake_start_test_run(project_name, projects_config):
+        started.append(project_name)
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+    monkeypatch.setattr(manager, "start_test_run", fake_start_test_run)
+    manager.loop = asyncio.new_event_loop()
+    manager.executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        # the errors are logged rather than ending the project's task.
+        manager.loop.run_until_complete(
+            manager.start_test_runs_async("test-1", projects_config, 3)
+        )
+    finally:
+        manager.executor.shutdown(wait=True)
+        manager.loop.close()
+    assert started == ["test-1"] * 3
+
+
+def test_start_project_worker_publishes_stats(monkeypatch, manager):
+    def fake_get_bitbar_test_stats(project_name, project_config):
+        stats = configuration.BITBAR_CACHE["projects"][project_name]["stats"]
+        stats["OFFLINE"] = 2
+
+    monkeypatch.setattr(manager, "get_bitbar_test_stats", fake_get_bitbar_test_stats)
+    monkeypatch.setattr(manager, "handle_queue", lambda *args: None)
+    monkeypatch.setitem(test_run_manager.CONFIG, "threads", [])
+    manager.start_project_worker("test-1", projects_config)
+    manager.project_workers["test-1"].join()
+    stats = configuration.BITBAR_CACHE["projects"]["test-1"]["stats"]
+    assert stats.snapshot.OFFLINE == 2
+
+
+def test_stop_wakes_threads(manager):
+    event = manager.get_wakeup_event("test-1")
+    manager.pending_tasks_interval = test_run_manager.AdaptiveInterval(3600, 1, 3600)
+    pending_tasks_thread = threading.Thread(
+        target=manager.thread_pending_tasks, args=(projects_config,)
+    )
+    pending_tasks_thread.start()
+    manager.stop()
+    pending_tasks_thread.join(5)
+    assert not pending_tasks_thread.is_alive()
+    assert event.is_set()
+    assert manager.state == "STOP"
+
+
+def test_adaptive_interval():
+    interval = test_run_manager.AdaptiveInterval(20, 5, 60)
+    assert interval.busy() == 5
+    assert [interval.idle() for _ in range(5)] == [10, 20, 40, 60, 60]
+    assert interval.reset() == 20
+
+
+def test_pending_tasks_wake_project(monkeypatch, manager):
+    pending_tasks = {("proj-autophone", "worker-1"): 0}
+    monkeypatch.setattr(
+        test_run_manager,
+        "get_taskcluster_pending_tasks_for_worker_types",
+        lambda worker_types: dict(pending_tasks),
+    )
+    event = manager.get_wakeup_event("test-1")
+
+    manager.process_pending_tasks(projects_config)
+    assert not event.is_set()
+    assert manager.pending_tasks_interval.value == manager.wait * 2
+
+    pending_tasks[("proj-autophone", "worker-1")] = 3
+    manager.process_pending_tasks(projects_config)
+    assert event.is_set()
+    assert manager.pending_tasks_interval.value == manager.wait // 2
+    assert manager.get_project_pending_tasks("test-1", projects_config) == 3
+
+
+def test_refresh_pending_tasks_errors(monkeypatch, manager, caplog):
+    def fail(worker_types):
+        raise ValueError("Expecting value")
+
+    monkeypatch.setattr(
+        test_run_manager, "get_taskcluster_pending_tasks_for_worker_types", fail
+    )
+    manager.refresh_pending_tasks(projects_config)
+    assert "Failed to get pending tasks (ValueError: Expecting value)." in caplog.text
+
+
+def test_process_queue_forecast(monkeypatch, manager):
+    stats = configuration.BITBAR_CACHE["projects"]["test-1"]["stats"]
+    stats.update({"IDLE": 6, "RUNNING": 4, "WAITING": 1})
+    stats.publish()
+    manager.pending_tasks_snapshot = {
+        "timestamp": None,
+        "pending_tasks": {("proj-autophone", "worker-1"): 2},
+    }
+    assert manager.process_queue("test-1", projects_config) == 2
+
+    manager.forecaster = forecast.BacklogForecaster()
+    monkeypatch.setattr(manager.forecaster, "get_expected_arrivals", lambda *args: 1.5)
+    assert manager.process_queue("test-1", projects_config) == 4
+    # but only on idle devices.
+    monkeypatch.setattr(manager.forecaster, "get_expected_arrivals", lambda *args: 50)
+    assert manager.process_queue("test-1", projects_config) == 5
+
+
+def test_process_queue_allocate(monkeypatch, manager):
+    # two projects share four pixel2 devices, one of which is in both
+    # device groups.
+    shared_config = {
+        "defaults": projects_config["defaults"],
+        "unit": {
+            "device_group_name": "unit",
+            "device_model": "pixel2",
+            "additional_parameters": {"TC_WORKER_TYPE": "worker-unit"},
+        },
+        "perf": {
+            "device_group_name": "perf",
+            "device_model": "pixel2",
+            "priority": 1,
+            "additional_parameters": {"TC_WORKER_TYPE": "worker-perf"},
+        },
+    }
+    device_groups = {
+        "unit": {"pixel2-01": None, "pixel2-02": None, "pixel2-03": None},
+        "perf": {"pixel2-03": None, "pixel2-04": None},
+    }
+    monkeypatch.setattr(
+        test_run_manager, "CONFIG", {"projects": shared_config, "device_groups": {}}
+    )
+    test_run_manager.CONFIG["device_groups"] = device_groups
+    for project_name, count in (("unit", 3), ("perf", 2)):
+        test_run_manager.CACHE["projects"][project_name] = {
+            "lock": threading.Lock(),
+            "stats": ProjectStats(COUNT=count, IDLE=count),
+        }
+    manager.pending_tasks_snapshot = {
+        "timestamp": None,
+        "pending_tasks": {
+            ("proj-autophone", "worker-unit"): 5,
+            ("proj-autophone", "worker-perf"): 5,
+        },
+    }
+    # without allocation the shared device is counted twice.
+    assert manager.process_queue("unit", shared_config) == 4
+    assert manager.process_queue("perf", shared_config) == 3
+
+    # perf has priority, the four devices and two more runs to queue for
+    # the ten pending tasks are shared between the projects.
+    manager.allocator = allocator.DeviceAllocator()
+    assert manager.process_queue("unit", shared_config) == 3
+    assert manager.allocator.reserved == {"unit": 3}
+    assert manager.process_queue("perf", shared_config) == 3
+    manager.allocator.release("unit")
+    assert manager.allocator.reserved == {"perf": 3}
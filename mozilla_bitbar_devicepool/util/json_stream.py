@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import codecs
+import json
+
+# characters of the decoded prefix kept before the buffer is trimmed.
+TRIM_SIZE = 65536
+
+WHITESPACE = " \t\n\r"
+
+
+class JSONStream(object):
+    """Buffer of the text of a JSON document read from an iterable of
+    chunks of UTF-8 encoded bytes or text, from which values are decoded
+    one at a time as the chunks arrive.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.index = 0
+        self.eof = False
+
+    def read(self):
+        """Append the next chunk to the buffer. Return False at the end."""
+        if self.eof:
+            return False
+        if self.index > TRIM_SIZE:
+            self.buffer = self.buffer[self.index :]
+            self.index = 0
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.decoder.decode(chunk)
+            if chunk:
+                self.buffer += chunk
+                return True
+        self.buffer += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """Return the next character which is not whitespace, or '' at
+        the end of the document.
+        """
+        while True:
+            while (
+                self.index < len(self.buffer) and self.buffer[self.index] in WHITESPACE
+            ):
+                self.index += 1
+            if self.index < len(self.buffer) or not self.read():
+                return self.buffer[self.index : self.index + 1]
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(
+                "expected one of {!r} at offset {} but found {!r}".format(
+                    characters, self.index, character
+                )
+            )
+        self.index += 1
+        return character
+
+    def decode(self):
+        """Decode and return the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.index)
+            except ValueError:
+                # incomplete, or invalid once the document has been read.
+                if self.read():
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next
+            # chunk.
+            if end == len(self.buffer) and self.read():
+                continue
+            self.index = end
+            return value
+
+
+def iter_items(chunks, key="data"):
+    """Yield the items of the array stored under key in the JSON object
+    read from chunks, decoding each item as it arrives rather than the
+    whole document. The object's other values are decoded and discarded.
+
+    :param chunks: iterable of bytes or str, e.g. a streamed
+                   requests.Response's iter_content().
+    :param key: name of the array member of the top level object.
+
+    Examples:
+       iter_items([b'{"data": [{"id": 1}, {"id"', b': 2}], "total": 2}'])
+       # yields {"id": 1} then {"id": 2}
+    """
+    stream = JSONStream(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        name = stream.decode()
+        stream.expect(":")
+        if name == key and stream.peek() == "[":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            stream.decode()
+        if stream.expect(",}") == "}":
+            return
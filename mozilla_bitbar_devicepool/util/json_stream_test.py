@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+from mozilla_bitbar_devicepool.util import json_stream
+
+
+def split(text, size):
+    data = text.encode("utf-8")
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_items():
+    document = {
+        "offset": 0,
+        "data": [
+            {"id": 1, "deviceName": "pixel2-01", "problems": [{"type": "OFFLINE"}]},
+            {"id": 22, "deviceName": "motog5-é", "escaped": "\\"},
+            [],
+            12345,
+        ],
+        "total": 4,
+        "empty": False,
+    }
+    text = json.dumps(document)
+    # items split across chunks, including multi-byte characters and
+    # numbers.
+    for size in (1, 2, 3, 7, len(text)):
+        assert list(json_stream.iter_items(split(text, size))) == document["data"]
+    assert list(json_stream.iter_items([text])) == document["data"]
+    assert list(json_stream.iter_items([json.dumps({"data": [], "total": 0})])) == []
+    assert list(json_stream.iter_items(["{}"])) == []
+    assert list(json_stream.iter_items(['{"runs": [1]}'], key="runs")) == [1]
+
+
+def test_iter_items_stops_early():
+    chunks = iter(['{"data": [{"id": 1}, ', '{"id": 2}', "]}"])
+    items = json_stream.iter_items(chunks)
+    assert next(items) == {"id": 1}
+    # the remaining chunks have not been read.
+    assert list(chunks) == ['{"id": 2}', "]}"]
+
+
+def test_iter_items_invalid():
+    with pytest.raises(ValueError):
+        list(json_stream.iter_items(['{"data": [{"id": 1}, {"id"']))
+    with pytest.raises(ValueError):
+        list(json_stream.iter_items(["[]"]))
@@ -26,30 +26,92 @@ def lookup_key_value(dict_list, keyname):
     return None
 
 
+# filter operators accepted by get_filter after a double underscore in
+# the keyword argument name, e.g. id__in=[1, 2]. eq is the default.
+FILTER_OPERATORS = ("eq", "in", "isnull", "like", "gt", "lt")
+
+
+def get_filter_flag(fieldname, fieldtype):
+    if fieldtype == int:
+        if "time" in fieldname:
+            return "d"
+        return "n"
+    elif fieldtype == str:
+        return "s"
+    elif fieldtype == bool:
+        return "b"
+    raise ValueError("Unknown filter field type %s" % fieldtype)
+
+
+def check_filter_value(fieldname, fieldtype, fieldvalue):
+    if type(fieldvalue) is not fieldtype:
+        raise ValueError(
+            "filter field name {} type {} does not match {}".format(
+                fieldname, type(fieldvalue), fieldtype
+            )
+        )
+
+
 def get_filter(fields, **kwargs):
+    """Return a list of Bitbar filter expressions.
+
+    :param fields: dict mapping the field names which may be filtered on
+                   to their types.
+    :param **kwargs: keyword arguments containing fieldnames, optionally
+                     followed by a double underscore and one of
+                     FILTER_OPERATORS, and the values to filter by:
+                     eq: value of the field's type.
+                     in: non-empty list of values of the field's type.
+                     isnull: True for isnull, False for isnotnull.
+                     like: str value, matched anywhere in str fields.
+                     gt, lt: int value, for int fields such as times.
+
+    Examples:
+       get_filter({'name': str}, name='test.zip')
+       # ['s_name_eq_test.zip']
+       get_filter({'id': int, 'endtime': int}, id__in=[1, 2], endtime__isnull=True)
+       # ['n_id_in_1|2', 'd_endtime_isnull']
+    """
     filter = []
-    for fieldname in kwargs:
-        fieldvalue = kwargs[fieldname]
-        fieldtype = type(fieldvalue)
-        if fieldtype != fields[fieldname]:
+    for key in kwargs:
+        fieldname, _, operator = key.partition("__")
+        operator = operator or "eq"
+        if operator not in FILTER_OPERATORS:
             raise ValueError(
-                "filter field name {} type {} does not match {}".format(
-                    fieldname, fieldtype, fields[fieldname]
+                "filter operator {} is not one of {}".format(operator, FILTER_OPERATORS)
+            )
+        fieldvalue = kwargs[key]
+        fieldtype = fields[fieldname]
+        fieldflag = get_filter_flag(fieldname, fieldtype)
+        if operator == "isnull":
+            check_filter_value(key, bool, fieldvalue)
+            filter.append(
+                "{}_{}_{}".format(
+                    fieldflag, fieldname, "isnull" if fieldvalue else "isnotnull"
                 )
             )
-        fieldflag = ""
-        if fieldtype == int:
-            if "time" in fieldname:
-                fieldflag = "d"
-            else:
-                fieldflag = "n"
-        elif fieldtype == str:
-            fieldflag = "s"
-        elif fieldtype == bool:
-            fieldflag = "b"
+            continue
+        if operator == "in":
+            if not isinstance(fieldvalue, (list, tuple, set)) or not fieldvalue:
+                raise ValueError(
+                    "filter field name {} requires a non-empty list".format(key)
+                )
+            for value in fieldvalue:
+                check_filter_value(key, fieldtype, value)
+            fieldvalue = "|".join(str(value) for value in fieldvalue)
         else:
-            raise ValueError("Unknown filter field type %s" % fieldtype)
-        filter.append("{}_{}_eq_{}".format(fieldflag, fieldname, fieldvalue))
+            if operator == "like" and fieldtype != str:
+                raise ValueError(
+                    "filter field name {} like requires a str field".format(key)
+                )
+            if operator in ("gt", "lt") and fieldtype != int:
+                raise ValueError(
+                    "filter field name {} {} requires an int field".format(
+                        key, operator
+                    )
+                )
+            check_filter_value(key, fieldtype, fieldvalue)
+        filter.append("{}_{}_{}_{}".format(fieldflag, fieldname, operator, fieldvalue))
     return filter
 
 
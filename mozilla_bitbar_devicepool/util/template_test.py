@@ -0,0 +1,62 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozilla_bitbar_devicepool.util.template import get_filter
+
+FIELDS = {
+    "archivetime": int,
+    "enabled": bool,
+    "endtime": int,
+    "id": int,
+    "name": str,
+}
+
+
+def test_get_filter_eq():
+    assert get_filter(FIELDS, name="test.zip", id=3, enabled=True) == [
+        "s_name_eq_test.zip",
+        "n_id_eq_3",
+        "b_enabled_eq_True",
+    ]
+    assert get_filter(FIELDS, id__eq=3) == ["n_id_eq_3"]
+
+
+def test_get_filter_operators():
+    assert get_filter(
+        FIELDS,
+        id__in=[1, 2],
+        endtime__isnull=True,
+        archivetime__isnull=False,
+        name__like="pixel",
+        endtime__gt=1000,
+        id__lt=5,
+    ) == [
+        "n_id_in_1|2",
+        "d_endtime_isnull",
+        "d_archivetime_isnotnull",
+        "s_name_like_pixel",
+        "d_endtime_gt_1000",
+        "n_id_lt_5",
+    ]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"id": "3"},
+        {"id__foo": 3},
+        {"id__in": []},
+        {"id__in": 3},
+        {"id__in": [1, "2"]},
+        {"endtime__isnull": 1},
+        {"id__like": 3},
+        {"name__gt": "a"},
+        {"endtime__lt": "1000"},
+    ],
+)
+def test_get_filter_invalid(kwargs):
+    with pytest.raises(ValueError):
+        get_filter(FIELDS, **kwargs)